@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Adaptive-compute inference for TomatoHealth
+Every image gets one cheap pass; only uncertain ones are escalated to test-time augmentation
+(flipped and cropped views in one invoke) and, if still uncertain, to a larger model.
+
+Usage:
+    python adaptive.py report labeled/ --output tiers.json
+"""
+
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+
+from imaging import load_image, resize_for_model
+
+# Tiers in escalation order; each prediction records the one that answered it
+SINGLE = 'single'
+TTA = 'tta'
+LARGE = 'large'
+TIERS = (SINGLE, TTA, LARGE)
+
+# Flips plus centre and corner crops
+TTA_VIEWS = 7
+
+# Invokes and model inputs spent on an image answered by each tier
+TIER_COST = {SINGLE: (1, 1), TTA: (2, 1 + TTA_VIEWS), LARGE: (3, 2 + TTA_VIEWS)}
+
+
+def top_margin(probs):
+    """Difference between the two highest probabilities"""
+    top = np.partition(probs, -2)[-2:]
+    return float(top[1] - top[0])
+
+
+def normalized_entropy(probs):
+    """Entropy of a probability vector scaled to [0, 1]"""
+    probs = np.clip(probs, 1e-12, 1.0)
+    return float(-(probs * np.log(probs)).sum() / np.log(len(probs)))
+
+
+def tta_views(image, base=None, crop=0.85):
+    """
+    Model inputs for the augmented views of a decoded RGB image: horizontal and vertical
+    flips of the whole image, and centre and corner crops covering `crop` of each side.
+    base is the plain model input, when already computed.
+    """
+    if base is None:
+        base = resize_for_model(image)
+    views = [base[:, ::-1], base[::-1]]
+    height, width = image.shape[:2]
+    crop_height, crop_width = int(height * crop), int(width * crop)
+    corners = [((height - crop_height) // 2, (width - crop_width) // 2), (0, 0), (0, width - crop_width),
+               (height - crop_height, 0), (height - crop_height, width - crop_width)]
+    for top, left in corners:
+        views.append(resize_for_model(np.ascontiguousarray(image[top:top + crop_height, left:left + crop_width])))
+    return np.stack(views)
+
+
+class AdaptiveInference:
+    """
+    Runs the active model once and escalates only when its answer is uncertain: the
+    top-1 margin is below min_margin or the normalized entropy above max_entropy.
+    Uncertain images get every TTA view in one batched invoke, averaged with the first
+    pass; if that is still uncertain and a larger model is configured, it answers instead.
+    """
+
+    def __init__(self, min_margin=None, max_entropy=None, large_model=None, crop=None):
+        env = os.environ.get
+        self.min_margin = float(min_margin if min_margin is not None else env('ADAPTIVE_MIN_MARGIN', 0.2))
+        self.max_entropy = float(max_entropy if max_entropy is not None else env('ADAPTIVE_MAX_ENTROPY', 0.5))
+        self.crop = float(crop or env('ADAPTIVE_TTA_CROP', 0.85))
+        # Path of a bigger .tflite model for the last tier, loaded on first use
+        self.large_model = large_model or env('ADAPTIVE_LARGE_MODEL') or None
+        self._large = None
+        self._lock = threading.Lock()
+
+    def uncertain(self, probs):
+        return top_margin(probs) < self.min_margin or normalized_entropy(probs) > self.max_entropy
+
+    def large(self):
+        if self._large is None and self.large_model:
+            with self._lock:
+                if self._large is None:
+                    from inference import TomatoDiseasePredictor
+                    self._large = TomatoDiseasePredictor(self.large_model)
+        return self._large
+
+    def predict(self, model, image, with_embedding=False):
+        """
+        Classify a decoded RGB image with model (a predictor). Returns (result, tier), or
+        (result, embedding, tier) when with_embedding is set; the embedding always comes from
+        the first pass of model, so it matches the other embeddings of that model version.
+        """
+        base = model.preprocess(image)
+        result, embedding = model.predict(base, with_embedding=True)
+        result, tier = self.escalate(model, image, base, result)
+        if with_embedding:
+            return result, embedding, tier
+        return result, tier
+
+    def escalate(self, model, image, base, result):
+        """Returns (result, tier) for a first-pass result of model on image (base is its model input)"""
+        if not self.uncertain(result[2]):
+            return result, SINGLE
+        views = tta_views(image, base, self.crop).astype(np.float32)
+        probs = np.vstack([result[2][None], model.predict_batch(views)]).mean(axis=0)
+        predicted_class = int(np.argmax(probs))
+        result, tier = (predicted_class, float(probs[predicted_class]), probs), TTA
+        large = self.large() if self.uncertain(probs) else None
+        if large is not None:
+            result, tier = large.predict(image), LARGE
+        return result, tier
+
+
+def predict_images(model, images, adaptive=None):
+    """
+    Classify decoded RGB images in one batched first pass, escalating the uncertain ones like
+    the web app does when adaptive is set. Returns one (result, tier) pair per image.
+    """
+    bases = [model.preprocess(image) for image in images]
+    pairs = []
+    for image, base, probs in zip(images, bases, model.predict_batch(np.stack(bases))):
+        predicted_class = int(np.argmax(probs))
+        result = (predicted_class, float(probs[predicted_class]), probs)
+        pairs.append(adaptive.escalate(model, image, base, result) if adaptive is not None else (result, SINGLE))
+    return pairs
+
+
+def report(model, samples, adaptive, min_confidence=0.3):
+    """
+    Compare single-pass and adaptive inference on labeled images: how many images each tier
+    answered, its accuracy, and how many of the uploads rejected for low confidence it rescued
+    """
+    rows = {tier: {'images': 0, 'correct': 0, 'single_correct': 0, 'rescued': 0} for tier in TIERS}
+    single_correct = adaptive_correct = single_rejected = adaptive_rejected = invokes = inputs = 0
+    for path, label in samples:
+        image = load_image(path)
+        single = model.predict(image)
+        result, tier = adaptive.predict(model, image)
+        invokes += TIER_COST[tier][0]
+        inputs += TIER_COST[tier][1]
+        row = rows[tier]
+        row['images'] += 1
+        row['correct'] += int(result[0] == label)
+        row['single_correct'] += int(single[0] == label)
+        accepted = result[1] >= min_confidence
+        if single[1] < min_confidence:
+            single_rejected += 1
+            row['rescued'] += int(accepted and result[0] == label)
+        else:
+            single_correct += int(single[0] == label)
+        if accepted:
+            adaptive_correct += int(result[0] == label)
+        else:
+            adaptive_rejected += 1
+
+    total = len(samples)
+    for row in rows.values():
+        count = row['images']
+        row['share'] = count / total
+        row['accuracy'] = row.pop('correct') / count if count else None
+        row['single_pass_accuracy'] = row.pop('single_correct') / count if count else None
+    return {
+        'images': total,
+        'min_margin': adaptive.min_margin,
+        'max_entropy': adaptive.max_entropy,
+        'tiers': rows,
+        'single_pass': {'accepted_accuracy': single_correct / total, 'rejected': single_rejected},
+        'adaptive': {'accepted_accuracy': adaptive_correct / total, 'rejected': adaptive_rejected,
+                     'invokes_per_image': invokes / total, 'inputs_per_image': inputs / total},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TomatoHealth adaptive inference')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    report_parser = subparsers.add_parser('report', help='Tier distribution and accuracy per tier')
+    report_parser.add_argument('directory', help='Folder with one sub-folder of images per class')
+    report_parser.add_argument('--limit', type=int, help='Evaluate at most this many images')
+    report_parser.add_argument('--min-confidence', type=float, default=0.3)
+    report_parser.add_argument('--output', help='Also write the results as JSON')
+    args = parser.parse_args()
+
+    from registry import ModelRegistry, labeled_images
+    registry = ModelRegistry()
+    if not registry.load():
+        raise SystemExit(f"Model file not found: {registry.path(registry.active_name())}")
+    samples = labeled_images(args.directory)
+    if args.limit:
+        # Take every n-th image so a subset still covers every class
+        samples = samples[::max(1, len(samples) // args.limit)][:args.limit]
+    if not samples:
+        raise SystemExit(f"No labeled images in {args.directory}")
+
+    results = report(registry.current(), samples, AdaptiveInference(), args.min_confidence)
+    print(f"{'tier':<8} {'images':>7} {'share':>7} {'accuracy':>9} {'1-pass acc':>11} {'rescued':>8}")
+    for tier, row in results['tiers'].items():
+        accuracy = f"{row['accuracy']:.3f}" if row['accuracy'] is not None else '-'
+        single = f"{row['single_pass_accuracy']:.3f}" if row['single_pass_accuracy'] is not None else '-'
+        print(f"{tier:<8} {row['images']:7d} {row['share']:7.1%} {accuracy:>9} {single:>11} {row['rescued']:8d}")
+    single, adaptive = results['single_pass'], results['adaptive']
+    print(f"single pass: {single['accepted_accuracy']:.3f} correct and accepted, {single['rejected']} rejected")
+    print(f"adaptive:    {adaptive['accepted_accuracy']:.3f} correct and accepted, {adaptive['rejected']} rejected, "
+          f"{adaptive['invokes_per_image']:.2f} invokes and {adaptive['inputs_per_image']:.2f} model inputs per image")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,143 @@
 import os
+import cProfile
+import random
 import secrets
-from datetime import datetime
-from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import RequestEntityTooLarge
+from flask import Flask, Request, Response, abort, g, render_template, send_file, request, redirect, url_for, flash, session, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, case, event, func, inspect, or_, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-import tensorflow as tf
 import numpy as np
-from PIL import Image
 import io
+import math
+import csv
+import json
+import zipfile
 import base64
-import cv2
+import click
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+from derivatives import MIMETYPE, DerivativeStore, content_filename, is_content_addressed
+from adaptive import SINGLE as SINGLE_TIER, AdaptiveInference
+from embeddings import EmbeddingStores
+from daemon import RemotePredictor
+from cache import DatabaseCacheStore, PredictionCache, TTLCache, content_key, perceptual_key
+from imaging import decode_image
+from inference import DISEASE_CLASSES, BatchTimeout
+from jobs import JobQueue
+from passwords import PasswordHasher, PasswordHasherBusy
+from registry import ModelRegistry
+from scanning import BurstSource, FrameScanner, VideoSource, is_video
+from scheduler import BULK, INTERACTIVE, FairScheduler, RateLimited, SchedulerBusy
+from storage import storage_from_env
+from tiling import WORKING_RESOLUTION, predict_tiled
+from validation import LOW_CONFIDENCE_MESSAGE, MIN_CONFIDENCE, NON_PLANT_MESSAGE, Sample, default_cascade
+from writebehind import WriteBehindBuffer
+from metrics import INFERENCE_TIERS, REGISTRY, REJECTIONS, REQUEST_SECONDS, REQUESTS, STAGE_SECONDS
+
+class UploadRequest(Request):
+    """Batch API requests carry many images, so they get their own body size limit"""
+    @property
+    def max_content_length(self):
+        return upload_limit(self.path)
 
 # Initialize Flask app
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secrets.token_hex(16))
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///tomato_disease.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {}
+if app.config['SQLALCHEMY_DATABASE_URI'] not in ('sqlite://', 'sqlite:///:memory:'):
+    # Connections kept open per process; raise for Postgres when running many threads per worker
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(
+        pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        pool_timeout=float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        pool_pre_ping=True
+    )
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    # Wait for the write lock instead of failing with "database is locked"
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {
+        'timeout': float(os.environ.get('SQLITE_BUSY_TIMEOUT', 30))
+    }
+# Users allowed to export every user's predictions (comma-separated usernames)
+app.config['ADMIN_USERNAMES'] = {name.strip() for name in os.environ.get('ADMIN_USERNAMES', '').split(',') if name.strip()}
+# Prediction rows are queued and committed in batches by a background thread
+app.config['WRITE_BEHIND'] = os.environ.get('WRITE_BEHIND', '0') == '1'
+# Flat upload folder of older releases; still read until `python storage.py migrate` has moved it
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
+app.config['DERIVATIVE_FOLDER'] = os.environ.get('DERIVATIVE_FOLDER', os.path.join(app.instance_path, 'derivatives'))
+app.config['EMBEDDING_FOLDER'] = os.environ.get('EMBEDDING_FOLDER', os.path.join(app.instance_path, 'embeddings'))
+app.config['SIMILAR_CASES'] = int(os.environ.get('SIMILAR_CASES', 4))
+# 'user' compares with the user's own history, 'all' with every user's predictions
+app.config['SIMILAR_CASES_SCOPE'] = os.environ.get('SIMILAR_CASES_SCOPE', 'user')
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # 5MB max file size
+app.config['MAX_BATCH_CONTENT_LENGTH'] = int(os.environ.get('MAX_BATCH_CONTENT_LENGTH', 100 * 1024 * 1024))
+app.config['MAX_BATCH_FILES'] = int(os.environ.get('MAX_BATCH_FILES', 200))
+# Scouting videos and bursts of frames
+app.config['MAX_SCAN_CONTENT_LENGTH'] = int(os.environ.get('MAX_SCAN_CONTENT_LENGTH', 500 * 1024 * 1024))
+# Inference requests are turned away with 503 once this many images wait for the model
+app.config['INFERENCE_MAX_QUEUE'] = int(os.environ.get('INFERENCE_MAX_QUEUE', 64))
+
+def upload_limit(path):
+    """Largest request body accepted for a URL path"""
+    if path.startswith('/api/v1/predict/batch'):
+        return app.config['MAX_BATCH_CONTENT_LENGTH']
+    if path.startswith('/api/v1/scan'):
+        return app.config['MAX_SCAN_CONTENT_LENGTH']
+    return app.config['MAX_CONTENT_LENGTH']
+app.config['ASYNC_PREDICTIONS'] = os.environ.get('ASYNC_PREDICTIONS', '0') == '1'
+app.config['JOB_QUEUE_PATH'] = os.environ.get('JOB_QUEUE_PATH', os.path.join(app.instance_path, 'prediction_jobs.db'))
+# Per-user token buckets shared by the worker processes of this host (empty: per process)
+app.config['RATE_LIMIT_PATH'] = os.environ.get('RATE_LIMIT_PATH', os.path.join(app.instance_path, 'rate_limits.db'))
+
+# Ensure the instance directory exists
+os.makedirs(app.instance_path, exist_ok=True)
+
+# Uploads are written to disk in the background, off the request path
+upload_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='upload-writer')
+
+# Originals of uploads under hash-sharded keys, locally or in an object store (STORAGE_BACKEND);
+# old ones are compacted into pack files by `python storage.py compact`
+upload_store = storage_from_env(app.instance_path, legacy_folder=app.config['UPLOAD_FOLDER'])
+
+# Thumbnails of uploads for the history and dashboard pages
+derivative_store = DerivativeStore(upload_store.get, app.config['DERIVATIVE_FOLDER'])
+
+# Penultimate-layer embeddings of past predictions, for "similar past cases"
+embedding_stores = EmbeddingStores(app.config['EMBEDDING_FOLDER'])
+
+# Durable queue for asynchronous predictions, drained by `python jobs.py worker`
+job_queue = JobQueue(app.config['JOB_QUEUE_PATH'])
 
-# Ensure upload directory exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# Images of a batch API request are analyzed concurrently so they share batched invokes
+batch_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('BATCH_MAX_SIZE', 8)),
+                                    thread_name_prefix='batch-api')
+
+@event.listens_for(Engine, 'connect')
+def configure_sqlite(dbapi_connection, connection_record):
+    """
+    WAL lets readers proceed while a write is in progress, and synchronous=NORMAL
+    only fsyncs at checkpoints instead of on every commit
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f"PRAGMA synchronous={os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')}")
+        cursor.close()
 
 # Initialize extensions
 db = SQLAlchemy(app)
@@ -31,20 +146,6 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Please log in to access this page.'
 
-# Disease classes
-DISEASE_CLASSES = [
-    'Bacterial spot',
-    'Early blight', 
-    'Late blight',
-    'Leaf Mold',
-    'Septoria leaf spot',
-    'Spider mites Two-spotted spider mite',
-    'Target Spot',
-    'Yellow Leaf Curl Virus',
-    'Mosaic virus',
-    'Healthy'
-]
-
 # Disease treatment recommendations
 DISEASE_TREATMENTS = {
     'Bacterial spot': 'Remove affected leaves and apply copper-based fungicides. Improve air circulation.',
@@ -59,20 +160,43 @@ DISEASE_TREATMENTS = {
     'Healthy': 'Your tomato plant looks healthy! Continue with proper care and monitoring.'
 }
 
+# Password hashing runs in a bounded pool; PASSWORD_HASH_METHOD sets the scheme and cost
+password_hasher = PasswordHasher()
+
 # User model
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(120), nullable=False)
+    # scrypt hashes are longer than pbkdf2 ones
+    password_hash = db.Column(db.String(256), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Usage counters, updated in batches by the usage writer
+    images_admitted = db.Column(db.Integer, default=0)
+    requests_rate_limited = db.Column(db.Integer, default=0)
+    requests_shed = db.Column(db.Integer, default=0)
+    last_request_at = db.Column(db.DateTime)
     predictions = db.relationship('Prediction', backref='user', lazy=True)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Verify a password, upgrading the stored hash if it uses another scheme or cost"""
+        valid, new_hash = password_hasher.verify(self.password_hash, password)
+        if new_hash:
+            self.password_hash = new_hash
+        return valid
+
+# The logged-in user of a request, cached between requests
+class SessionUser(UserMixin):
+    """A snapshot of a User's identity, detached from the database session so it can be cached"""
+    
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.email = user.email
+        self.created_at = user.created_at
 
 # Prediction model
 class Prediction(db.Model):
@@ -82,146 +206,771 @@ class Prediction(db.Model):
     prediction = db.Column(db.String(120), nullable=False)
     confidence = db.Column(db.Float, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # Version (content hash) of the model that produced the prediction
+    model_version = db.Column(db.String(32))
+    # What answered it: single, tta or large (adaptive inference), cache or tiled
+    tier = db.Column(db.String(16))
 
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Serves the per-user history listing newest first without a sort; the second index
+    # serves date-range exports across all users
+    __table_args__ = (db.Index('ix_prediction_user_timestamp', 'user_id', 'timestamp', 'id'),
+                      db.Index('ix_prediction_timestamp', 'timestamp', 'id'))
 
-def is_plant_image(image_path):
+# Per-user summary, kept up to date on every Prediction insert
+class UserStats(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    total_predictions = db.Column(db.Integer, nullable=False, default=0)
+    confidence_sum = db.Column(db.Float, nullable=False, default=0.0)
+    last_prediction_at = db.Column(db.DateTime)
+
+# Per-user prediction count for each disease class
+class UserDiseaseStats(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    disease = db.Column(db.String(120), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+# Persistent tier of the prediction cache
+class CachedPrediction(db.Model):
+    key = db.Column(db.String(128), primary_key=True)
+    probabilities = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+def increment_counters(connection, table, keys, counters, latest=None):
+    """
+    Add counters to the row of table identified by keys, creating the row if needed.
+    Columns in latest only move forward (timestamps). Runs as a single upsert where supported.
     """
-    Basic plant detection using color analysis and edge detection.
-    This is a simple heuristic - for production, you'd want a dedicated plant detection model.
+    latest = latest or {}
+    values = {**keys, **counters, **latest}
+    dialect = connection.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = sqlite_insert if dialect == 'sqlite' else postgresql_insert
+        stmt = insert(table).values(**values)
+        updates = {name: table.c[name] + stmt.excluded[name] for name in counters}
+        for name in latest:
+            column, new = table.c[name], stmt.excluded[name]
+            updates[name] = case((or_(column.is_(None), column < new), new), else_=column)
+        connection.execute(stmt.on_conflict_do_update(index_elements=list(keys), set_=updates))
+        return
+
+    updates = {name: table.c[name] + value for name, value in counters.items()}
+    for name, value in latest.items():
+        column = table.c[name]
+        updates[name] = case((or_(column.is_(None), column < value), value), else_=column)
+    where = and_(*(table.c[name] == value for name, value in keys.items()))
+    if connection.execute(table.update().where(where).values(**updates)).rowcount == 0:
+        connection.execute(table.insert().values(**values))
+
+@event.listens_for(Session, 'before_flush')
+def reset_prediction_stats(session, flush_context, instances):
+    session.info['new_predictions'] = []
+
+@event.listens_for(Prediction, 'after_insert')
+def collect_prediction_stats(mapper, connection, target):
+    object_session(target).info['new_predictions'].append(target)
+
+@event.listens_for(Session, 'after_flush')
+def record_prediction_stats(session, flush_context):
     """
+    Fold the predictions inserted by a flush into their users' summaries, in the same
+    transaction; a batch of rows costs one upsert per user and disease, not per row
+    """
+    predictions = session.info.pop('new_predictions', None)
+    if not predictions:
+        return
+    users, diseases = {}, {}
+    for target in predictions:
+        count, confidence_sum, latest = users.get(target.user_id, (0, 0.0, None))
+        timestamp = target.timestamp or datetime.utcnow()
+        users[target.user_id] = (count + 1, confidence_sum + target.confidence,
+                                 timestamp if latest is None else max(latest, timestamp))
+        diseases[target.user_id, target.prediction] = diseases.get((target.user_id, target.prediction), 0) + 1
+    
+    connection = session.connection()
+    for user_id, (count, confidence_sum, latest) in users.items():
+        increment_counters(connection, UserStats.__table__, {'user_id': user_id},
+                           {'total_predictions': count, 'confidence_sum': confidence_sum},
+                           latest={'last_prediction_at': latest})
+    for (user_id, disease), count in diseases.items():
+        increment_counters(connection, UserDiseaseStats.__table__,
+                           {'user_id': user_id, 'disease': disease}, {'count': count})
+
+def user_summary(user_id):
+    """Prediction statistics over a user's whole history, read from the summary tables"""
+    stats = db.session.get(UserStats, user_id)
+    by_disease = dict(db.session.query(UserDiseaseStats.disease, UserDiseaseStats.count)
+                      .filter_by(user_id=user_id).all())
+    total = stats.total_predictions if stats else 0
+    healthy = by_disease.get('Healthy', 0)
+    return {
+        'total': total,
+        'healthy': healthy,
+        'diseased': total - healthy,
+        'average_confidence': stats.confidence_sum / total if total else 0.0,
+        'last_prediction_at': stats.last_prediction_at if stats else None,
+        'by_disease': by_disease,
+    }
+
+def encode_cursor(prediction):
+    return f"{prediction.timestamp.isoformat()}_{prediction.id}"
+
+def decode_cursor(cursor):
+    """Return (timestamp, id) from a history cursor, or None if it is malformed"""
     try:
-        # Read image
-        image = cv2.imread(image_path)
-        if image is None:
-            return False
-        
-        # Convert to different color spaces
-        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-        lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
-        
-        # Define green color range (plants are typically green)
-        lower_green = np.array([35, 40, 40])
-        upper_green = np.array([85, 255, 255])
-        
-        # Create mask for green regions
-        green_mask = cv2.inRange(hsv, lower_green, upper_green)
-        
-        # Calculate percentage of green pixels
-        total_pixels = image.shape[0] * image.shape[1]
-        green_pixels = cv2.countNonZero(green_mask)
-        green_percentage = (green_pixels / total_pixels) * 100
-        
-        # Edge detection to find leaf-like structures
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        edges = cv2.Canny(gray, 50, 150)
-        
-        # Calculate edge density
-        edge_pixels = cv2.countNonZero(edges)
-        edge_percentage = (edge_pixels / total_pixels) * 100
-        
-        # Simple heuristic: if there's significant green color and some edges, it might be a plant
-        is_likely_plant = green_percentage > 15 and edge_percentage > 2
-        
-        # Additional check: look for organic shapes (leaves typically have rounded edges)
-        # This is a simplified check - in reality you'd want more sophisticated shape analysis
-        
-        return is_likely_plant
-        
-    except Exception as e:
-        print(f"Error in plant detection: {e}")
-        return False
+        timestamp, prediction_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(timestamp), int(prediction_id)
+    except (AttributeError, ValueError):
+        return None
 
-def validate_image_content(image_path):
+def history_page(user_id, before=None, after=None, per_page=10):
+    """
+    One page of a user's predictions, newest first, using keyset pagination on (timestamp, id).
+    before/after are cursors of the last/first row of the neighbouring page, so every page
+    is an index range scan whatever its depth.
+    """
+    query = Prediction.query.filter_by(user_id=user_id)
+    newer = after is not None and before is None
+    cursor = decode_cursor(after if newer else before)
+    if cursor:
+        timestamp, prediction_id = cursor
+        if newer:
+            query = query.filter(or_(Prediction.timestamp > timestamp,
+                                     and_(Prediction.timestamp == timestamp, Prediction.id > prediction_id)))
+        else:
+            query = query.filter(or_(Prediction.timestamp < timestamp,
+                                     and_(Prediction.timestamp == timestamp, Prediction.id < prediction_id)))
+
+    if newer:
+        rows = query.order_by(Prediction.timestamp.asc(), Prediction.id.asc()).limit(per_page + 1).all()
+        items = list(reversed(rows[:per_page]))
+        has_newer, has_older = len(rows) > per_page, cursor is not None
+    else:
+        rows = query.order_by(Prediction.timestamp.desc(), Prediction.id.desc()).limit(per_page + 1).all()
+        items = rows[:per_page]
+        has_newer, has_older = cursor is not None, len(rows) > per_page
+
+    return SimpleNamespace(
+        items=items,
+        has_newer=has_newer and bool(items),
+        has_older=has_older and bool(items),
+        newer_cursor=encode_cursor(items[0]) if items else None,
+        older_cursor=encode_cursor(items[-1]) if items else None,
+    )
+
+EXPORT_COLUMNS = ('id', 'timestamp', 'prediction', 'confidence', 'model_version', 'image_filename')
+
+def iter_predictions(user_id=None, start=None, end=None, diseases=None, batch_size=1000):
+    """
+    Yield predictions as dicts, oldest first, optionally limited to one user, to the time range
+    [start, end) and to some diseases. Rows come from a streaming (server-side where supported)
+    cursor batch_size at a time and are not kept in the session, so memory use does not grow
+    with the size of the history. Rows of every user also carry user_id and username.
+    """
+    columns = [getattr(Prediction, name) for name in EXPORT_COLUMNS]
+    if user_id is None:
+        query = select(*columns, Prediction.user_id, User.username).join(User, User.id == Prediction.user_id)
+    else:
+        query = select(*columns).where(Prediction.user_id == user_id)
+    if start is not None:
+        query = query.where(Prediction.timestamp >= start)
+    if end is not None:
+        query = query.where(Prediction.timestamp < end)
+    if diseases:
+        query = query.where(Prediction.prediction.in_(diseases))
+    # Index order: (user_id, timestamp, id) for one user, (timestamp, id) for everyone
+    query = query.order_by(Prediction.timestamp, Prediction.id).execution_options(yield_per=batch_size)
+    for row in db.session.execute(query):
+        yield row._asdict()
+
+def parse_export_date(value, end=False):
+    """
+    Parse a YYYY-MM-DD date or ISO datetime from a query string. A bare end date includes the
+    whole day. Returns None when value is empty; raises ValueError when it is malformed.
+    """
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if end and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+def format_export(rows, export_format):
+    """Encode rows as CSV or NDJSON, a few hundred rows per chunk"""
+    buffer = io.StringIO()
+    writer = None
+    for count, row in enumerate(rows, 1):
+        row['timestamp'] = row['timestamp'].isoformat() if row['timestamp'] else None
+        if export_format == 'csv':
+            if writer is None:
+                writer = csv.DictWriter(buffer, fieldnames=list(row))
+                writer.writeheader()
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(row) + '\n')
+        if count % 500 == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if export_format == 'csv' and writer is None:
+        # Header only, so an empty export is still a valid CSV file
+        csv.writer(buffer).writerow(EXPORT_COLUMNS)
+    yield buffer.getvalue()
+
+# Identities of recently active users, so authenticated requests skip the user query
+user_cache = TTLCache(max_entries=int(os.environ.get('USER_CACHE_SIZE', 1024)),
+                      ttl=float(os.environ.get('USER_CACHE_TTL', 60)))
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, target):
+    # Other worker processes pick up the change when their entry expires
+    user_cache.invalidate(target.id)
+
+@login_manager.user_loader
+def load_user(user_id):
+    user_id = int(user_id)
+    user = user_cache.get(user_id)
+    if user is None:
+        record = db.session.get(User, user_id)
+        if record is None:
+            return None
+        user = SessionUser(record)
+        user_cache.put(user_id, user)
+    return user
+
+# File size, dimensions, green ratio, exposure, blur and edge density, cheapest first
+validation_cascade = default_cascade()
+
+def validate_image_content(image=None, data=None):
     """
     Validate that the image contains plant material suitable for disease analysis.
+    Accepts an image path, an RGB array from decode_image, or the raw upload bytes.
     Returns (is_valid, message)
     """
     try:
-        # Check if image is a plant
-        if not is_plant_image(image_path):
-            return False, "The uploaded image doesn't appear to contain plant material. Please upload a clear photo of a tomato leaf or plant."
-        
-        # Additional checks can be added here
-        # - Check image quality (blur, lighting)
-        # - Check if the plant part is clearly visible
-        # - Check minimum size requirements
-        
-        return True, "Image validation passed."
+        if isinstance(image, str):
+            with open(image, 'rb') as f:
+                image, data = None, f.read()
+        is_valid, message, _ = validation_cascade.run(Sample(data=data, image=image))
+        return is_valid, message
         
     except Exception as e:
         return False, f"Error validating image: {str(e)}"
 
-# Load TensorFlow Lite model
-class TomatoDiseasePredictor:
-    def __init__(self, model_path):
-        self.interpreter = tf.lite.Interpreter(model_path=model_path)
-        self.interpreter.allocate_tensors()
-        self.input_details = self.interpreter.get_input_details()
-        self.output_details = self.interpreter.get_output_details()
-    
-    def predict(self, image):
-        # Preprocess image
-        if isinstance(image, str):
-            image = Image.open(image)
-        elif hasattr(image, 'read'):
-            image = Image.open(image)
-        
-        # Convert to RGB if necessary
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Resize to model input size
-        image = image.resize((256, 256))
-        
-        # Convert to array and normalize
-        input_arr = tf.keras.preprocessing.image.img_to_array(image)
-        input_arr = np.array([input_arr])  # Add batch dimension
-        
-        # Set input tensor
-        self.interpreter.set_tensor(self.input_details[0]['index'], input_arr)
-        
-        # Run inference
-        self.interpreter.invoke()
-        
-        # Get predictions
-        predictions = self.interpreter.get_tensor(self.output_details[0]['index'])
-        
-        # Get prediction class and confidence
-        predicted_class = np.argmax(predictions[0])
-        confidence = float(predictions[0][predicted_class])
-        
-        return predicted_class, confidence, predictions[0]
-
-# Initialize the model
+# Initialize the model; `python registry.py activate <name>` hot-swaps it in every process
+model_registry = ModelRegistry()
 try:
-    model_path = os.path.join('Plant_Disease_Prediction', 'tomato_disease_model.tflite')
-    if os.path.exists(model_path):
-        predictor = TomatoDiseasePredictor(model_path)
+    if os.environ.get('INFERENCE_SOCKET'):
+        # The model runs in a separate `python daemon.py` process shared by every worker
+        predictor = RemotePredictor(os.environ['INFERENCE_SOCKET'])
+    elif model_registry.load():
+        predictor = model_registry
     else:
         predictor = None
-        print("Warning: Model file not found. Please ensure tomato_disease_model.tflite is in the Plant_Disease_Prediction directory.")
+        print(f"Warning: Model file not found. Please ensure {model_registry.active_name()}.tflite is in the {model_registry.directory} directory.")
 except Exception as e:
     predictor = None
     print(f"Warning: Could not load model: {e}")
 
+# Escalates uncertain images to test-time augmentation and optionally a larger model
+adaptive_inference = AdaptiveInference() if os.environ.get('ADAPTIVE_INFERENCE', '0') == '1' else None
+
+# Prediction cache for repeat uploads
+prediction_cache = None
+if int(os.environ.get('PREDICTION_CACHE_SIZE', 1024)) > 0:
+    cache_ttl = int(os.environ.get('PREDICTION_CACHE_TTL', 24 * 3600))
+    prediction_cache = PredictionCache(
+        max_entries=int(os.environ.get('PREDICTION_CACHE_SIZE', 1024)),
+        ttl=cache_ttl,
+        store=DatabaseCacheStore(app, db, CachedPrediction, cache_ttl)
+              if os.environ.get('PREDICTION_CACHE_PERSIST', '1') == '1' else None
+    )
+use_perceptual_cache = os.environ.get('PREDICTION_CACHE_PHASH', '0') == '1'
+
 # Helper functions
+def analyze_upload(data):
+    """
+    Run the cache, validation and prediction pipeline over raw upload bytes.
+    Returns ((predicted_class, confidence, all_predictions), message, model_version, embedding, tier);
+    the result is None when rejected, the embedding when served from cache or unavailable.
+    """
+    # One model version for the whole request, even if a hot-swap happens meanwhile
+    model = predictor.current()
+    
+    exact_key = None
+    if prediction_cache is not None:
+        with STAGE_SECONDS.time(stage='cache_lookup'):
+            exact_key = content_key(data, model.model_version)
+            cached = prediction_cache.get(exact_key)
+        if cached is not None:
+            return cached, "Prediction served from cache.", model.model_version, None, 'cache'
+    
+    # Validate image content before classification; the upload is only decoded
+    # once the header checks pass, and validation and inference share the buffer
+    sample = Sample(data=data)
+    with STAGE_SECONDS.time(stage='validate'):
+        is_valid, validation_message, _ = validation_cascade.run(sample)
+    if not is_valid:
+        return None, validation_message, model.model_version, None, None
+    image = sample.image
+    
+    visual_key = None
+    if prediction_cache is not None and use_perceptual_cache:
+        visual_key = perceptual_key(image, model.model_version)
+        cached = prediction_cache.get(visual_key)
+        if cached is not None:
+            prediction_cache.put(exact_key, cached[2])
+            return cached, "Prediction served from cache.", model.model_version, None, 'cache'
+    
+    # Make prediction; adaptive inference spends more compute only on uncertain images
+    with STAGE_SECONDS.time(stage='inference'):
+        if adaptive_inference is not None:
+            result, embedding, tier = adaptive_inference.predict(model, image, with_embedding=True)
+        else:
+            (result, embedding), tier = model.predict(image, with_embedding=True), SINGLE_TIER
+    INFERENCE_TIERS.inc(tier=tier)
+    
+    # Additional confidence threshold check
+    if result[1] < MIN_CONFIDENCE:  # Less than 30% confidence
+        REJECTIONS.inc(reason='low_confidence')
+        return None, LOW_CONFIDENCE_MESSAGE, model.model_version, None, tier
+    
+    if prediction_cache is not None:
+        prediction_cache.put(exact_key, result[2])
+        if visual_key is not None:
+            prediction_cache.put(visual_key, result[2])
+    
+    return result, "Prediction complete.", model.model_version, embedding, tier
+
+def store_embeddings(pairs):
+    """Add the embeddings of committed predictions, given as (Prediction, embedding) pairs"""
+    groups = {}
+    for prediction, embedding in pairs:
+        if embedding is not None and prediction.model_version:
+            groups.setdefault((prediction.model_version, len(embedding)), []).append((prediction, embedding))
+    for (model_version, dim), group in groups.items():
+        try:
+            with STAGE_SECONDS.time(stage='embedding_store'):
+                embedding_stores.get(model_version, dim).append_many(
+                    [prediction.id for prediction, _ in group],
+                    [prediction.user_id for prediction, _ in group],
+                    np.stack([embedding for _, embedding in group]))
+        except Exception as e:
+            app.logger.warning('Could not store embeddings: %s', e)
+
+def prediction_embedding(prediction):
+    """The stored embedding of a prediction, or of an earlier prediction of the same image"""
+    dim = predictor.embedding_size if predictor else None
+    if not dim or not prediction.model_version:
+        return None
+    store = embedding_stores.get(prediction.model_version, dim)
+    embedding = store.vector(prediction.id)
+    if embedding is None:
+        # Cached results skip the model; identical uploads share their content-addressed file
+        earlier = db.session.query(Prediction.id).filter(
+            Prediction.image_filename == prediction.image_filename,
+            Prediction.model_version == prediction.model_version
+        ).order_by(Prediction.id.desc()).limit(5)
+        for (prediction_id,) in earlier:
+            embedding = store.vector(prediction_id)
+            if embedding is not None:
+                break
+    return embedding
+
+def similar_cases(prediction, embedding=None, k=None, scope=None):
+    """
+    The k earlier predictions whose images look most like this one, as (Prediction, similarity)
+    pairs; scope 'user' searches the owner's history only, 'all' every user's.
+    """
+    k = k or app.config['SIMILAR_CASES']
+    scope = scope or app.config['SIMILAR_CASES_SCOPE']
+    if embedding is None:
+        embedding = prediction_embedding(prediction)
+    if embedding is None or not prediction.model_version:
+        return []
+    
+    store = embedding_stores.get(prediction.model_version, len(embedding))
+    with STAGE_SECONDS.time(stage='similar_search'):
+        # Over-fetch so repeat uploads of one image can be collapsed
+        hits = store.search(embedding, k * 3, user_id=prediction.user_id if scope == 'user' else None,
+                            exclude={prediction.id})
+    if not hits:
+        return []
+    rows = {row.id: row for row in Prediction.query.filter(Prediction.id.in_([i for i, _ in hits]))}
+    cases, seen = [], {prediction.image_filename}
+    for prediction_id, similarity in hits:
+        row = rows.get(prediction_id)
+        if row is None or row.image_filename in seen:
+            continue
+        seen.add(row.image_filename)
+        cases.append((row, similarity))
+        if len(cases) == k:
+            break
+    return cases
+
+def save_predictions(pairs, wait=True):
+    """
+    Persist (Prediction, embedding) pairs and index their embeddings. In write-behind mode,
+    unless wait is set, the rows are queued and get their ids when their batch is committed.
+    """
+    if prediction_writer is not None and not wait:
+        for pair in pairs:
+            prediction_writer.add(pair)
+        return
+    with STAGE_SECONDS.time(stage='db_commit'):
+        db.session.add_all([prediction for prediction, _ in pairs])
+        db.session.commit()
+    store_embeddings(pairs)
+
+def write_predictions(pairs):
+    """Commit one batch of buffered predictions in a single transaction (writer thread)"""
+    with app.app_context():
+        try:
+            with STAGE_SECONDS.time(stage='db_write_behind'):
+                db.session.add_all([prediction for prediction, _ in pairs])
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        store_embeddings(pairs)
+
+prediction_writer = None
+if app.config['WRITE_BEHIND']:
+    prediction_writer = WriteBehindBuffer(
+        write_predictions,
+        max_batch=int(os.environ.get('WRITE_BEHIND_MAX_BATCH', 64)),
+        max_latency_ms=float(os.environ.get('WRITE_BEHIND_MAX_LATENCY_MS', 200)),
+        name='prediction-writer'
+    )
+
+# Per-user token buckets and weighted fair queuing in front of the model (SCHEDULER=0 turns it off)
+inference_scheduler = (FairScheduler(buckets_path=app.config['RATE_LIMIT_PATH'] or None)
+                       if os.environ.get('SCHEDULER', '1') == '1' else None)
+
+def write_usage(events):
+    """Fold buffered (user_id, images, rate_limited, shed, at) events into the users' counters"""
+    totals = {}
+    for user_id, images, rate_limited, shed, at in events:
+        previous = totals.get(user_id, (0, 0, 0, at))
+        totals[user_id] = (previous[0] + images, previous[1] + rate_limited, previous[2] + shed, max(previous[3], at))
+    table = User.__table__
+    with app.app_context():
+        with db.engine.begin() as connection:
+            for user_id, (images, rate_limited, shed, at) in totals.items():
+                connection.execute(table.update().where(table.c.id == user_id).values(
+                    images_admitted=func.coalesce(table.c.images_admitted, 0) + images,
+                    requests_rate_limited=func.coalesce(table.c.requests_rate_limited, 0) + rate_limited,
+                    requests_shed=func.coalesce(table.c.requests_shed, 0) + shed,
+                    last_request_at=at
+                ))
+
+# One UPDATE per active user every USAGE_FLUSH_MS instead of one per request
+usage_writer = WriteBehindBuffer(write_usage, max_batch=1024,
+                                 max_latency_ms=float(os.environ.get('USAGE_FLUSH_MS', 1000)), name='usage-writer')
+
+def record_usage(user_id, images=0, rate_limited=0, shed=0):
+    usage_writer.add((user_id, images, rate_limited, shed, datetime.utcnow()))
+
+def admit_inference(user_id, images=1):
+    """Take images from the user's token bucket and count them; raises RateLimited"""
+    if inference_scheduler is not None:
+        try:
+            inference_scheduler.admit(user_id, images)
+        except RateLimited:
+            REJECTIONS.inc(reason='rate_limited')
+            record_usage(user_id, rate_limited=1)
+            raise
+    record_usage(user_id, images=images)
+
+def acquire_inference_slot(user_id, priority, cost=1):
+    """Wait for a fair-share inference slot, to be given back with release_inference_slot()"""
+    if inference_scheduler is None:
+        return
+    try:
+        inference_scheduler.acquire(user_id, priority, cost)
+    except SchedulerBusy:
+        REJECTIONS.inc(reason='busy')
+        record_usage(user_id, shed=1)
+        raise
+
+def release_inference_slot():
+    if inference_scheduler is not None:
+        inference_scheduler.release()
+
+def hold_inference_slot(user_id, priority):
+    """
+    Take a fair-share slot for the rest of the request. Decoding, validation, thumbnails and
+    rendering cost more CPU than the model, so the slot covers them too.
+    """
+    acquire_inference_slot(user_id, priority)
+    g.inference_slot = True
+
+@app.teardown_request
+def release_request_slot(exception):
+    if g.pop('inference_slot', False):
+        release_inference_slot()
+
+@contextmanager
+def inference_slot(user_id, priority, cost=1):
+    acquire_inference_slot(user_id, priority, cost)
+    try:
+        yield
+    finally:
+        release_inference_slot()
+
+def analyze_tiled(data):
+    """
+    Validate an upload and classify it tile by tile, for field photos with many leaves.
+    Returns ((predicted_class, confidence, all_predictions), message, model_version, heatmap);
+    the result is None when rejected.
+    """
+    model = predictor.current()
+    
+    # Keep enough resolution for the tiles; validation still runs on a small proxy
+    sample = Sample(data=data, max_side=WORKING_RESOLUTION)
+    with STAGE_SECONDS.time(stage='validate'):
+        is_valid, validation_message, _ = validation_cascade.run(sample)
+    if not is_valid:
+        return None, validation_message, model.model_version, None
+    
+    with STAGE_SECONDS.time(stage='tiled_inference'):
+        result, heatmap = predict_tiled(model.predict_batch, sample.image, DISEASE_CLASSES.index('Healthy'))
+    
+    if result is None:
+        REJECTIONS.inc(reason='no_plant_tiles')
+        return None, NON_PLANT_MESSAGE, model.model_version, heatmap
+    if result[1] < MIN_CONFIDENCE:
+        REJECTIONS.inc(reason='low_confidence')
+        return None, LOW_CONFIDENCE_MESSAGE, model.model_version, heatmap
+    
+    return result, "Prediction complete.", model.model_version, heatmap
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'png', 'jpg', 'jpeg'}
 
-def save_uploaded_file(file):
+def save_uploaded_file(file, data=None):
+    """
+    Save an upload under the hash of its content and return the filename.
+    Identical uploads share one file; the write happens off the request path.
+    """
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        # Add timestamp to filename to avoid conflicts
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
-        filename = timestamp + filename
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        if data is None:
+            data = file.read()
+        filename = content_filename(data, file.filename.rsplit('.', 1)[1])
+        upload_executor.submit(write_upload, filename, data)
         return filename
     return None
 
+def write_upload(filename, data):
+    try:
+        with STAGE_SECONDS.time(stage='upload_save'):
+            upload_store.put(filename, data)
+    except Exception as e:
+        print(f"Error saving uploaded file {filename}: {e}")
+        return
+    # The history pages show the thumbnail right away, so make it while the bytes are in memory
+    try:
+        with STAGE_SECONDS.time(stage='thumbnail'):
+            derivative_store.create(filename, data, 'thumb')
+    except Exception as e:
+        print(f"Error creating thumbnail for {filename}: {e}")
+
+def top_predictions(all_predictions, k=3):
+    """Return the k most likely (disease, confidence %) pairs"""
+    top_indices = np.argsort(all_predictions)[-k:][::-1]
+    return [(DISEASE_CLASSES[i], float(all_predictions[i]) * 100) for i in top_indices]
+
+def iter_batch_uploads():
+    """
+    Yield (filename, data) for every image of a batch request; data is None for images over
+    the single-upload limit. Zip archives are expanded; entries that are not images are skipped.
+    Raises RequestEntityTooLarge when the archives expand beyond the request's size limit.
+    """
+    limit = app.config['MAX_CONTENT_LENGTH']
+    # Declared sizes can lie, so the bytes actually decompressed are counted too
+    budget = upload_limit(request.path)
+    for _, file in request.files.items(multi=True):
+        if not file or not file.filename:
+            continue
+        if file.filename.lower().endswith('.zip'):
+            with zipfile.ZipFile(file.stream) as archive:
+                entries = [entry for entry in archive.infolist()
+                           if not entry.is_dir() and allowed_file(os.path.basename(entry.filename))]
+                if sum(entry.file_size for entry in entries) > budget:
+                    raise RequestEntityTooLarge('The zip archive expands beyond the upload limit')
+                for entry in entries:
+                    name = os.path.basename(entry.filename)
+                    if entry.file_size > limit:
+                        yield name, None
+                        continue
+                    with archive.open(entry) as member:
+                        data = member.read(limit + 1)
+                    if len(data) > limit:
+                        yield name, None
+                        continue
+                    budget -= len(data)
+                    if budget < 0:
+                        raise RequestEntityTooLarge('The zip archive expands beyond the upload limit')
+                    yield name, data
+        else:
+            yield file.filename, file.read()
+
+def process_prediction_job(job):
+    """
+    Validate, classify and record one queued upload (runs in a worker process).
+    Returns the job result; raises ValueError when the image is rejected.
+    """
+    if not predictor:
+        raise RuntimeError('Model not available')
+    result, message, model_version, embedding, tier = analyze_upload(job['payload'])
+    if result is None:
+        raise ValueError(message)
+    predicted_class, confidence, all_predictions = result
+    disease_name = DISEASE_CLASSES[predicted_class]
+    
+    filename = save_uploaded_file(FileStorage(filename=job['filename']), job['payload'])
+    prediction_record = Prediction(
+        user_id=job['user_id'],
+        image_filename=filename,
+        prediction=disease_name,
+        confidence=confidence * 100,
+        model_version=model_version,
+        tier=tier
+    )
+    save_predictions([(prediction_record, embedding)])
+    
+    return {
+        'prediction_id': prediction_record.id,
+        'prediction': disease_name,
+        'confidence': confidence * 100,
+        'model_version': model_version,
+        'tier': tier,
+        'treatment': DISEASE_TREATMENTS[disease_name],
+        'image_filename': filename,
+        'top_predictions': [{'disease': name, 'confidence': value}
+                            for name, value in top_predictions(all_predictions, 3)]
+    }
+
+def job_response(job):
+    return {
+        'job_id': job['id'],
+        'status': job['status'],
+        'result': job['result'],
+        'error': job['error'],
+        'status_url': url_for('job_status', job_id=job['id']),
+        'events_url': url_for('job_events', job_id=job['id'])
+    }
+
+def analyze_in_app_context(data, slot=False):
+    # slot: the caller acquired an inference slot for this image, released once it is analyzed
+    try:
+        with app.app_context():
+            return analyze_upload(data)
+    finally:
+        if slot:
+            release_inference_slot()
+
+# Request instrumentation
+profile_sample_rate = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+profile_dir = os.environ.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+
+def is_inference_request(method, path):
+    return method == 'POST' and (path == '/predict' or path.startswith(('/api/v1/predict/', '/api/v1/scan')))
+
+def inference_overloaded(method, path):
+    """True when a request would queue images for a model that is already backed up"""
+    if not is_inference_request(method, path):
+        return False
+    priority = INTERACTIVE if path == '/predict' else BULK
+    if inference_scheduler is not None and inference_scheduler.saturated(priority):
+        return True
+    if predictor is None or predictor.engine is None:
+        return False
+    return predictor.engine.stats()['queue_depth'] >= app.config['INFERENCE_MAX_QUEUE']
+
+def overload_response(status, message, retry_after=5):
+    """A 429 or 503 with Retry-After: JSON for API clients, the upload page for the web form"""
+    headers = {'Retry-After': str(max(1, math.ceil(retry_after)))}
+    if request.path.startswith('/api/'):
+        return jsonify({'error': message}), status, headers
+    flash(message, 'error')
+    return render_template('predict.html', prediction=False), status, headers
+
+def busy_response():
+    return overload_response(503, 'The server is busy right now. Please try again in a moment.')
+
+def rate_limited_response(error):
+    return overload_response(429, 'You are sending images faster than your share of the service allows. '
+                                  'Please wait a moment and try again.', error.retry_after)
+
+@app.before_request
+def shed_inference_load():
+    if inference_overloaded(request.method, request.path):
+        REJECTIONS.inc(reason='busy')
+        if current_user.is_authenticated:
+            record_usage(current_user.id, shed=1)
+        return busy_response()
+    # A user whose bucket is empty is refused before the upload is parsed
+    if (inference_scheduler is not None and is_inference_request(request.method, request.path)
+            and current_user.is_authenticated):
+        try:
+            inference_scheduler.check(current_user.id)
+        except RateLimited as e:
+            REJECTIONS.inc(reason='rate_limited')
+            record_usage(current_user.id, rate_limited=1)
+            return rate_limited_response(e)
+    return None
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    # Profile a small random sample of requests when enabled
+    if profile_sample_rate and random.random() < profile_sample_rate:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    endpoint = request.endpoint or 'unknown'
+    if started is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        os.makedirs(profile_dir, exist_ok=True)
+        path = os.path.join(profile_dir, f"{endpoint}-{datetime.utcnow().strftime('%Y%m%d_%H%M%S_%f')}.prof")
+        profiler.dump_stats(path)
+        app.logger.info('Request profile written to %s', path)
+    return response
+
+def cache_lookup_counts():
+    if prediction_cache is None:
+        return {}
+    stats = prediction_cache.stats()
+    return {('hit',): stats['hits'], ('store_hit',): stats['store_hits'], ('miss',): stats['misses']}
+
+def batching_gauges():
+    if predictor is None or predictor.engine is None:
+        return {}
+    stats = predictor.engine.stats()
+    return {('queue_depth',): stats['queue_depth'], ('timeouts',): stats['timeouts']}
+
+REGISTRY.counter('tomatohealth_cache_lookups_total', 'Prediction cache lookups by result',
+                 ('result',), callback=cache_lookup_counts)
+REGISTRY.gauge('tomatohealth_batching', 'Batching engine queue depth and timeouts',
+               ('stat',), callback=batching_gauges)
+REGISTRY.gauge('tomatohealth_write_behind', 'Buffered prediction rows pending, written and failed',
+               ('stat',), callback=lambda: {(key,): value for key, value in prediction_writer.stats().items()}
+                                           if prediction_writer is not None else {})
+REGISTRY.gauge('tomatohealth_scheduler', 'Fair-share scheduler slots in use, queued requests, admitted images and refusals',
+               ('stat',), callback=lambda: {(key,): value for key, value in inference_scheduler.stats().items()}
+                                           if inference_scheduler is not None else {})
+REGISTRY.gauge('tomatohealth_job_queue_depth', 'Asynchronous jobs waiting or running',
+               callback=lambda: {(): job_queue.depth()})
+
 # Routes
 @app.route('/')
 def index():
@@ -239,7 +988,16 @@ def login():
         password = request.form['password']
         user = User.query.filter_by(username=username).first()
         
-        if user and user.check_password(password):
+        try:
+            valid = user is not None and user.check_password(password)
+        except PasswordHasherBusy:
+            flash('Too many people are signing in right now. Please try again in a few seconds.', 'error')
+            return render_template('login.html'), 503, {'Retry-After': '5'}
+        
+        if valid:
+            # Saves a hash upgraded to the configured scheme and cost
+            if inspect(user).modified:
+                db.session.commit()
             login_user(user)
             next_page = request.args.get('next')
             flash('Login successful!', 'success')
@@ -279,7 +1037,11 @@ def register():
         
         # Create new user
         user = User(username=username, email=email)
-        user.set_password(password)
+        try:
+            user.set_password(password)
+        except PasswordHasherBusy:
+            flash('Too many people are signing up right now. Please try again in a few seconds.', 'error')
+            return render_template('register.html'), 503, {'Retry-After': '5'}
         db.session.add(user)
         db.session.commit()
         
@@ -299,13 +1061,14 @@ def logout():
 @login_required
 def dashboard():
     # Get user statistics
-    total_predictions = Prediction.query.filter_by(user_id=current_user.id).count()
+    summary = user_summary(current_user.id)
     recent_predictions = Prediction.query.filter_by(user_id=current_user.id)\
-                                        .order_by(Prediction.timestamp.desc())\
+                                        .order_by(Prediction.timestamp.desc(), Prediction.id.desc())\
                                         .limit(5).all()
     
     return render_template('dashboard.html', 
-                         total_predictions=total_predictions,
+                         total_predictions=summary['total'],
+                         summary=summary,
                          recent_predictions=recent_predictions)
 
 @app.route('/predict', methods=['GET', 'POST'])
@@ -322,62 +1085,67 @@ def predict():
             return redirect(request.url)
         
         if not allowed_file(file.filename):
+            REJECTIONS.inc(reason='invalid_type')
             flash('Invalid file type. Please upload JPG, JPEG, or PNG files.', 'error')
             return redirect(request.url)
         
+        # Field photos with several leaves are analyzed tile by tile
+        tiled = request.form.get('tiled') == '1'
+        
+        try:
+            admit_inference(current_user.id)
+        except RateLimited as e:
+            return rate_limited_response(e)
+        
+        if app.config['ASYNC_PREDICTIONS'] and not tiled:
+            # Inference runs in the worker processes; the web thread is free immediately
+            job_queue.enqueue(current_user.id, file.filename, file.read())
+            flash('Your image is being analyzed. The diagnosis will appear in your history shortly.', 'info')
+            return redirect(url_for('history'))
+        
         if not predictor:
             flash('Model not available. Please contact administrator.', 'error')
             return redirect(request.url)
         
         try:
+            # Web uploads go ahead of API traffic, and no user can take every slot
+            hold_inference_slot(current_user.id, INTERACTIVE)
+            data = file.read()
+            heatmap = embedding = None
+            if tiled:
+                result, message, model_version, heatmap = analyze_tiled(data)
+                tier = 'tiled'
+            else:
+                result, message, model_version, embedding, tier = analyze_upload(data)
+            if result is None:
+                flash(message, 'error')
+                return redirect(request.url)
+            predicted_class, confidence, all_predictions = result
+            
             # Save uploaded file
-            filename = save_uploaded_file(file)
+            filename = save_uploaded_file(file, data)
             if not filename:
                 flash('Error saving file', 'error')
                 return redirect(request.url)
             
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            
-            # Validate image content before classification
-            is_valid, validation_message = validate_image_content(file_path)
-            if not is_valid:
-                # Delete the uploaded file since it's not valid
-                try:
-                    os.remove(file_path)
-                except:
-                    pass
-                flash(validation_message, 'error')
-                return redirect(request.url)
-            
-            # Make prediction
-            predicted_class, confidence, all_predictions = predictor.predict(file_path)
-            
-            # Additional confidence threshold check
-            if confidence < 0.3:  # Less than 30% confidence
-                flash('The image quality is too low for reliable disease detection. Please upload a clearer image of a tomato leaf.', 'error')
-                try:
-                    os.remove(file_path)
-                except:
-                    pass
-                return redirect(request.url)
-            
             disease_name = DISEASE_CLASSES[predicted_class]
             treatment = DISEASE_TREATMENTS[disease_name]
             
             # Get top 3 predictions
-            top_3_indices = np.argsort(all_predictions)[-3:][::-1]
-            top_3_predictions = [(DISEASE_CLASSES[i], float(all_predictions[i]) * 100) 
-                               for i in top_3_indices]
+            top_3_predictions = top_predictions(all_predictions, 3)
             
             # Save prediction to database
             prediction_record = Prediction(
                 user_id=current_user.id,
                 image_filename=filename,
                 prediction=disease_name,
-                confidence=confidence * 100
+                confidence=confidence * 100,
+                model_version=model_version,
+                tier=tier
             )
-            db.session.add(prediction_record)
-            db.session.commit()
+            # Earlier diagnoses of similar-looking leaves (this one is not indexed yet)
+            cases = [] if tiled else similar_cases(prediction_record, embedding)
+            save_predictions([(prediction_record, embedding)], wait=False)
             
             return render_template('predict.html', 
                                  prediction=True,
@@ -385,26 +1153,574 @@ def predict():
                                  confidence=confidence * 100,
                                  treatment=treatment,
                                  image_filename=filename,
-                                 top_predictions=top_3_predictions)
+                                 top_predictions=top_3_predictions,
+                                 heatmap=heatmap,
+                                 similar_cases=cases)
+        
+        except BatchTimeout:
+            REJECTIONS.inc(reason='busy')
+            flash('The server is busy right now. Please try again in a moment.', 'error')
+            return redirect(request.url)
+        
+        except SchedulerBusy:
+            return busy_response()
         
         except Exception as e:
+            REJECTIONS.inc(reason='error')
+            app.logger.exception('Error processing image')
             flash(f'Error processing image: {str(e)}', 'error')
             return redirect(request.url)
     
     return render_template('predict.html', prediction=False)
 
+@app.route('/api/v1/predict/batch', methods=['POST'])
+@login_required
+def predict_batch_api():
+    """
+    Classify many images in one request (multipart files and/or zip archives).
+    Results are streamed back as NDJSON, one line per image as soon as it finishes.
+    """
+    if not predictor:
+        return jsonify({'error': 'Model not available'}), 503
+    
+    top_k = max(1, min(request.args.get('top_k', 3, type=int), len(DISEASE_CLASSES)))
+    try:
+        uploads = []
+        for filename, data in iter_batch_uploads():
+            uploads.append((filename, data))
+            if len(uploads) > app.config['MAX_BATCH_FILES']:
+                return jsonify({'error': f"At most {app.config['MAX_BATCH_FILES']} images per batch"}), 413
+    except zipfile.BadZipFile:
+        return jsonify({'error': 'Invalid zip archive'}), 400
+    except RequestEntityTooLarge as e:
+        return jsonify({'error': e.description}), 413
+    if not uploads:
+        return jsonify({'error': 'No image files in request'}), 400
+    
+    user_id = current_user.id
+    accepted = [data is not None and allowed_file(filename) and len(data) <= app.config['MAX_CONTENT_LENGTH']
+                for filename, data in uploads]
+    try:
+        admit_inference(user_id, sum(accepted))
+    except RateLimited as e:
+        return rate_limited_response(e)
+    
+    def generate():
+        futures = {}
+        succeeded = 0
+        records = []
+        
+        def result_line(future):
+            index = futures.pop(future)
+            filename, data = uploads[index]
+            line = {'index': index, 'filename': filename}
+            try:
+                result, message, model_version, embedding, tier = future.result()
+            except Exception as e:
+                result, message = None, f'Error processing image: {str(e)}'
+            
+            if result is None:
+                line.update(status='rejected', error=message)
+                return line
+            predicted_class, confidence, all_predictions = result
+            disease_name = DISEASE_CLASSES[predicted_class]
+            saved_filename = save_uploaded_file(FileStorage(filename=filename), data)
+            prediction_record = Prediction(
+                user_id=user_id,
+                image_filename=saved_filename,
+                prediction=disease_name,
+                confidence=confidence * 100,
+                model_version=model_version,
+                tier=tier
+            )
+            records.append((prediction_record, embedding))
+            line.update(
+                status='ok',
+                prediction=disease_name,
+                confidence=confidence * 100,
+                model_version=model_version,
+                tier=tier,
+                treatment=DISEASE_TREATMENTS[disease_name],
+                top_k=[{'disease': name, 'confidence': value}
+                       for name, value in top_predictions(all_predictions, top_k)]
+            )
+            return line
+        
+        try:
+            for index, (filename, data) in enumerate(uploads):
+                if not allowed_file(filename):
+                    yield json.dumps({'index': index, 'filename': filename, 'status': 'rejected',
+                                      'error': 'Invalid file type'}) + '\n'
+                    continue
+                if not accepted[index]:
+                    yield json.dumps({'index': index, 'filename': filename, 'status': 'rejected',
+                                      'error': 'File too large'}) + '\n'
+                    continue
+                # One slot per image, taken here so the images of other users' requests
+                # interleave with this one's instead of queuing behind it
+                try:
+                    acquire_inference_slot(user_id, BULK)
+                except SchedulerBusy:
+                    yield json.dumps({'index': index, 'filename': filename, 'status': 'rejected',
+                                      'error': 'The server is busy right now. Please try again in a moment.'}) + '\n'
+                    continue
+                futures[batch_executor.submit(analyze_in_app_context, data, True)] = index
+                # Stream the images that finished while waiting for the slot
+                for future in [future for future in futures if future.done()]:
+                    line = result_line(future)
+                    succeeded += line['status'] == 'ok'
+                    yield json.dumps(line) + '\n'
+            
+            for future in as_completed(list(futures)):
+                line = result_line(future)
+                succeeded += line['status'] == 'ok'
+                yield json.dumps(line) + '\n'
+        finally:
+            save_predictions(records, wait=False)
+        
+        yield json.dumps({'status': 'done', 'total': len(uploads), 'succeeded': succeeded}) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/v1/predict/tiled', methods=['POST'])
+@login_required
+def predict_tiled_api():
+    """Diagnose a field photo with several leaves; returns the diagnosis and a per-tile heatmap"""
+    file = request.files.get('file')
+    if not file or file.filename == '':
+        return jsonify({'error': 'No file selected'}), 400
+    if not allowed_file(file.filename):
+        return jsonify({'error': 'Invalid file type. Please upload JPG, JPEG, or PNG files.'}), 400
+    if not predictor:
+        return jsonify({'error': 'Model not available'}), 503
+    try:
+        admit_inference(current_user.id)
+    except RateLimited as e:
+        return rate_limited_response(e)
+    
+    try:
+        hold_inference_slot(current_user.id, BULK)
+        data = file.read()
+        result, message, model_version, heatmap = analyze_tiled(data)
+    except BatchTimeout:
+        REJECTIONS.inc(reason='busy')
+        return jsonify({'error': 'The server is busy right now. Please try again in a moment.'}), 503
+    except SchedulerBusy:
+        return busy_response()
+    if result is None:
+        return jsonify({'status': 'rejected', 'error': message, 'heatmap': heatmap}), 422
+    predicted_class, confidence, all_predictions = result
+    disease_name = DISEASE_CLASSES[predicted_class]
+    
+    filename = save_uploaded_file(file, data)
+    prediction_record = Prediction(
+        user_id=current_user.id,
+        image_filename=filename,
+        prediction=disease_name,
+        confidence=confidence * 100,
+        model_version=model_version,
+        tier='tiled'
+    )
+    save_predictions([(prediction_record, None)])
+    
+    for tile in heatmap['tiles']:
+        tile['prediction'] = DISEASE_CLASSES[tile.pop('class')]
+        tile['confidence'] *= 100
+    return jsonify({
+        'status': 'ok',
+        'prediction_id': prediction_record.id,
+        'prediction': disease_name,
+        'confidence': confidence * 100,
+        'treatment': DISEASE_TREATMENTS[disease_name],
+        'model_version': model_version,
+        'top_predictions': [{'disease': name, 'confidence': value}
+                            for name, value in top_predictions(all_predictions, 3)],
+        'heatmap': heatmap
+    })
+
+@app.route('/api/v1/scan', methods=['POST'])
+@login_required
+def scan_api():
+    """
+    Scan a walk along a row: one video (file) or a burst of images (multipart files and/or zip
+    archives). Returns disease counts, a timeline of segments and the throughput in frames/sec.
+    """
+    if not predictor:
+        return jsonify({'error': 'Model not available'}), 503
+    user_id = current_user.id
+    try:
+        admit_inference(user_id)
+    except RateLimited as e:
+        return rate_limited_response(e)
+    model = predictor.current()
+    
+    def predict_batch(batch):
+        # Each batch of frames queues for the model like that many uploads
+        with inference_slot(user_id, BULK, len(batch)):
+            return model.predict_batch(batch)
+    
+    scanner = FrameScanner(predict_batch, min_confidence=MIN_CONFIDENCE)
+    
+    video = next((file for _, file in request.files.items(multi=True) if file and is_video(file.filename)), None)
+    try:
+        if video is not None:
+            # OpenCV reads videos from a path; frames are then decoded as they are scanned
+            suffix = '.' + video.filename.rsplit('.', 1)[1].lower()
+            with tempfile.NamedTemporaryFile(suffix=suffix) as temporary:
+                video.save(temporary)
+                temporary.flush()
+                summary = scanner.scan(VideoSource(temporary.name))
+        else:
+            summary = scanner.scan(BurstSource((name, data) for name, data in iter_batch_uploads()
+                                               if allowed_file(name)))
+    except zipfile.BadZipFile:
+        return jsonify({'error': 'Invalid zip archive'}), 400
+    except RequestEntityTooLarge as e:
+        return jsonify({'error': e.description}), 413
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except BatchTimeout:
+        REJECTIONS.inc(reason='busy')
+        return jsonify({'error': 'The server is busy right now. Please try again in a moment.'}), 503
+    except SchedulerBusy:
+        return busy_response()
+    if not summary['frames_read']:
+        return jsonify({'error': 'No video or image frames in request'}), 400
+    
+    # The frames analyzed are only known now; they may leave the bucket in debt
+    if summary['analyzed'] > 1:
+        if inference_scheduler is not None:
+            inference_scheduler.charge(user_id, summary['analyzed'] - 1)
+        record_usage(user_id, images=summary['analyzed'] - 1)
+    
+    STAGE_SECONDS.observe(summary['seconds'], stage='scan')
+    return jsonify(dict(summary, model_version=model.model_version))
+
+@app.route('/api/v1/predictions/<int:prediction_id>/similar')
+@login_required
+def similar_predictions_api(prediction_id):
+    """Earlier predictions whose images look most like one of the user's (?scope=user|all&k=4)"""
+    prediction = db.session.get(Prediction, prediction_id)
+    if prediction is None or prediction.user_id != current_user.id:
+        return jsonify({'error': 'Prediction not found'}), 404
+    scope = request.args.get('scope', app.config['SIMILAR_CASES_SCOPE'])
+    if scope not in ('user', 'all'):
+        return jsonify({'error': "scope must be 'user' or 'all'"}), 400
+    k = max(1, min(request.args.get('k', app.config['SIMILAR_CASES'], type=int), 50))
+    
+    similar = []
+    for row, similarity in similar_cases(prediction, k=k, scope=scope):
+        item = {
+            'prediction': row.prediction,
+            'confidence': row.confidence,
+            'similarity': similarity,
+            'timestamp': row.timestamp.isoformat() if row.timestamp else None
+        }
+        # Other users' cases are anonymous: no id and no photo
+        if row.user_id == current_user.id:
+            item['prediction_id'] = row.id
+            item['image_url'] = url_for('image_derivative', size='thumb', filename=row.image_filename)
+        similar.append(item)
+    return jsonify({'prediction_id': prediction.id, 'scope': scope, 'similar': similar})
+
+@app.route('/api/v1/jobs', methods=['POST'])
+@login_required
+def create_job():
+    file = request.files.get('file')
+    if not file or file.filename == '':
+        return jsonify({'error': 'No file selected'}), 400
+    if not allowed_file(file.filename):
+        return jsonify({'error': 'Invalid file type. Please upload JPG, JPEG, or PNG files.'}), 400
+    try:
+        admit_inference(current_user.id)
+    except RateLimited as e:
+        return rate_limited_response(e)
+    
+    job_id = job_queue.enqueue(current_user.id, file.filename, file.read())
+    return jsonify(job_response(job_queue.get(job_id))), 202
+
+@app.route('/api/v1/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None or job['user_id'] != current_user.id:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_response(job))
+
+@app.route('/api/v1/jobs/<job_id>/events')
+@login_required
+def job_events(job_id):
+    """Server-sent events stream that reports status changes until the job finishes"""
+    job = job_queue.get(job_id)
+    if job is None or job['user_id'] != current_user.id:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    def generate():
+        last_status = None
+        # Each open stream holds a sync worker, so it ends soon and EventSource reconnects after `retry`
+        deadline = time.monotonic() + float(os.environ.get('JOB_EVENTS_TIMEOUT', 15))
+        yield f"retry: {int(os.environ.get('JOB_EVENTS_RETRY_MS', 1000))}\n\n"
+        while True:
+            current = job_queue.get(job_id)
+            if current is None:
+                # Purged while the client was listening
+                yield f"event: gone\ndata: {json.dumps({'job_id': job_id})}\n\n"
+                return
+            if current['status'] != last_status:
+                last_status = current['status']
+                yield f"event: status\ndata: {json.dumps(job_response(current))}\n\n"
+            if current['status'] in ('done', 'failed') or time.monotonic() > deadline:
+                return
+            time.sleep(0.5)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/images/<size>/<path:filename>')
+def image_derivative(size, filename):
+    """Serve a resized upload; content-addressed images are cached by browsers indefinitely"""
+    try:
+        path = derivative_store.get(filename, size)
+    except FileNotFoundError:
+        abort(404)
+    except Exception as e:
+        app.logger.error(f"Derivative {size} of {filename} failed: {e}")
+        abort(404)
+
+    if is_content_addressed(filename):
+        # The name is the hash of the original, so the derivative can never change
+        response = send_file(path, mimetype=MIMETYPE, etag=f"{size}-{filename}", max_age=31536000)
+        response.cache_control.immutable = True
+    else:
+        # Uploads saved by older releases are named by time; revalidate them daily
+        response = send_file(path, mimetype=MIMETYPE, max_age=86400)
+    return response
+
+@app.route('/uploads/<filename>')
+def uploaded_file(filename):
+    """Serve an original upload, loose or read out of its pack"""
+    try:
+        data = upload_store.get(filename)
+    except FileNotFoundError:
+        abort(404)
+    mimetype = 'image/png' if filename.lower().endswith('.png') else 'image/jpeg'
+    if is_content_addressed(filename):
+        response = send_file(io.BytesIO(data), mimetype=mimetype, etag=filename, max_age=31536000)
+        response.cache_control.immutable = True
+    else:
+        response = send_file(io.BytesIO(data), mimetype=mimetype, etag=False, max_age=86400)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics of this worker process"""
+    token = os.environ.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/readyz')
+def readyz():
+    """Readiness probe: 200 once the model of this worker has been loaded and warmed up"""
+    if predictor is None:
+        return jsonify({'ready': False, 'reason': 'Model not available'}), 503
+    if not predictor.is_warm:
+        predictor.start_warm_up()
+        return jsonify({'ready': False, 'reason': 'Model warming up'}), 503
+    return jsonify({
+        'ready': True,
+        'model': predictor.model_name,
+        'model_version': predictor.model_version,
+        'runtime': predictor.pool.runtime,
+        'interpreters': predictor.pool.size,
+        'load_seconds': predictor.load_seconds,
+        'warm_seconds': predictor.warm_seconds
+    })
+
+@app.route('/api/v1/cache/stats')
+@login_required
+def cache_stats():
+    if prediction_cache is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(prediction_cache.stats(), enabled=True))
+
 @app.route('/history')
 @login_required
 def history():
-    page = request.args.get('page', 1, type=int)
-    predictions = Prediction.query.filter_by(user_id=current_user.id)\
-                                 .order_by(Prediction.timestamp.desc())\
-                                 .paginate(page=page, per_page=10, error_out=False)
-    return render_template('history.html', predictions=predictions)
+    predictions = history_page(current_user.id,
+                               before=request.args.get('before'),
+                               after=request.args.get('after'))
+    return render_template('history.html', predictions=predictions, summary=user_summary(current_user.id))
+
+@app.route('/history/export')
+@login_required
+def export_history():
+    """
+    Download the prediction history as CSV (format=csv) or NDJSON (format=ndjson), filtered by
+    start/end dates and disease (repeatable). Admins may pass scope=all to export every user.
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        abort(400, description='format must be csv or ndjson')
+    try:
+        start = parse_export_date(request.args.get('start'))
+        end = parse_export_date(request.args.get('end'), end=True)
+    except ValueError:
+        abort(400, description='start and end must be dates (YYYY-MM-DD) or ISO timestamps')
+    diseases = request.args.getlist('disease')
+    unknown = set(diseases) - set(DISEASE_CLASSES)
+    if unknown:
+        abort(400, description=f"Unknown disease: {', '.join(sorted(unknown))}")
+    
+    user_id = current_user.id
+    if request.args.get('scope') == 'all':
+        if current_user.username not in app.config['ADMIN_USERNAMES']:
+            abort(403)
+        user_id = None
+    
+    rows = iter_predictions(user_id, start=start, end=end, diseases=diseases)
+    filename = f"tomatohealth-history-{datetime.utcnow().strftime('%Y%m%d')}.{export_format}"
+    return Response(stream_with_context(format_export(rows, export_format)),
+                    mimetype='text/csv' if export_format == 'csv' else 'application/x-ndjson',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+def rebuild_user_stats():
+    """Recompute the per-user summary tables from the prediction history"""
+    UserDiseaseStats.query.delete()
+    UserStats.query.delete()
+    totals = db.session.query(Prediction.user_id, func.count(Prediction.id), func.sum(Prediction.confidence),
+                              func.max(Prediction.timestamp)).group_by(Prediction.user_id).all()
+    db.session.add_all(UserStats(user_id=user_id, total_predictions=count, confidence_sum=confidence_sum or 0.0,
+                                 last_prediction_at=last_prediction_at)
+                       for user_id, count, confidence_sum, last_prediction_at in totals)
+    diseases = db.session.query(Prediction.user_id, Prediction.prediction, func.count(Prediction.id))\
+                         .group_by(Prediction.user_id, Prediction.prediction).all()
+    db.session.add_all(UserDiseaseStats(user_id=user_id, disease=disease, count=count)
+                       for user_id, disease, count in diseases)
+    db.session.commit()
+    return len(totals)
+
+@app.cli.command('backfill-stats')
+def backfill_stats():
+    """Rebuild the per-user prediction statistics (flask --app app backfill-stats)"""
+    print(f"Rebuilt statistics for {rebuild_user_stats()} users")
+
+@app.cli.command('tier-stats')
+@click.option('--days', type=int, default=30, help='Only predictions from the last N days')
+def tier_stats(days):
+    """Share and mean confidence of the predictions each inference tier answered"""
+    since = datetime.utcnow() - timedelta(days=days)
+    rows = db.session.query(Prediction.tier, func.count(Prediction.id), func.avg(Prediction.confidence))\
+                     .filter(Prediction.timestamp >= since).group_by(Prediction.tier).all()
+    total = sum(count for _, count, _ in rows) or 1
+    print(f"{'tier':<10} {'predictions':>12} {'share':>7} {'confidence':>11}")
+    for tier, count, confidence in sorted(rows, key=lambda row: -row[1]):
+        print(f"{tier or 'unknown':<10} {count:12d} {count / total:7.1%} {confidence or 0:10.1f}%")
+
+@app.cli.command('usage')
+@click.option('--top', type=int, default=20, help='Show this many users')
+def usage_command(top):
+    """Users who sent the most images, with their rate-limited and shed requests"""
+    users = User.query.filter(User.images_admitted > 0).order_by(User.images_admitted.desc()).limit(top).all()
+    print(f"{'user':<20} {'images':>10} {'limited':>8} {'shed':>6}  last request")
+    for user in users:
+        last = user.last_request_at.strftime('%Y-%m-%d %H:%M') if user.last_request_at else '-'
+        print(f"{user.username:<20} {user.images_admitted:10d} {user.requests_rate_limited or 0:8d} "
+              f"{user.requests_shed or 0:6d}  {last}")
+
+def rebuild_embeddings(backfill=False, batch_size=32):
+    """
+    Retrain the similarity index of the active model. With backfill, first embed the
+    predictions made by this model that have no embedding yet (e.g. served from cache).
+    Returns (rows indexed, predictions backfilled)
+    """
+    model = predictor.current()
+    dim = model.embedding_size
+    if not dim:
+        raise RuntimeError('The active model does not expose embeddings')
+    store = embedding_stores.get(model.model_version, dim)
+    
+    backfilled = 0
+    if backfill:
+        rows, inputs = [], []
+
+        def flush(rows, inputs):
+            _, vectors = model.predict_batch(np.stack(inputs).astype(np.float32), embeddings=True)
+            store.append_many([row.id for row in rows], [row.user_id for row in rows], vectors)
+            return len(rows)
+
+        # Keyset pages of the columns needed, so the table is never loaded at once
+        last_id = 0
+        while True:
+            page = db.session.query(Prediction.id, Prediction.user_id, Prediction.image_filename)\
+                             .filter(Prediction.model_version == model.model_version, Prediction.id > last_id)\
+                             .order_by(Prediction.id).limit(batch_size).all()
+            if not page:
+                break
+            last_id = page[-1].id
+            for prediction in page:
+                if store.vector(prediction.id) is not None:
+                    continue
+                try:
+                    data = upload_store.get(prediction.image_filename)
+                except FileNotFoundError:
+                    continue
+                rows.append(prediction)
+                inputs.append(model.preprocess(decode_image(data)))
+                if len(rows) == batch_size:
+                    backfilled += flush(rows, inputs)
+                    rows, inputs = [], []
+        if rows:
+            backfilled += flush(rows, inputs)
+    
+    return store.rebuild(), backfilled
+
+@app.cli.command('rebuild-embeddings')
+@click.option('--backfill', is_flag=True, help='Embed predictions that have no embedding yet')
+def rebuild_embeddings_command(backfill):
+    """Retrain the similar-cases index (flask --app app rebuild-embeddings [--backfill])"""
+    if not predictor:
+        raise click.ClickException('Model not available')
+    rows, backfilled = rebuild_embeddings(backfill)
+    if backfill:
+        print(f"Embedded {backfilled} earlier predictions")
+    print(f"Indexed {rows} embeddings")
+
+def add_missing_columns(model):
+    """Add nullable columns introduced after a table was created"""
+    table = model.__table__
+    existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+    # "user" is a reserved word in PostgreSQL
+    table_name = db.engine.dialect.identifier_preparer.format_table(table)
+    with db.engine.begin() as connection:
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                connection.execute(text(f'ALTER TABLE {table_name} ADD COLUMN {column.name} {column_type}'))
+
+def upgrade_schema():
+    """Bring a database created by an older release up to date"""
+    # create_all only creates missing tables, not columns or indexes added to existing ones
+    add_missing_columns(Prediction)
+    add_missing_columns(User)
+    if db.engine.dialect.name == 'postgresql':
+        # Room for scrypt hashes; SQLite does not enforce VARCHAR lengths
+        column = next(c for c in inspect(db.engine).get_columns('user') if c['name'] == 'password_hash')
+        if (getattr(column['type'], 'length', None) or 256) < 256:
+            with db.engine.begin() as connection:
+                connection.execute(text('ALTER TABLE "user" ALTER COLUMN password_hash TYPE VARCHAR(256)'))
+    for index in Prediction.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+    # The summary tables start empty on an existing database
+    if UserStats.query.first() is None and Prediction.query.first() is not None:
+        rebuild_user_stats()
 
 # Initialize database
 with app.app_context():
     db.create_all()
+    upgrade_schema()
 
 if __name__ == '__main__':
+    if predictor:
+        predictor.start_warm_up()
     app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
\ No newline at end of file
@@ -0,0 +1,276 @@
+"""
+ASGI entry point for TomatoHealth
+Request bodies are read on the event loop into spooled temporary files, so slow uploads wait
+without holding a thread each. Only complete requests are handed to a small
+thread pool that runs the Flask app; when that pool is backed up, or the inference queue is
+full, requests are turned away with 503 and Retry-After before their body is read.
+
+Run with:  uvicorn asgi:application --workers 4
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app, inference_overloaded, predictor, upload_limit
+from metrics import REGISTRY
+
+
+def default_max_uploads():
+    """
+    Uploads one worker can receive at once: an upload holds a socket and, once its spool rolls
+    over, a file, so this is half the open-file limit, which is first raised as far as allowed
+    """
+    try:
+        import resource
+    except ImportError:
+        return 4096
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 65536 if hard == resource.RLIM_INFINITY else min(hard, 65536)
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+            soft = wanted
+        except (ValueError, OSError):
+            pass
+    if soft == resource.RLIM_INFINITY:
+        soft = 65536
+    # Leave room for the database, the model and the app's own files
+    return max(64, soft // 2 - 128)
+
+
+class AsgiAdapter:
+    """
+    Serves a WSGI app over ASGI. The body is spooled in memory up to spool_size bytes and
+    on disk beyond that; the WSGI app then runs on one of `threads` threads. At most
+    max_queue complete requests may wait for a thread and at most max_uploads bodies may
+    be spooling at once; requests over either limit, or for which busy(method, path) is
+    true, get 503 with Retry-After. busy() is the check that sheds load under a backlog;
+    max_uploads only keeps the worker from running out of file descriptors.
+    """
+
+    def __init__(self, wsgi_app, threads=None, max_queue=None, max_uploads=None, spool_size=None,
+                 retry_after=None, body_limit=None, busy=None, on_startup=None):
+        env = os.environ.get
+        self.wsgi_app = wsgi_app
+        self.threads = int(threads or env('ASGI_THREADS', 8))
+        self.max_queue = int(max_queue or env('ASGI_MAX_QUEUE', 64))
+        # Each upload holds at most spool_size bytes in memory and the rest on disk,
+        # so the open-file limit, not memory, is what bounds how many can arrive at once
+        self.max_uploads = int(max_uploads or env('ASGI_MAX_UPLOADS') or default_max_uploads())
+        self.spool_size = int(spool_size or env('ASGI_SPOOL_SIZE', 32 * 1024))
+        self.retry_after = str(retry_after or env('ASGI_RETRY_AFTER', 5))
+        self.body_limit = body_limit
+        self.busy = busy
+        self.on_startup = on_startup
+        self._executor = None
+        self._lock = threading.Lock()
+        # Requests waiting for a thread, and bodies currently being received
+        self.queued = 0
+        self.uploading = 0
+        self.rejected = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if self.on_startup is not None:
+                    self.on_startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._executor is not None:
+                    self._executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _overloaded(self, scope):
+        if self.queued >= self.max_queue:
+            return True
+        if self.uploading >= self.max_uploads and scope['method'] not in ('GET', 'HEAD'):
+            return True
+        return self.busy is not None and self.busy(scope['method'], scope['path'])
+
+    async def _reject(self, send, status, reason, headers=()):
+        body = reason.encode()
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'text/plain; charset=utf-8'),
+                                (b'content-length', str(len(body)).encode()),
+                                (b'connection', b'close'), *headers]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _http(self, scope, receive, send):
+        # Turn requests away before accepting an upload that would only wait in a queue
+        if self._overloaded(scope):
+            self.rejected += 1
+            await self._reject(send, 503, 'The server is busy right now. Please try again in a moment.',
+                               [(b'retry-after', self.retry_after.encode())])
+            return
+
+        limit = self.body_limit(scope['path']) if self.body_limit is not None else None
+        headers = dict(scope['headers'])
+        declared = headers.get(b'content-length')
+        if limit is not None and declared is not None and declared.isdigit() and int(declared) > limit:
+            await self._reject(send, 413, 'Request body too large')
+            return
+
+        body = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        try:
+            self.uploading += 1
+            try:
+                size = await self._receive_body(receive, body, limit)
+            finally:
+                self.uploading -= 1
+            if size is None:
+                # Client went away mid-upload
+                return
+            if size < 0:
+                await self._reject(send, 413, 'Request body too large')
+                return
+            body.seek(0)
+
+            # Conditions may have changed while the body was arriving
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                await self._reject(send, 503, 'The server is busy right now. Please try again in a moment.',
+                                   [(b'retry-after', self.retry_after.encode())])
+                return
+            environ = self._environ(scope, body, size)
+            await self._run_wsgi(environ, send)
+        finally:
+            body.close()
+
+    async def _receive_body(self, receive, body, limit):
+        # Returns the body size, None on disconnect or -1 when over the limit
+        loop = asyncio.get_running_loop()
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if limit is not None and size > limit:
+                return -1
+            if size > self.spool_size:
+                # The spool rolls over to (or already is) a file on disk; keep that I/O off the event loop
+                await loop.run_in_executor(None, body.write, chunk)
+            else:
+                body.write(chunk)
+            if not message.get('more_body', False):
+                return size
+
+    def _environ(self, scope, body, size):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'CONTENT_LENGTH': str(size),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.input_terminated': True,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'CONTENT_LENGTH':
+                key = f'HTTP_{name}'
+                environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='asgi-wsgi')
+        return self._executor
+
+    async def _run_wsgi(self, environ, send):
+        loop = asyncio.get_running_loop()
+        started = threading.Event()
+
+        def send_from_thread(message):
+            # Blocks the worker thread until the client has taken the data (flow control)
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def run():
+            with self._lock:
+                self.queued -= 1
+                started.set()
+            self._call_wsgi(environ, send_from_thread)
+
+        with self._lock:
+            self.queued += 1
+        try:
+            await loop.run_in_executor(self._get_executor(), run)
+        finally:
+            with self._lock:
+                if not started.is_set():
+                    self.queued -= 1
+
+    def _call_wsgi(self, environ, send):
+        # Runs on an executor thread; the response is iterated on the same thread because
+        # streamed Flask responses keep their request context in the generator
+        state = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            if exc_info and state.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            state['status'] = int(status.split(' ', 1)[0])
+            state['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                for name, value in response_headers]
+            return lambda data: None
+
+        def start():
+            if not state.get('sent'):
+                send({'type': 'http.response.start', 'status': state['status'],
+                      'headers': state['headers']})
+                state['sent'] = True
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    start()
+                    send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            start()
+            send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    def stats(self):
+        return {'queued': self.queued, 'uploading': self.uploading, 'rejected': self.rejected}
+
+
+def warm_up():
+    if predictor:
+        predictor.start_warm_up()
+
+
+application = AsgiAdapter(app, body_limit=upload_limit, busy=inference_overloaded, on_startup=warm_up)
+REGISTRY.gauge('tomatohealth_asgi', 'Requests waiting for a thread, uploads in progress and busy rejections',
+               ('stat',), callback=lambda: {(key,): value for key, value in application.stats().items()})
@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+"""
+TomatoHealth benchmark suite
+Times every stage of the prediction pipeline on synthetic leaf and non-leaf images,
+plus end-to-end /predict through the Flask test client at several concurrency levels.
+
+Usage:
+    python benchmark.py --output bench.json
+    python benchmark.py --save-baseline benchmark_baseline.json
+    python benchmark.py --baseline benchmark_baseline.json --tolerance 0.25
+    python benchmark.py --index-sizes 10000,100000,1000000 --skip-end-to-end
+    python benchmark.py --fairness-seconds 20 --skip-end-to-end --skip-index
+"""
+
+import argparse
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+RESOLUTIONS = {'small': (640, 480), 'medium': (1600, 1200), 'large': (4032, 3024)}
+CONCURRENCY_LEVELS = (1, 4, 8)
+
+# Isolate the benchmark from the real database, queue, cache and upload folder
+_workdir = tempfile.mkdtemp(prefix='tomatohealth-bench-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_workdir, 'bench.db')
+os.environ['JOB_QUEUE_PATH'] = os.path.join(_workdir, 'jobs.db')
+os.environ['RATE_LIMIT_PATH'] = os.path.join(_workdir, 'rate_limits.db')
+os.environ['STORAGE_BACKEND'] = 'local'
+os.environ['STORAGE_ROOT'] = os.path.join(_workdir, 'uploads')
+os.environ['STORAGE_INDEX_PATH'] = os.path.join(_workdir, 'upload_index.db')
+os.environ['PREDICTION_CACHE_SIZE'] = '0'
+
+
+def synthetic_leaf(size, seed=0):
+    """A green, vein-textured leaf shape on a soil-coloured background"""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    image = np.empty((height, width, 3), np.uint8)
+    image[:] = (96, 72, 48)
+    center = (width // 2, height // 2)
+    axes = (int(width * 0.4), int(height * 0.3))
+    cv2.ellipse(image, center, axes, 20, 0, 360, (60, 150, 50), -1)
+    for i in range(-6, 7):
+        end = (center[0] + int(axes[0] * 0.9 * np.cos(i / 4)), center[1] + int(axes[1] * 0.9 * np.sin(i / 4)))
+        cv2.line(image, center, end, (110, 190, 90), max(1, width // 400))
+    for _ in range(12):
+        spot = (int(rng.integers(center[0] - axes[0] // 2, center[0] + axes[0] // 2)),
+                int(rng.integers(center[1] - axes[1] // 2, center[1] + axes[1] // 2)))
+        cv2.circle(image, spot, max(2, width // 80), (70, 50, 30), -1)
+    noise = rng.integers(0, 24, image.shape, dtype=np.uint8)
+    return cv2.add(image, noise)
+
+
+def synthetic_non_leaf(size, seed=0):
+    """A grey, low-texture scene with a few hard-edged objects (phone, table...)"""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    gradient = np.linspace(90, 200, width, dtype=np.float32)
+    image = np.repeat(np.repeat(gradient[None, :, None], height, axis=0), 3, axis=2).astype(np.uint8)
+    for _ in range(3):
+        x, y = int(rng.integers(0, width // 2)), int(rng.integers(0, height // 2))
+        cv2.rectangle(image, (x, y), (x + width // 4, y + height // 3), (30, 30, 35), -1)
+    return image
+
+
+def encode_jpeg(image, quality=90):
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def timed(fn, repeat, warmup=2):
+    """Run fn repeatedly and return latency statistics in milliseconds"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return summarize(samples)
+
+
+def summarize(samples):
+    samples = np.asarray(samples)
+    return {
+        'n': int(samples.size),
+        'mean_ms': float(samples.mean()),
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p95_ms': float(np.percentile(samples, 95)),
+        'p99_ms': float(np.percentile(samples, 99)),
+        'max_ms': float(samples.max()),
+    }
+
+
+def bench_stages(app_module, repeat):
+    """Time each pipeline stage separately for every image kind and resolution"""
+    from imaging import decode_image, is_plant_image
+    from storage import storage_from_env
+    from validation import Sample
+
+    predictor = app_module.predictor
+    # The upload store the app writes originals to (STORAGE_* point into the work directory)
+    store = storage_from_env(_workdir)
+    saved = itertools.count()
+    results = {}
+    for kind, make in (('leaf', synthetic_leaf), ('non_leaf', synthetic_non_leaf)):
+        for label, size in RESOLUTIONS.items():
+            data = encode_jpeg(make(size))
+            image = decode_image(data)
+            key = f"{kind}/{label}"
+            stages = {
+                # A new name each time, since the store skips originals it already has
+                'upload_save': timed(lambda: store.put(f"{kind}_{label}_{next(saved)}.jpg", data), repeat),
+                'decode': timed(lambda: decode_image(data), repeat),
+                'is_plant_image': timed(lambda: is_plant_image(image), repeat),
+                'validation_cascade': timed(lambda: app_module.validation_cascade.run(Sample(data=data)), repeat),
+            }
+            if predictor is not None:
+                stages['tensor_prep'] = timed(lambda: predictor.preprocess(image), repeat)
+                input_batch = predictor.preprocess(image)[None].astype(np.float32)
+                stages['invoke'] = timed(lambda: predictor.predict_batch(input_batch), repeat)
+            results[key] = stages
+            print(f"  {key}: " + ', '.join(f"{name} {stats['p50_ms']:.2f}ms" for name, stats in stages.items()),
+                  file=sys.stderr)
+
+    if predictor is not None:
+        input_arr = predictor.preprocess(decode_image(encode_jpeg(synthetic_leaf(RESOLUTIONS['small']))))
+        batch = np.stack([input_arr] * 8).astype(np.float32)
+        results['invoke_batch8'] = {'invoke': timed(lambda: predictor.predict_batch(batch), repeat)}
+    return results
+
+
+def bench_db_insert(app_module, repeat):
+    """Time one Prediction insert + commit"""
+    app, db = app_module.app, app_module.db
+    with app.app_context():
+        user = ensure_user(app_module)
+
+        def insert():
+            db.session.add(app_module.Prediction(user_id=user.id, image_filename='bench.jpg',
+                                                 prediction='Healthy', confidence=99.0))
+            db.session.commit()
+
+        return timed(insert, repeat)
+
+
+def bench_db_writers(app_module, inserts_per_writer, levels=CONCURRENCY_LEVELS):
+    """
+    Prediction inserts per second with N writer processes (like N gunicorn workers),
+    committing every row against write-behind batches
+    """
+    from writebehind import WriteBehindBuffer
+
+    app, db = app_module.app, app_module.db
+    with app.app_context():
+        user_id = ensure_user(app_module).id
+    context = multiprocessing.get_context('fork')
+
+    def writer(write_behind, barrier):
+        with app.app_context():
+            # Pooled connections must not be shared with the parent process
+            db.engine.dispose(close=False)
+        buffer = WriteBehindBuffer(app_module.write_predictions) if write_behind else None
+        barrier.wait()
+        with app.app_context():
+            for _ in range(inserts_per_writer):
+                prediction = app_module.Prediction(user_id=user_id, image_filename='bench.jpg',
+                                                   prediction='Healthy', confidence=99.0)
+                if buffer is not None:
+                    buffer.add((prediction, None))
+                else:
+                    db.session.add(prediction)
+                    db.session.commit()
+        if buffer is not None:
+            buffer.close()
+
+    results = {}
+    for mode in ('commit_per_row', 'write_behind'):
+        results[mode] = {}
+        for level in levels:
+            barrier = context.Barrier(level + 1)
+            processes = [context.Process(target=writer, args=(mode == 'write_behind', barrier))
+                         for _ in range(level)]
+            for process in processes:
+                process.start()
+            barrier.wait()
+            started = time.perf_counter()
+            for process in processes:
+                process.join()
+            elapsed = time.perf_counter() - started
+            stats = {
+                'throughput_rps': level * inserts_per_writer / elapsed,
+                'errors': sum(1 for process in processes if process.exitcode != 0),
+            }
+            results[mode][f"writers_{level}"] = stats
+            print(f"  {mode} x{level}: {stats['throughput_rps']:.0f} inserts/s", file=sys.stderr)
+    return results
+
+
+def ensure_user(app_module, username='bench'):
+    user = app_module.User.query.filter_by(username=username).first()
+    if user is None:
+        user = app_module.User(username=username, email=f'{username}@example.com')
+        user.set_password('benchmark')
+        app_module.db.session.add(user)
+        app_module.db.session.commit()
+    return user
+
+
+def bench_end_to_end(app_module, requests_per_level):
+    """POST /predict through the Flask test client at several concurrency levels"""
+    app = app_module.app
+    with app.app_context():
+        ensure_user(app_module)
+    images = [encode_jpeg(synthetic_leaf(RESOLUTIONS['medium'], seed=i)) for i in range(16)]
+    local = threading.local()
+
+    def client():
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+            local.client.post('/login', data={'username': 'bench', 'password': 'benchmark'})
+        return local.client
+
+    def one_request(i):
+        started = time.perf_counter()
+        response = client().post('/predict', data={'file': (io.BytesIO(images[i % len(images)]), 'leaf.jpg')},
+                                 content_type='multipart/form-data')
+        return (time.perf_counter() - started) * 1000, response.status_code
+
+    results = {}
+    for level in CONCURRENCY_LEVELS:
+        with ThreadPoolExecutor(level) as executor:
+            list(executor.map(one_request, range(level)))  # log in and warm up every thread
+            started = time.perf_counter()
+            outcomes = list(executor.map(one_request, range(requests_per_level)))
+            elapsed = time.perf_counter() - started
+        stats = summarize([latency for latency, _ in outcomes])
+        stats['throughput_rps'] = requests_per_level / elapsed
+        stats['errors'] = sum(1 for _, status in outcomes if status >= 400)
+        results[f"concurrency_{level}"] = stats
+        print(f"  /predict x{level}: p50 {stats['p50_ms']:.1f}ms, "
+              f"p95 {stats['p95_ms']:.1f}ms, {stats['throughput_rps']:.1f} req/s", file=sys.stderr)
+    return results
+
+
+def bench_fairness(app_module, seconds, heavy_clients=8, light_users=4, think_time=0.5, rate=4, burst=20):
+    """
+    Load generator: light users each upload one image at a time through /predict, with a pause
+    between uploads, while a heavy user floods /predict and the batch API from many threads.
+    Reports the light users' latency alone, next to the heavy user with the requests served in
+    arrival order (no scheduler), with fair queuing, and with a per-user rate limit of rate images
+    per second (burst at once) that the light users stay under and the heavy user does not.
+    """
+    from scheduler import FairScheduler
+
+    app = app_module.app
+    light_names = [f'light{i}' for i in range(light_users)]
+    with app.app_context():
+        for name in ['heavy'] + light_names:
+            ensure_user(app_module, name)
+    images = [encode_jpeg(synthetic_leaf(RESOLUTIONS['small'], seed=i)) for i in range(16)]
+    configured = app_module.inference_scheduler
+
+    def logged_in(name):
+        client = app.test_client()
+        client.post('/login', data={'username': name, 'password': 'benchmark'})
+        return client
+
+    # The first uploads compile templates and fill caches; keep them out of every phase
+    for name in light_names:
+        logged_in(name).post('/predict', data={'file': (io.BytesIO(images[0]), 'leaf.jpg')},
+                             content_type='multipart/form-data')
+
+    def run_phase(scheduler, heavy):
+        app_module.inference_scheduler = scheduler
+        stop = threading.Event()
+        light_latencies, light_statuses, heavy_statuses = [], [], []
+        lock = threading.Lock()
+
+        def light(name, seed):
+            client = logged_in(name)
+            i = seed
+            while not stop.is_set():
+                started = time.perf_counter()
+                response = client.post('/predict', data={'file': (io.BytesIO(images[i % len(images)]), 'leaf.jpg')},
+                                       content_type='multipart/form-data')
+                with lock:
+                    light_latencies.append((time.perf_counter() - started) * 1000)
+                    light_statuses.append(response.status_code)
+                i += 1
+                stop.wait(think_time)
+
+        def flood(batch):
+            client = logged_in('heavy')
+            i = 0
+            while not stop.is_set():
+                if batch:
+                    files = [(io.BytesIO(images[(i + j) % len(images)]), f'leaf{j}.jpg') for j in range(8)]
+                    response = client.post('/api/v1/predict/batch', data={'files': files},
+                                           content_type='multipart/form-data')
+                    response.get_data()
+                else:
+                    response = client.post('/predict', data={'file': (io.BytesIO(images[i % len(images)]), 'leaf.jpg')},
+                                           content_type='multipart/form-data')
+                with lock:
+                    heavy_statuses.append(response.status_code)
+                i += 1
+                if response.status_code == 429:
+                    # Like any HTTP client library, back off as told
+                    stop.wait(float(response.headers['Retry-After']))
+
+        threads = [threading.Thread(target=light, args=(name, i)) for i, name in enumerate(light_names)]
+        if heavy:
+            threads += [threading.Thread(target=flood, args=(i % 4 == 3,)) for i in range(heavy_clients)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        stats = {'light': summarize(light_latencies)}
+        stats['light']['errors'] = sum(1 for status in light_statuses if status >= 400)
+        if heavy:
+            stats['heavy'] = {str(status): heavy_statuses.count(status) for status in sorted(set(heavy_statuses))}
+        return stats
+
+    # Fair queuing alone: a rate limit high enough that the heavy user is never refused
+    unlimited = dict(rate=1e9, burst=1e9)
+    results = {}
+    try:
+        for phase, scheduler, heavy in (('light_only', FairScheduler(**unlimited), False),
+                                        ('heavy_fifo', None, True),
+                                        ('heavy_fair', FairScheduler(**unlimited), True),
+                                        ('heavy_rate_limited', FairScheduler(rate=rate, burst=burst), True)):
+            results[phase] = run_phase(scheduler, heavy)
+            light = results[phase]['light']
+            print(f"  {phase}: light users p50 {light['p50_ms']:.0f}ms, p95 {light['p95_ms']:.0f}ms, "
+                  f"p99 {light['p99_ms']:.0f}ms; heavy user statuses {results[phase].get('heavy', {})}",
+                  file=sys.stderr)
+    finally:
+        app_module.inference_scheduler = configured
+    return results
+
+
+def bench_embedding_index(sizes, dim, queries=100, k=10):
+    """
+    Similar-cases query latency against store size: exact search, the IVF index and a
+    per-user lookup, with the share of the exact top-k neighbours the index finds
+    """
+    from embeddings import build_store
+
+    rng = np.random.default_rng(0)
+    # Embeddings of one disease cluster together, so sample around a few class centres
+    centers = rng.normal(size=(64, dim)).astype(np.float32)
+
+    def sample(count):
+        return centers[rng.integers(0, len(centers), count)] + rng.normal(scale=0.6, size=(count, dim)).astype(np.float32)
+
+    results = {}
+    for size in sizes:
+        vectors = np.concatenate([sample(min(100000, size - start)).astype(np.float16)
+                                  for start in range(0, size, 100000)])
+        store = build_store(tempfile.mkdtemp(dir=_workdir), vectors, rng.integers(0, 1000, size))
+        started = time.perf_counter()
+        store.rebuild()
+        build_seconds = time.perf_counter() - started
+
+        query_vectors = sample(queries)
+        exact, ivf, user, recalls = [], [], [], []
+        for query in query_vectors:
+            store.search(query, k)
+            started = time.perf_counter()
+            reference = store.search(query, k, exact=True)
+            exact.append((time.perf_counter() - started) * 1000)
+            started = time.perf_counter()
+            found = store.search(query, k)
+            ivf.append((time.perf_counter() - started) * 1000)
+            started = time.perf_counter()
+            store.search(query, k, user_id=int(rng.integers(0, 1000)))
+            user.append((time.perf_counter() - started) * 1000)
+            recalls.append(len({i for i, _ in reference} & {i for i, _ in found}) / k)
+
+        results[str(size)] = {
+            'build_seconds': build_seconds,
+            'exact': summarize(exact),
+            'ivf': summarize(ivf),
+            'user': summarize(user),
+            f"recall_at_{k}": float(np.mean(recalls)),
+        }
+        print(f"  {size} rows: exact {results[str(size)]['exact']['p50_ms']:.2f}ms, "
+              f"ivf {results[str(size)]['ivf']['p50_ms']:.2f}ms, user {results[str(size)]['user']['p50_ms']:.2f}ms, "
+              f"recall {np.mean(recalls):.3f}, build {build_seconds:.1f}s", file=sys.stderr)
+    return results
+
+
+def flatten(results, prefix=''):
+    """Yield (metric path, value) for every p50 latency and throughput in the results"""
+    for key, value in results.items():
+        path = f"{prefix}/{key}" if prefix else key
+        if isinstance(value, dict):
+            yield from flatten(value, path)
+        elif key in ('p50_ms', 'throughput_rps'):
+            yield path, value
+
+
+def compare(results, baseline, tolerance, min_delta_ms=0.5):
+    """
+    Return a list of regressions beyond the tolerance relative to the baseline.
+    Latency changes smaller than min_delta_ms are treated as timer noise.
+    """
+    current = dict(flatten(results))
+    regressions = []
+    for path, reference in flatten(baseline):
+        value = current.get(path)
+        if value is None or reference <= 0:
+            continue
+        if path.endswith('throughput_rps'):
+            regressed = value < reference * (1 - tolerance)
+        else:
+            regressed = value > reference * (1 + tolerance) and value - reference > min_delta_ms
+        if regressed:
+            regressions.append(f"{path}: {value:.2f} vs baseline {reference:.2f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the TomatoHealth prediction pipeline')
+    parser.add_argument('--repeat', type=int, default=20, help='Samples per stage')
+    parser.add_argument('--requests', type=int, default=32, help='Requests per concurrency level')
+    parser.add_argument('--skip-end-to-end', action='store_true')
+    parser.add_argument('--index-sizes', default='10000,100000',
+                        help='Comma-separated embedding store sizes for the similar-cases benchmark')
+    parser.add_argument('--index-dim', type=int, help="Embedding length (default: the model's, else 128)")
+    parser.add_argument('--skip-index', action='store_true')
+    parser.add_argument('--fairness-seconds', type=float, default=10, help='Duration of each fairness phase')
+    parser.add_argument('--fairness-rate', type=float, default=4, help='Images per second per user when rate limited')
+    parser.add_argument('--fairness-burst', type=float, default=20, help='Images per user at once when rate limited')
+    parser.add_argument('--skip-fairness', action='store_true')
+    parser.add_argument('--db-inserts', type=int, default=200, help='Prediction inserts per writer process')
+    parser.add_argument('--skip-db-writers', action='store_true')
+    parser.add_argument('--output', help='Write results JSON here (default: stdout)')
+    parser.add_argument('--baseline', help='Fail if results regress against this results JSON')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative regression')
+    parser.add_argument('--min-delta-ms', type=float, default=0.5, help='Ignore smaller latency changes')
+    parser.add_argument('--save-baseline', help='Write results JSON as the new baseline')
+    args = parser.parse_args()
+
+    import app as app_module
+    if app_module.predictor is not None:
+        app_module.predictor.warm_up()
+    else:
+        print('Warning: model not available, skipping tensor prep, invoke and /predict', file=sys.stderr)
+
+    print('Benchmarking pipeline stages...', file=sys.stderr)
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'runtime': app_module.predictor.pool.runtime if app_module.predictor else None,
+            'model_version': app_module.predictor.model_version if app_module.predictor else None,
+        },
+        'stages': bench_stages(app_module, args.repeat),
+    }
+    results['stages']['db_insert'] = {'insert': bench_db_insert(app_module, args.repeat)}
+    if not args.skip_db_writers:
+        print('Benchmarking concurrent database writers...', file=sys.stderr)
+        results['db_writers'] = bench_db_writers(app_module, args.db_inserts)
+    if app_module.predictor is not None and not args.skip_end_to_end:
+        print('Benchmarking end-to-end /predict...', file=sys.stderr)
+        results['end_to_end'] = bench_end_to_end(app_module, args.requests)
+    if app_module.predictor is not None and not args.skip_fairness:
+        print('Benchmarking light-user latency under a heavy user...', file=sys.stderr)
+        results['fairness'] = bench_fairness(app_module, args.fairness_seconds, rate=args.fairness_rate,
+                                            burst=args.fairness_burst)
+    if not args.skip_index:
+        print('Benchmarking the similar-cases index...', file=sys.stderr)
+        dim = args.index_dim or (app_module.predictor.embedding_size if app_module.predictor else None) or 128
+        sizes = [int(size) for size in args.index_sizes.split(',') if size]
+        results['embedding_index'] = bench_embedding_index(sizes, dim)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            f.write(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_delta_ms)
+        if regressions:
+            print('Performance regressions:', file=sys.stderr)
+            for line in regressions:
+                print(f"  {line}", file=sys.stderr)
+            sys.exit(1)
+        print('No regressions against baseline.', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""
+Prediction cache for TomatoHealth
+Content-addressed results so repeat uploads skip decoding and inference,
+plus a small TTL cache for other per-request lookups
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import cv2
+import numpy as np
+
+from writebehind import WriteBehindBuffer
+
+
+def content_key(data, model_version):
+    """Cache key for the exact upload bytes under a given model version"""
+    return f"sha256:{hashlib.sha256(data).hexdigest()}:{model_version}"
+
+
+def perceptual_hash(image, hash_size=8):
+    """64-bit difference hash of an RGB array; stable across re-encoding and resizing"""
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def perceptual_key(image, model_version):
+    """Cache key for the visual content of a decoded image under a given model version"""
+    return f"dhash:{perceptual_hash(image):016x}:{model_version}"
+
+
+class DatabaseCacheStore:
+    """
+    Persistent cache tier backed by a SQLAlchemy model with key, probabilities and created_at columns.
+    Entries are written in batches by a write-behind thread, off the request path, and the same
+    thread deletes expired rows every prune_interval seconds so the table does not grow without bound.
+    """
+
+    def __init__(self, app, db, model, ttl, max_latency_ms=200.0, prune_interval=None):
+        self.app = app
+        self.db = db
+        self.model = model
+        self.ttl = ttl
+        self.prune_interval = prune_interval if prune_interval is not None else min(ttl, 3600) if ttl else None
+        self._next_prune = 0.0
+        self.writer = WriteBehindBuffer(self.write, max_batch=256, max_latency_ms=max_latency_ms,
+                                        name='cache-writer')
+
+    def get(self, key):
+        entry = self.db.session.get(self.model, key)
+        if entry is None:
+            return None
+        if self.ttl and entry.created_at < datetime.utcnow() - timedelta(seconds=self.ttl):
+            return None
+        return np.array(json.loads(entry.probabilities), dtype=np.float32)
+
+    def put(self, key, probabilities):
+        self.writer.add((key, json.dumps([float(p) for p in probabilities]), datetime.utcnow()))
+
+    def write(self, entries):
+        """Store a batch of (key, probabilities JSON, created_at) entries in one transaction (writer thread)"""
+        with self.app.app_context():
+            try:
+                for key, probabilities, created_at in entries:
+                    self.db.session.merge(self.model(key=key, probabilities=probabilities, created_at=created_at))
+                if self.prune_interval and time.monotonic() >= self._next_prune:
+                    self._next_prune = time.monotonic() + self.prune_interval
+                    self.db.session.query(self.model).filter(
+                        self.model.created_at < datetime.utcnow() - timedelta(seconds=self.ttl)
+                    ).delete(synchronize_session=False)
+                self.db.session.commit()
+            except Exception:
+                self.db.session.rollback()
+                raise
+
+
+class PredictionCache:
+    """
+    In-process LRU of class probabilities with size and TTL eviction,
+    optionally backed by a persistent store for entries evicted or from other workers.
+    """
+
+    def __init__(self, max_entries=1024, ttl=24 * 3600, store=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = store
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return (predicted_class, confidence, probabilities) or None"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                probabilities, expires_at = entry
+                if expires_at >= now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._result(probabilities)
+                del self._entries[key]
+
+        probabilities = self.store.get(key) if self.store is not None else None
+        with self._lock:
+            if probabilities is None:
+                self.misses += 1
+                return None
+            self.store_hits += 1
+            self._insert(key, probabilities, now)
+        return self._result(probabilities)
+
+    def put(self, key, probabilities, persist=True):
+        probabilities = np.asarray(probabilities, dtype=np.float32)
+        with self._lock:
+            self._insert(key, probabilities, time.monotonic())
+        if persist and self.store is not None:
+            self.store.put(key, probabilities)
+
+    def _insert(self, key, probabilities, now):
+        self._entries[key] = (probabilities, now + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    @staticmethod
+    def _result(probabilities):
+        predicted_class = int(np.argmax(probabilities))
+        return predicted_class, float(probabilities[predicted_class]), probabilities
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.store_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'store_hits': self.store_hits,
+                'misses': self.misses,
+                'hit_ratio': (self.hits + self.store_hits) / lookups if lookups else 0.0,
+            }
+
+
+class TTLCache:
+    """Thread-safe LRU of arbitrary values that expire ttl seconds after they are stored"""
+
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at >= now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.max_entries <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+"""
+Inference daemon for TomatoHealth
+One process owns the model and its interpreters; web workers on the same host send it
+preprocessed images through shared memory and a Unix domain socket. Requests from every
+worker meet in one batching engine, and the web processes never import a TFLite runtime.
+
+Run the daemon, then point the web app at its socket:
+    python daemon.py --socket /run/tomatohealth/inference.sock
+    INFERENCE_SOCKET=/run/tomatohealth/inference.sock gunicorn -c gunicorn.conf.py app:app
+"""
+
+import argparse
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from types import SimpleNamespace
+
+import numpy as np
+
+from imaging import MODEL_INPUT_SIZE
+from inference import BatchTimeout, preprocess_image
+
+DEFAULT_SOCKET = '/tmp/tomatohealth-inference.sock'
+
+# A slot holds one float32 model input; results are written back into the request's slots
+SLOT_BYTES = MODEL_INPUT_SIZE[0] * MODEL_INPUT_SIZE[1] * 3 * 4
+
+_HEADER = struct.Struct('!I')
+
+
+def send_message(sock, message):
+    payload = json.dumps(message).encode()
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def recv_message(sock):
+    """Read one length-prefixed JSON message; returns None when the peer has closed the socket"""
+    header = _recv_exactly(sock, _HEADER.size)
+    if header is None:
+        return None
+    payload = _recv_exactly(sock, _HEADER.unpack(header)[0])
+    return None if payload is None else json.loads(payload)
+
+
+def slot_array(shm, slot, shape, dtype):
+    """A numpy view of one slot of a shared-memory segment"""
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=slot * SLOT_BYTES)
+
+
+class _Pending:
+    __slots__ = ('slots', 'done', 'response', 'abandoned')
+
+    def __init__(self):
+        self.slots = []
+        self.done = threading.Event()
+        self.response = None
+        self.abandoned = False
+
+
+class InferenceClient:
+    """
+    Connection of one web process to the inference daemon. The daemon allocates a
+    shared-memory segment of `slots` image slots for the connection; threads take free
+    slots in turn, write their inputs there and send only slot numbers over the socket.
+    Many threads share the connection, and their requests are matched to responses by id.
+    """
+
+    def __init__(self, socket_path, slots=None, timeout=None):
+        env = os.environ.get
+        self.socket_path = socket_path
+        self.slots = max(1, int(slots or env('INFERENCE_SLOTS', 32)))
+        self.timeout = float(timeout or env('BATCH_TIMEOUT', 30))
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._free = threading.Condition(self._lock)
+        self._sock = None
+        self._pid = None
+        self._shm = None
+        self._free_slots = []
+        self._pending = {}
+        self._next_id = 0
+        self.info = None
+        # Statistics
+        self.requests = 0
+        self.timeouts = 0
+
+    def _ensure_connected(self):
+        # Sockets and mappings are per process, so a forked worker opens its own connection
+        with self._lock:
+            if self._sock is not None and self._pid == os.getpid():
+                return
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+                send_message(sock, {'op': 'hello', 'slots': self.slots, 'pid': os.getpid()})
+                reply = recv_message(sock)
+                if reply is None or 'error' in reply:
+                    raise ConnectionError(f"Inference daemon refused the connection: {reply and reply['error']}")
+                shm = SharedMemory(name=reply['shm'])
+                # The daemon owns the segment; keep this process's tracker from removing it at exit
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            except BaseException:
+                sock.close()
+                raise
+            self._sock, self._pid, self._shm = sock, os.getpid(), shm
+            self._free_slots = list(range(reply['slots']))
+            self._pending = {}
+            self.info = reply['info']
+            threading.Thread(target=self._read_responses, args=(sock,), name='inference-client', daemon=True).start()
+
+    def _read_responses(self, sock):
+        try:
+            while True:
+                message = recv_message(sock)
+                if message is None:
+                    break
+                with self._lock:
+                    pending = self._pending.pop(message['id'], None)
+                    if pending is None:
+                        continue
+                    if pending.abandoned:
+                        # The caller timed out; its slots are free once the daemon is done with them
+                        self._free_slots.extend(pending.slots)
+                        self._free.notify_all()
+                        continue
+                pending.response = message
+                pending.done.set()
+        except OSError:
+            pass
+        with self._lock:
+            if self._sock is sock:
+                self._sock = None
+            pending, self._pending = self._pending, {}
+            self._free.notify_all()
+        sock.close()
+        for item in pending.values():
+            item.response = {'error': 'Lost connection to the inference daemon'}
+            item.done.set()
+
+    def _request(self, message, slots=None, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        pending = _Pending()
+        with self._lock:
+            sock = self._sock
+            if sock is None:
+                raise ConnectionError('Lost connection to the inference daemon')
+            self._next_id += 1
+            message['id'] = self._next_id
+            self._pending[message['id']] = pending
+            self.requests += 1
+        with self._send_lock:
+            send_message(sock, message)
+        if not pending.done.wait(timeout):
+            with self._lock:
+                self.timeouts += 1
+                if message['id'] in self._pending and slots:
+                    # The daemon may still write into the slots, so they are taken from the
+                    # caller and freed when its answer arrives
+                    pending.abandoned = True
+                    pending.slots = slots[:]
+                    del slots[:]
+            raise BatchTimeout('Prediction request timed out waiting for the inference daemon')
+        response = pending.response
+        if 'error' in response:
+            if response.get('timeout'):
+                raise BatchTimeout(response['error'])
+            raise RuntimeError(response['error'])
+        return response
+
+    def _acquire(self, count, timeout):
+        deadline = time.monotonic() + timeout
+        with self._free:
+            while len(self._free_slots) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise BatchTimeout('Timed out waiting for a shared-memory slot')
+                self._free.wait(remaining)
+                if self._sock is None:
+                    raise ConnectionError('Lost connection to the inference daemon')
+            slots, self._free_slots = self._free_slots[:count], self._free_slots[count:]
+            return slots, self._shm
+
+    def _release(self, slots, shm):
+        with self._free:
+            # Slots of a segment from a lost connection are not reused
+            if slots and shm is self._shm:
+                self._free_slots.extend(slots)
+                self._free.notify_all()
+
+    def get_info(self):
+        """Model name, version, embedding size and runtime details reported by the daemon"""
+        self._ensure_connected()
+        self.info = self._request({'op': 'info'})['info']
+        return self.info
+
+    def run(self, inputs, embeddings=False, timeout=None):
+        """
+        Classify a (N, H, W, 3) uint8 or float32 batch. Returns (probabilities, embeddings or None,
+        model_version); batches larger than the slot count are sent in several requests.
+        """
+        self._ensure_connected()
+        if inputs.dtype not in (np.uint8, np.float32):
+            inputs = inputs.astype(np.float32)
+        probs, vectors, model_version = [], [], None
+        for start in range(0, len(inputs), self.slots):
+            chunk = inputs[start:start + self.slots]
+            slots, shm = self._acquire(len(chunk), self.timeout if timeout is None else timeout)
+            try:
+                for slot, image in zip(slots, chunk):
+                    np.copyto(slot_array(shm, slot, image.shape, image.dtype), image)
+                response = self._request({'op': 'predict', 'slots': list(slots), 'shape': list(chunk.shape[1:]),
+                                          'dtype': chunk.dtype.name, 'embeddings': embeddings}, slots, timeout)
+                classes, dim = response['classes'], response['embedding_size']
+                for slot in slots:
+                    output = slot_array(shm, slot, (classes + dim,), np.float32)
+                    probs.append(output[:classes].copy())
+                    if embeddings and dim:
+                        vectors.append(output[classes:].copy())
+            finally:
+                self._release(slots, shm)
+            model_version = response['model_version']
+        if self.info is not None and model_version != self.info['model_version']:
+            # The daemon switched models; fetch its new name and embedding size on next use
+            self.info = None
+        return np.stack(probs), (np.stack(vectors) if vectors else None), model_version
+
+    def stats(self):
+        with self._lock:
+            return {'queue_depth': len(self._pending), 'requests': self.requests, 'timeouts': self.timeouts,
+                    'free_slots': len(self._free_slots)}
+
+
+class RemotePredictor:
+    """
+    Stands in for the model registry in a web process when the model runs in the daemon.
+    Preprocessing happens here; invokes and batching happen in the daemon.
+    """
+
+    def __init__(self, socket_path, check_interval=None):
+        if check_interval is None:
+            check_interval = float(os.environ.get('MODEL_CHECK_INTERVAL', 5))
+        self.check_interval = check_interval
+        self.engine = InferenceClient(socket_path)
+        self._next_check = 0.0
+
+    def _info(self):
+        if self.engine.info is None or time.monotonic() >= self._next_check:
+            self._next_check = time.monotonic() + self.check_interval
+            self.engine.get_info()
+        return self.engine.info
+
+    def current(self):
+        """This predictor; the model it serves is whatever the daemon has active"""
+        self._info()
+        return self
+
+    @property
+    def model_name(self):
+        return self._info()['model_name']
+
+    @property
+    def model_version(self):
+        return self._info()['model_version']
+
+    @property
+    def embedding_size(self):
+        return self._info()['embedding_size']
+
+    @property
+    def load_seconds(self):
+        return self._info()['load_seconds']
+
+    @property
+    def warm_seconds(self):
+        return self._info()['warm_seconds']
+
+    @property
+    def pool(self):
+        info = self._info()
+        return SimpleNamespace(runtime=f"daemon ({info['runtime']})", size=info['interpreters'])
+
+    @property
+    def is_warm(self):
+        """True once the daemon is reachable and its model has been warmed up"""
+        try:
+            return self._info()['is_warm']
+        except OSError:
+            return False
+
+    def start_warm_up(self):
+        # The daemon warms up its own model
+        pass
+
+    def preprocess(self, image):
+        return preprocess_image(image)
+
+    def predict_batch(self, input_batch, embeddings=False):
+        probs, vectors, _ = self.engine.run(np.asarray(input_batch), embeddings=embeddings)
+        return (probs, vectors) if embeddings else probs
+
+    def predict(self, image, with_embedding=False):
+        probs, vectors, _ = self.engine.run(self.preprocess(image)[None], embeddings=with_embedding)
+        predicted_class = int(np.argmax(probs[0]))
+        result = (predicted_class, float(probs[0][predicted_class]), probs[0])
+        if with_embedding:
+            return result, vectors[0] if vectors is not None else None
+        return result
+
+    def close(self):
+        pass
+
+
+class InferenceDaemon:
+    """
+    Serves a model registry on a Unix domain socket. Every client connection gets its own
+    shared-memory segment; single images go through the registry's batching engine, so
+    concurrent requests from all web workers share invokes.
+    """
+
+    def __init__(self, registry, socket_path, threads=None):
+        self.registry = registry
+        self.socket_path = socket_path
+        # Threads waiting on the batching engine, one per request in flight
+        self._executor = ThreadPoolExecutor(max_workers=int(threads or os.environ.get('DAEMON_THREADS', 64)),
+                                            thread_name_prefix='inference-daemon')
+        self._segments = set()
+        self._lock = threading.Lock()
+
+    def info(self):
+        model = self.registry.current()
+        return {
+            'model_name': model.model_name,
+            'model_version': model.model_version,
+            'embedding_size': model.embedding_size,
+            'runtime': model.pool.runtime,
+            'interpreters': model.pool.size,
+            'load_seconds': model.load_seconds,
+            'warm_seconds': model.warm_seconds,
+            'is_warm': model.is_warm,
+            'batching': model.engine.stats() if model.engine is not None else None,
+        }
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        # Shared-memory segments are created 0600, so only clients running as this user could map them
+        os.chmod(self.socket_path, 0o600)
+        server.listen(128)
+        print(f"Inference daemon serving {self.registry.active_name()} on {self.socket_path}")
+        try:
+            while True:
+                conn, _ = server.accept()
+                threading.Thread(target=self._serve_connection, args=(conn,), name='inference-connection',
+                                 daemon=True).start()
+        finally:
+            server.close()
+            os.unlink(self.socket_path)
+            self.close()
+
+    def close(self):
+        """Remove every shared-memory segment still open"""
+        with self._lock:
+            segments, self._segments = self._segments, set()
+        for shm in segments:
+            self._release_segment(shm)
+
+    def _release_segment(self, shm):
+        shm.unlink()
+        try:
+            shm.close()
+        except BufferError:
+            # A request still holds a view; the mapping goes away with the process
+            pass
+
+    def _serve_connection(self, conn):
+        shm = None
+        send_lock = threading.Lock()
+        try:
+            hello = recv_message(conn)
+            if hello is None or hello.get('op') != 'hello':
+                return
+            slots = max(1, min(int(hello['slots']), 1024))
+            shm = SharedMemory(create=True, size=slots * SLOT_BYTES)
+            with self._lock:
+                self._segments.add(shm)
+            send_message(conn, {'shm': shm.name, 'slots': slots, 'info': self.info()})
+            while True:
+                message = recv_message(conn)
+                if message is None:
+                    return
+                self._executor.submit(self._handle, conn, send_lock, shm, message)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+            if shm is not None:
+                with self._lock:
+                    self._segments.discard(shm)
+                self._release_segment(shm)
+
+    def _handle(self, conn, send_lock, shm, message):
+        try:
+            if message['op'] == 'info':
+                response = {'info': self.info()}
+            else:
+                response = self._predict(shm, message)
+        except BatchTimeout as e:
+            response = {'error': str(e), 'timeout': True}
+        except Exception as e:
+            response = {'error': f"Inference failed: {e}"}
+        response['id'] = message['id']
+        try:
+            with send_lock:
+                send_message(conn, response)
+        except OSError:
+            # The client is gone; its connection thread cleans up
+            pass
+
+    def _predict(self, shm, message):
+        model = self.registry.current()
+        slots, shape, dtype = message['slots'], tuple(message['shape']), np.dtype(message['dtype'])
+        inputs = [slot_array(shm, slot, shape, dtype) for slot in slots]
+        if len(inputs) == 1 and model.engine is not None:
+            # Single images from every worker are batched together by the engine
+            (_, _, probs), vector = model.engine.submit(inputs[0], with_embedding=True)
+            probs, vectors = probs[None], (None if vector is None else vector[None])
+        else:
+            probs, vectors = model.predict_batch(np.stack(inputs).astype(np.float32, copy=False), embeddings=True)
+        del inputs
+        classes = probs.shape[1]
+        dim = vectors.shape[1] if message.get('embeddings') and vectors is not None else 0
+        for i, slot in enumerate(slots):
+            output = slot_array(shm, slot, (classes + dim,), np.float32)
+            output[:classes] = probs[i]
+            if dim:
+                output[classes:] = vectors[i]
+        return {'model_version': model.model_version, 'classes': classes, 'embedding_size': dim}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TomatoHealth inference daemon')
+    parser.add_argument('--socket', default=os.environ.get('INFERENCE_SOCKET', DEFAULT_SOCKET))
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    from registry import ModelRegistry
+    registry = ModelRegistry()
+    if not registry.load():
+        sys.exit(f"Model file not found: {registry.path(registry.active_name())}")
+    registry.warm_up()
+
+    daemon = InferenceDaemon(registry, args.socket, threads=args.threads)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        daemon.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+
+if __name__ == '__main__':
+    main()
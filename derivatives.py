@@ -0,0 +1,102 @@
+"""
+Image derivatives for TomatoHealth
+Uploads are stored once under the hash of their bytes, and small thumbnails are
+generated from them at ingest (or on first request) and kept on local disk
+"""
+
+import hashlib
+import io
+import os
+import re
+import tempfile
+
+from PIL import Image, ImageOps, features
+from werkzeug.security import safe_join
+
+# Longest side in pixels of each derivative
+SIZES = {'thumb': 160, 'preview': 1024}
+
+# WebP is much smaller at the same quality; fall back to JPEG when Pillow lacks it
+FORMAT = 'WEBP' if features.check('webp') else 'JPEG'
+EXTENSION = FORMAT.lower().replace('jpeg', 'jpg')
+MIMETYPE = f"image/{FORMAT.lower()}"
+
+_CONTENT_FILENAME = re.compile(r'^[0-9a-f]{64}\.[a-z]+$')
+
+
+def content_filename(data, extension):
+    """Name an upload after the SHA-256 of its bytes, so identical uploads share one file"""
+    extension = extension.lower().replace('jpeg', 'jpg')
+    return f"{hashlib.sha256(data).hexdigest()}.{extension}"
+
+
+def is_content_addressed(filename):
+    """Content-addressed files never change, so they can be cached forever"""
+    return bool(_CONTENT_FILENAME.match(filename))
+
+
+def write_atomic(path, data):
+    """Write bytes via a temporary file and rename, so readers never see a partial file"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def render_derivative(data, size, quality=80):
+    """Return encoded bytes of the image scaled so its longest side is at most SIZES[size]"""
+    bound = SIZES[size]
+    image = Image.open(io.BytesIO(data))
+    # Decode JPEGs at a reduced DCT scale; a 12 MP photo never has to be decoded in full
+    image.draft('RGB', (bound, bound))
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.thumbnail((bound, bound), Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, FORMAT, quality=quality)
+    return buffer.getvalue()
+
+
+class DerivativeStore:
+    """
+    Thumbnails of uploads, generated once and cached on disk. read_original(filename) returns
+    the bytes of an upload or raises FileNotFoundError.
+    """
+
+    def __init__(self, read_original, root, quality=80):
+        self.read_original = read_original
+        self.root = root
+        self.quality = quality
+        for size in SIZES:
+            os.makedirs(os.path.join(root, size), exist_ok=True)
+
+    def path(self, filename, size):
+        """Location of a derivative, or None if the filename tries to escape the store"""
+        return safe_join(self.root, size, f"{filename}.{EXTENSION}")
+
+    def create(self, filename, data, size):
+        """Generate a derivative from upload bytes that are already in memory"""
+        path = self.path(filename, size)
+        if path is None or os.path.exists(path):
+            return path
+        write_atomic(path, render_derivative(data, size, self.quality))
+        return path
+
+    def get(self, filename, size):
+        """
+        Return the path of a derivative, generating it from the original if needed.
+        Raises FileNotFoundError if there is no such upload.
+        """
+        if size not in SIZES:
+            raise FileNotFoundError(size)
+        path = self.path(filename, size)
+        if path is not None and os.path.exists(path):
+            return path
+        if path is None:
+            raise FileNotFoundError(filename)
+        return self.create(filename, self.read_original(filename), size)
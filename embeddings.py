@@ -0,0 +1,321 @@
+"""
+Embedding store for TomatoHealth
+Penultimate-layer embeddings of past predictions in an append-only, memory-mapped float16
+file, with an inverted-file (IVF) index for fast "similar past cases" lookups
+"""
+
+import fcntl
+import io
+import os
+import threading
+
+import numpy as np
+
+from derivatives import write_atomic
+
+# Centroids are trained once the store holds this many rows; smaller stores are searched exactly
+MIN_TRAIN_ROWS = int(os.environ.get('EMBEDDING_MIN_TRAIN_ROWS', 10000))
+# Clusters searched per query; more is slower but finds more of the true neighbours
+NPROBE = int(os.environ.get('EMBEDDING_NPROBE', 16))
+# Unsorted rows appended since the last re-sort that are scanned linearly
+MAX_TAIL_ROWS = 4096
+
+
+def record_dtype(dim):
+    """One row of the store: the prediction it belongs to, its owner and the unit-length vector"""
+    return np.dtype([('prediction_id', '<i8'), ('user_id', '<i8'), ('vector', '<f2', (dim,))])
+
+
+def normalize(vectors):
+    """Scale vectors to unit length, so the dot product is the cosine similarity"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def nearest_centroids(vectors, centroids, chunk=65536):
+    """Index of the most similar centroid for every vector, in chunks to bound memory"""
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk):
+        block = np.asarray(vectors[start:start + chunk], dtype=np.float32)
+        assignments[start:start + chunk] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(vectors, clusters, iterations=10, sample_size=None, seed=0):
+    """Spherical k-means on a random sample of the rows; returns (clusters, dim) unit centroids"""
+    rng = np.random.default_rng(seed)
+    clusters = min(clusters, len(vectors))
+    sample_size = min(len(vectors), sample_size or clusters * 64)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), clusters, replace=False)]
+    for _ in range(iterations):
+        assignments = nearest_centroids(sample, centroids)
+        order = np.argsort(assignments, kind='stable')
+        members = np.bincount(assignments, minlength=clusters)
+        starts = np.concatenate([[0], np.cumsum(members)[:-1]])
+        # Sum each cluster's members in one pass over the sorted sample
+        sums = np.add.reduceat(sample[order], np.minimum(starts, len(sample) - 1), axis=0)
+        # Clusters that lost every member restart from a random row
+        empty = np.flatnonzero(members == 0)
+        sums[empty] = sample[rng.choice(len(sample), len(empty))]
+        centroids = normalize(sums)
+    return centroids
+
+
+def default_clusters(rows):
+    """About sqrt(rows) clusters, so a probed cluster holds about as many rows as there are clusters"""
+    return int(np.clip(np.sqrt(rows), 1, 4096))
+
+
+class EmbeddingStore:
+    """
+    Embeddings of one model version in a directory.
+    vectors-<dim>.bin is append-only and shared by every process; index.npz holds the
+    centroids and the cluster of every row present when they were trained. Each process maps
+    the file, assigns rows appended since then to the nearest centroid, and searches only
+    the clusters closest to the query.
+    """
+
+    def __init__(self, directory, dim, nprobe=NPROBE, min_train_rows=MIN_TRAIN_ROWS):
+        self.directory = directory
+        self.dim = dim
+        self.nprobe = nprobe
+        self.min_train_rows = min_train_rows
+        self.dtype = record_dtype(dim)
+        self.path = os.path.join(directory, f"vectors-{dim}.bin")
+        self.index_path = os.path.join(directory, 'index.npz')
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._records = np.empty(0, dtype=self.dtype)
+        self._index_stamp = None
+        self._centroids = None
+        self._trained_rows = 0
+        self._rebuilding = False
+        self._reset_index()
+
+    def _reset_index(self):
+        # Rows [0, _sorted) are grouped by cluster, user and prediction id; the rest is the tail
+        self._sorted = 0
+        self._clusters = np.empty(0, dtype=np.int32)
+        self._by_cluster = self._cluster_offsets = None
+        self._by_user = self._users = None
+        self._by_id = self._ids = None
+
+    def __len__(self):
+        self.refresh()
+        return len(self._records)
+
+    # Writing
+
+    def append(self, prediction_id, user_id, vector):
+        """Add one prediction's embedding; safe to call from several processes at once"""
+        self.append_many([prediction_id], [user_id], np.asarray(vector)[None])
+
+    def append_many(self, prediction_ids, user_ids, vectors):
+        self._write(self._records_for(prediction_ids, user_ids, vectors))
+        if os.environ.get('EMBEDDING_AUTO_REBUILD', '1') == '1' and self._needs_rebuild():
+            self.start_rebuild()
+
+    def _records_for(self, prediction_ids, user_ids, vectors):
+        records = np.empty(len(prediction_ids), dtype=self.dtype)
+        records['prediction_id'] = prediction_ids
+        records['user_id'] = user_ids
+        records['vector'] = normalize(vectors)
+        return records
+
+    def _write(self, records):
+        with open(self.path, 'ab') as f:
+            # One locked write per batch, so concurrent writers never interleave records
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(records.tobytes())
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _needs_rebuild(self):
+        self.refresh()
+        if self._centroids is None:
+            return len(self._records) >= self.min_train_rows
+        # Retrain each time the store doubles, so the clusters follow the data
+        return len(self._records) >= 2 * self._trained_rows
+
+    def start_rebuild(self):
+        """Retrain the index in a background thread; only one process trains at a time"""
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._rebuild_in_background, name='embedding-index', daemon=True).start()
+
+    def _rebuild_in_background(self):
+        try:
+            self.rebuild(wait=False)
+        except Exception as e:
+            print(f"Warning: Could not rebuild the embedding index: {e}")
+        finally:
+            self._rebuilding = False
+
+    def rebuild(self, clusters=None, wait=True):
+        """
+        Train new centroids on the current rows and assign every row to one.
+        Returns the number of rows indexed, or None if another process is already rebuilding.
+        """
+        with open(os.path.join(self.directory, '.rebuild.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+            except BlockingIOError:
+                return None
+            self.refresh()
+            records = self._records
+            if not len(records):
+                return 0
+            vectors = records['vector']
+            centroids = train_centroids(vectors, clusters or default_clusters(len(records)))
+            assignments = nearest_centroids(vectors, centroids)
+            buffer = io.BytesIO()
+            np.savez(buffer, centroids=centroids.astype(np.float32), assignments=assignments)
+            write_atomic(self.index_path, buffer.getvalue())
+            return len(records)
+
+    # Reading
+
+    def _load_index(self):
+        with np.load(self.index_path) as index:
+            return index['centroids'], index['assignments']
+
+    def refresh(self):
+        """Map rows appended by any process and pick up a retrained index"""
+        with self._lock:
+            try:
+                size = os.path.getsize(self.path)
+            except FileNotFoundError:
+                size = 0
+            rows = size // self.dtype.itemsize
+            if rows != len(self._records):
+                self._records = (np.memmap(self.path, dtype=self.dtype, mode='r', shape=(rows,))
+                                 if rows else np.empty(0, dtype=self.dtype))
+
+            try:
+                stat = os.stat(self.index_path)
+                index_stamp = (stat.st_ino, stat.st_mtime_ns)
+            except FileNotFoundError:
+                index_stamp = None
+            if index_stamp != self._index_stamp:
+                self._index_stamp = index_stamp
+                self._reset_index()
+                self._centroids, self._clusters = (self._load_index() if index_stamp
+                                                   else (None, np.empty(0, dtype=np.int32)))
+                self._trained_rows = len(self._clusters)
+
+            # Rows appended since the index was trained go to the nearest existing centroid
+            if self._centroids is not None and len(self._clusters) < rows:
+                new = nearest_centroids(self._records['vector'][len(self._clusters):rows], self._centroids)
+                self._clusters = np.concatenate([self._clusters, new])
+            if rows - self._sorted > MAX_TAIL_ROWS:
+                self._sort(rows)
+
+    def _sort(self, rows):
+        records = self._records[:rows]
+        self._users = np.asarray(records['user_id'])
+        self._by_user = np.argsort(self._users, kind='stable')
+        self._users = self._users[self._by_user]
+        self._ids = np.asarray(records['prediction_id'])
+        self._by_id = np.argsort(self._ids, kind='stable')
+        self._ids = self._ids[self._by_id]
+        if self._centroids is not None:
+            self._by_cluster = np.argsort(self._clusters[:rows], kind='stable')
+            self._cluster_offsets = np.searchsorted(self._clusters[:rows][self._by_cluster],
+                                                    np.arange(len(self._centroids) + 1))
+        self._sorted = rows
+
+    def _user_rows(self, user_id):
+        rows = np.empty(0, dtype=np.int64)
+        if self._sorted:
+            start, end = np.searchsorted(self._users, [user_id, user_id + 1])
+            rows = self._by_user[start:end]
+        tail = np.arange(self._sorted, len(self._records))
+        return np.concatenate([rows, tail[self._records['user_id'][self._sorted:] == user_id]])
+
+    def _probed_rows(self, query):
+        probe = np.argsort(self._centroids @ query)[-self.nprobe:]
+        parts = []
+        if self._by_cluster is not None:
+            parts = [self._by_cluster[self._cluster_offsets[c]:self._cluster_offsets[c + 1]] for c in probe]
+        tail = np.arange(self._sorted, len(self._records))
+        parts.append(tail[np.isin(self._clusters[self._sorted:len(self._records)], probe)])
+        return np.concatenate(parts)
+
+    def vector(self, prediction_id):
+        """The stored embedding of a prediction, or None"""
+        with self._lock:
+            self.refresh()
+            if self._sorted:
+                position = np.searchsorted(self._ids, prediction_id)
+                if position < len(self._ids) and self._ids[position] == prediction_id:
+                    return self._records['vector'][self._by_id[position]].astype(np.float32)
+            tail = np.flatnonzero(self._records['prediction_id'][self._sorted:] == prediction_id)
+            if len(tail):
+                return self._records['vector'][self._sorted + tail[-1]].astype(np.float32)
+            return None
+
+    def search(self, vector, k=5, user_id=None, exclude=(), exact=False):
+        """
+        Return up to k (prediction_id, similarity) pairs, most similar first.
+        With user_id only that user's predictions are searched (exactly); globally the
+        nprobe nearest clusters are, unless the store is untrained or exact is set.
+        """
+        query = normalize(vector)
+        with self._lock:
+            self.refresh()
+            records = self._records
+            if user_id is not None:
+                rows = self._user_rows(user_id)
+            elif self._centroids is None or exact:
+                rows = None
+            else:
+                rows = self._probed_rows(query)
+
+        if rows is None:
+            ids = np.asarray(records['prediction_id'])
+            scores = np.concatenate([np.asarray(records['vector'][start:start + 65536], dtype=np.float32) @ query
+                                     for start in range(0, len(records), 65536)] or [np.empty(0)])
+        else:
+            ids = records['prediction_id'][rows]
+            scores = np.asarray(records['vector'][rows], dtype=np.float32) @ query
+        if not len(scores):
+            return []
+        if exclude:
+            scores[np.isin(ids, list(exclude))] = -np.inf
+        top = np.argpartition(-scores, min(k, len(scores) - 1))[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+
+class EmbeddingStores:
+    """One store per model version, since embeddings of different models are not comparable"""
+
+    def __init__(self, root):
+        self.root = root
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_version, dim):
+        key = (model_version, dim)
+        with self._lock:
+            store = self._stores.get(key)
+            if store is None:
+                store = self._stores[key] = EmbeddingStore(os.path.join(self.root, model_version), dim)
+            return store
+
+
+def build_store(directory, vectors, user_ids=None, chunk=100000):
+    """Write a store from in-memory vectors in one go (benchmarks and bulk imports)"""
+    store = EmbeddingStore(directory, vectors.shape[1])
+    if user_ids is None:
+        user_ids = np.zeros(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk):
+        end = min(start + chunk, len(vectors))
+        store._write(store._records_for(np.arange(start, end) + 1, user_ids[start:end], vectors[start:end]))
+    return store
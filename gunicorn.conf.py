@@ -0,0 +1,20 @@
+"""
+Gunicorn configuration for TomatoHealth
+The app (and the memory-mapped model) is loaded once in the master and shared by the forked workers
+"""
+
+import os
+
+preload_app = True
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+
+
+def post_fork(server, worker):
+    from app import app, db, predictor
+    # Connections opened by the master at import must not be shared with it; drop them
+    # from this worker's pool without closing them under the master
+    with app.app_context():
+        db.engine.dispose(close=False)
+    # The TFLite runtime, interpreters and their thread pools are built per worker, after fork
+    if predictor:
+        predictor.start_warm_up()
@@ -0,0 +1,126 @@
+"""
+Image helpers for TomatoHealth
+Decode uploads once into a NumPy buffer shared by validation and inference
+"""
+
+import io
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# Model input size (width, height)
+MODEL_INPUT_SIZE = (256, 256)
+
+
+def decode_image(data, target_size=MODEL_INPUT_SIZE):
+    """
+    Decode image bytes into an RGB uint8 array of shape (H, W, 3).
+    JPEGs are decoded at a reduced DCT scale, so the result is the smallest
+    power-of-two downscale that still covers target_size.
+    """
+    image = Image.open(io.BytesIO(data))
+    if target_size is not None:
+        image.draft('RGB', target_size)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return np.asarray(image)
+
+
+def load_image(image_path, target_size=MODEL_INPUT_SIZE):
+    """Decode an image file from disk, see decode_image"""
+    with open(image_path, 'rb') as f:
+        return decode_image(f.read(), target_size)
+
+
+def resize_for_model(image, out=None):
+    """Resize a decoded RGB array to the model input size, optionally into a preallocated buffer"""
+    if image.shape[1] == MODEL_INPUT_SIZE[0] and image.shape[0] == MODEL_INPUT_SIZE[1]:
+        if out is None:
+            return image
+        np.copyto(out, image)
+        return out
+    interpolation = cv2.INTER_AREA if image.shape[0] > MODEL_INPUT_SIZE[1] else cv2.INTER_CUBIC
+    return cv2.resize(image, MODEL_INPUT_SIZE, dst=out, interpolation=interpolation)
+
+
+# Longest side of the proxy image the validation heuristics run on
+PROXY_SIZE = 256
+
+# Plant heuristic thresholds
+MIN_GREEN_PERCENTAGE = 15
+MIN_EDGE_PERCENTAGE = 2
+
+
+def proxy_image(image, size=PROXY_SIZE):
+    """Downscale an RGB array so its longest side is at most size pixels"""
+    height, width = image.shape[:2]
+    scale = size / max(height, width)
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                      interpolation=cv2.INTER_AREA)
+
+
+def green_percentage(hsv):
+    """Percentage of saturated, lit pixels whose hue is green, from a hue histogram"""
+    # Same range as cv2.inRange(hsv, (35, 40, 40), (85, 255, 255)) without building a full mask image
+    lit = (hsv[..., 1] >= 40) & (hsv[..., 2] >= 40)
+    hue_histogram = np.bincount(hsv[..., 0][lit], minlength=180)
+    return hue_histogram[35:86].sum() * 100 / (hsv.shape[0] * hsv.shape[1])
+
+
+def edge_percentage(gray):
+    """Percentage of Canny edge pixels; leaf-like structures produce edges"""
+    edges = cv2.Canny(gray, 50, 150)
+    return cv2.countNonZero(edges) * 100 / edges.size
+
+
+def sharpness(gray):
+    """Variance of the Laplacian; low values mean a blurry image"""
+    return float(cv2.Laplacian(gray, cv2.CV_32F).var())
+
+
+def brightness(gray):
+    """Mean grey level (0-255)"""
+    return float(gray.mean())
+
+
+def plant_scores(image):
+    """
+    Return (green_percentage, edge_percentage) for an RGB array.
+    Plants are typically green, and leaf-like structures produce edges.
+    Computed on a small proxy of the image.
+    """
+    image = proxy_image(image)
+    hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    return green_percentage(hsv), edge_percentage(gray)
+
+
+def is_plant_image(image):
+    """
+    Basic plant detection using color analysis and edge detection.
+    This is a simple heuristic - for production, you'd want a dedicated plant detection model.
+    Accepts an image path or an RGB array from decode_image.
+    """
+    try:
+        # Read image
+        if isinstance(image, str):
+            image = load_image(image)
+        if image is None:
+            return False
+
+        green, edges = plant_scores(image)
+
+        # Simple heuristic: if there's significant green color and some edges, it might be a plant
+        is_likely_plant = green > MIN_GREEN_PERCENTAGE and edges > MIN_EDGE_PERCENTAGE
+
+        # Additional check: look for organic shapes (leaves typically have rounded edges)
+        # This is a simplified check - in reality you'd want more sophisticated shape analysis
+
+        return is_likely_plant
+
+    except Exception as e:
+        print(f"Error in plant detection: {e}")
+        return False
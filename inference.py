@@ -0,0 +1,573 @@
+"""
+Inference backend for TomatoHealth
+Lazy TFLite runtime loading, thread-safe interpreter pooling and
+micro-batching of concurrent prediction requests
+"""
+
+import hashlib
+import mmap
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+from imaging import decode_image, load_image, resize_for_model
+from metrics import BATCH_SIZE, INVOKE_SECONDS, MODEL_LOAD_SECONDS, QUEUE_WAIT_SECONDS
+
+# Output classes of the tomato model, in output order
+DISEASE_CLASSES = [
+    'Bacterial spot',
+    'Early blight', 
+    'Late blight',
+    'Leaf Mold',
+    'Septoria leaf spot',
+    'Spider mites Two-spotted spider mite',
+    'Target Spot',
+    'Yellow Leaf Curl Virus',
+    'Mosaic virus',
+    'Healthy'
+]
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+
+def load_runtime():
+    """
+    Import the lightest TFLite runtime available on first use.
+    Returns (Interpreter class, OpResolverType enum, runtime name); the full
+    TensorFlow package is only imported when no standalone runtime is installed.
+    """
+    global _runtime
+    if _runtime is not None:
+        return _runtime
+    with _runtime_lock:
+        if _runtime is None:
+            try:
+                from tflite_runtime import interpreter as tflite
+                _runtime = (tflite.Interpreter, tflite.OpResolverType, 'tflite_runtime')
+            except ImportError:
+                try:
+                    from ai_edge_litert import interpreter as litert
+                    _runtime = (litert.Interpreter, litert.OpResolverType, 'ai_edge_litert')
+                except ImportError:
+                    import tensorflow as tf
+                    _runtime = (tf.lite.Interpreter, tf.lite.experimental.OpResolverType, 'tensorflow')
+    return _runtime
+
+
+def preprocess_image(image):
+    """Return the (256, 256, 3) uint8 model input for a path, file object or decoded RGB array"""
+    if isinstance(image, str):
+        image = load_image(image)
+    elif hasattr(image, 'read'):
+        image = decode_image(image.read())
+    elif isinstance(image, Image.Image):
+        image = np.asarray(image.convert('RGB'))
+    
+    # Resize to model input size
+    return resize_for_model(image)
+
+
+class BatchTimeout(TimeoutError):
+    """Raised when a request is not answered within its timeout"""
+
+
+def default_pool_size():
+    """One interpreter per request thread that can run inference at the same time"""
+    for key in ('INTERPRETER_POOL_SIZE', 'GUNICORN_THREADS', 'THREADS'):
+        value = os.environ.get(key)
+        if value:
+            return max(1, int(value))
+    return 1
+
+
+def default_num_threads(pool_size):
+    """Split the cores of this worker between the interpreters of the pool"""
+    value = os.environ.get('TFLITE_NUM_THREADS')
+    if value:
+        return max(1, int(value))
+    workers = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+    return max(1, (os.cpu_count() or 1) // (workers * pool_size))
+
+
+# Ops between the classifier layer and the model output that only rescale its logits
+_OUTPUT_OPS = {'SOFTMAX', 'LOGISTIC', 'DEQUANTIZE', 'QUANTIZE', 'RESHAPE'}
+
+
+def find_embedding_tensor(interpreter, output_index):
+    """
+    Index of the penultimate-layer tensor, the input of the final fully connected layer,
+    or None when the graph cannot be inspected or does not end in one
+    """
+    try:
+        ops = interpreter._get_ops_details()
+    except AttributeError:
+        return None
+    producers = {int(tensor): op for op in ops for tensor in op['outputs']}
+    op = producers.get(int(output_index))
+    while op is not None and op['op_name'] in _OUTPUT_OPS:
+        op = producers.get(int(op['inputs'][0]))
+    if op is None or op['op_name'] != 'FULLY_CONNECTED':
+        return None
+    return int(op['inputs'][0])
+
+
+class PooledInterpreter:
+    """A single interpreter plus the state needed to run batches on it"""
+
+    def __init__(self, interpreter, embeddings=False):
+        self.interpreter = interpreter
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()
+        self.output_details = self.interpreter.get_output_details()
+        self.batch_size = int(self.input_details[0]['shape'][0])
+        
+        # Intermediate tensors are only readable when the interpreter preserves them
+        self.embedding_detail = None
+        if embeddings:
+            index = find_embedding_tensor(self.interpreter, self.output_details[0]['index'])
+            if index is not None:
+                self.embedding_detail = next(detail for detail in self.interpreter.get_tensor_details()
+                                             if detail['index'] == index)
+
+    @property
+    def embedding_size(self):
+        if self.embedding_detail is None:
+            return None
+        return int(np.prod(self.embedding_detail['shape'][1:]))
+
+    def run(self, input_batch, embeddings=False):
+        """
+        Run one invoke over an (N, H, W, C) batch and return (N, classes) probabilities,
+        or (probabilities, (N, D) embeddings) when embeddings is set
+        """
+        input_detail = self.input_details[0]
+        input_index = input_detail['index']
+
+        # Resize the input tensor to the batch dimension when it changes
+        if input_batch.shape[0] != self.batch_size:
+            self.interpreter.resize_tensor_input(input_index, list(input_batch.shape))
+            self.interpreter.allocate_tensors()
+            self.batch_size = input_batch.shape[0]
+
+        self.interpreter.set_tensor(input_index, _quantize(input_batch, input_detail))
+        with INVOKE_SECONDS.time():
+            self.interpreter.invoke()
+        output_detail = self.output_details[0]
+        probs = _dequantize(self.interpreter.get_tensor(output_detail['index']), output_detail)
+        if not embeddings:
+            return probs
+        if self.embedding_detail is None:
+            return probs, None
+        vectors = _dequantize(self.interpreter.get_tensor(self.embedding_detail['index']), self.embedding_detail)
+        return probs, vectors.reshape(len(probs), -1)
+
+
+def _quantize(values, detail):
+    """Convert float inputs to the tensor type; fully integer-quantized models take int8/uint8"""
+    dtype = detail['dtype']
+    if dtype == np.float32:
+        return values.astype(np.float32, copy=False)
+    scale, zero_point = detail['quantization']
+    limits = np.iinfo(dtype)
+    return np.clip(np.round(values / scale + zero_point), limits.min, limits.max).astype(dtype)
+
+
+def _dequantize(values, detail):
+    """Return a float32 copy of an output tensor"""
+    if values.dtype == np.float32:
+        return values.copy()
+    scale, zero_point = detail['quantization']
+    return (values.astype(np.float32) - zero_point) * scale
+
+
+class InterpreterPool:
+    """
+    A fixed set of interpreters built from the same memory-mapped model file.
+    Interpreters are not thread-safe, so each one is checked out by a single thread at a time.
+    They are built lazily in the process that uses them: their thread pools do not survive
+    fork, while the mapped model pages are shared by every process through the page cache.
+    """
+
+    def __init__(self, model_path, size=None, num_threads=None, use_xnnpack=None, embeddings=None):
+        self.model_path = model_path
+        self.size = size or default_pool_size()
+        self.num_threads = num_threads or default_num_threads(self.size)
+        if use_xnnpack is None:
+            use_xnnpack = os.environ.get('TFLITE_USE_XNNPACK', '1') == '1'
+        self.use_xnnpack = use_xnnpack
+        if embeddings is None:
+            embeddings = os.environ.get('EMBEDDINGS', '0') == '1'
+        self.embeddings = embeddings
+
+        self._available = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _build(self):
+        interpreter_class, op_resolver_type, _ = load_runtime()
+        # Loading from a path memory-maps the flatbuffer instead of copying it
+        kwargs = {'model_path': self.model_path, 'num_threads': self.num_threads}
+        if not self.use_xnnpack:
+            kwargs['experimental_op_resolver_type'] = op_resolver_type.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+        if self.embeddings:
+            # Keeps intermediate tensors (the embedding) readable after invoke, at some memory cost
+            kwargs['experimental_preserve_all_tensors'] = True
+            try:
+                return interpreter_class(**kwargs)
+            except TypeError:
+                print('Warning: This TFLite runtime cannot expose embeddings; similar cases are disabled')
+                self.embeddings = False
+                del kwargs['experimental_preserve_all_tensors']
+        return interpreter_class(**kwargs)
+
+    def _ensure_built(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                available = queue.LifoQueue()
+                for _ in range(self.size):
+                    available.put(PooledInterpreter(self._build(), self.embeddings))
+                self._available = available
+                self._pid = os.getpid()
+
+    @property
+    def runtime(self):
+        """Name of the TFLite runtime; it is imported on first use, in the process that runs the model"""
+        return load_runtime()[2]
+
+    @property
+    def is_built(self):
+        return self._pid == os.getpid()
+
+    @contextmanager
+    def interpreter(self, timeout=None):
+        """Check out an interpreter for the duration of the with block"""
+        self._ensure_built()
+        try:
+            slot = self._available.get(timeout=timeout)
+        except queue.Empty:
+            raise BatchTimeout('No interpreter became available in time')
+        try:
+            yield slot
+        finally:
+            self._available.put(slot)
+
+    def run(self, input_batch, embeddings=False):
+        with self.interpreter() as slot:
+            return slot.run(input_batch, embeddings)
+
+    @property
+    def embedding_size(self):
+        """Length of the model's embeddings, or None when they are not available"""
+        with self.interpreter() as slot:
+            return slot.embedding_size
+
+    def warm_up(self):
+        """Build every interpreter of this process and run one invoke on each"""
+        self._ensure_built()
+        slots = [self._available.get() for _ in range(self.size)]
+        try:
+            for slot in slots:
+                shape = [1] + [int(d) for d in slot.input_details[0]['shape'][1:]]
+                slot.run(np.zeros(shape, dtype=np.float32))
+        finally:
+            for slot in slots:
+                self._available.put(slot)
+
+
+class _PendingRequest:
+    __slots__ = ('input_arr', 'enqueued_at', 'done', 'result', 'embedding', 'error', 'cancelled')
+
+    def __init__(self, input_arr):
+        self.input_arr = input_arr
+        self.enqueued_at = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.embedding = None
+        self.error = None
+        self.cancelled = False
+
+
+class BatchingEngine:
+    """
+    Collects single-image requests from many threads into one batched tensor.
+    A batch is dispatched as soon as it holds max_batch_size images or the oldest
+    request has waited max_wait_ms, whichever comes first. Batches are padded to the
+    next power of two (1, 2, 4, 8, ...), so the interpreter's input tensor only takes a
+    few shapes and a single request still costs one image. With an interpreter pool,
+    one dispatcher thread per interpreter keeps every interpreter busy.
+    predict_batch(batch, embeddings=True) must return (probabilities, embeddings or None).
+    """
+
+    def __init__(self, predict_batch, max_batch_size=8, max_wait_ms=5.0, timeout=30.0, workers=1):
+        self.predict_batch = predict_batch
+        self.workers = max(1, int(workers))
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.timeout = float(timeout)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self._closed = False
+        # Statistics
+        self.batches = 0
+        self.requests = 0
+        self.timeouts = 0
+        self.last_batch_size = 0
+        self.max_batch_seen = 0
+        self.total_queue_wait = 0.0
+
+    def _ensure_started(self):
+        # Threads do not survive fork, so a preloaded app restarts the worker per process
+        if self._closed or (self._pid == os.getpid() and all(t.is_alive() for t in self._threads)):
+            return
+        with self._lock:
+            if self._closed:
+                return
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._threads = []
+                self._pid = os.getpid()
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name='batching-engine', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, input_arr, timeout=None, with_embedding=False):
+        """
+        Queue one preprocessed image (H, W, C) and block until its batch has run.
+        Returns (predicted_class, confidence, probabilities), and its embedding (or None)
+        as well when with_embedding is set
+        """
+        self._ensure_started()
+        pending = _PendingRequest(input_arr)
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._queue.put(pending)
+        if closed:
+            # A retired engine still answers late requests, one invoke each
+            probs, vectors = self.predict_batch(input_arr[None].astype(np.float32), embeddings=True)
+            predicted_class = int(np.argmax(probs[0]))
+            pending.result = (predicted_class, float(probs[0][predicted_class]), probs[0])
+            pending.embedding = vectors[0] if vectors is not None else None
+            pending.done.set()
+
+        if not pending.done.wait(self.timeout if timeout is None else timeout):
+            pending.cancelled = True
+            with self._lock:
+                self.timeouts += 1
+            raise BatchTimeout('Prediction request timed out waiting for the model')
+
+        if pending.error is not None:
+            raise pending.error
+        if with_embedding:
+            return pending.result, pending.embedding
+        return pending.result
+
+    def close(self):
+        """Stop the dispatcher threads once every request already queued has run"""
+        with self._lock:
+            self._closed = True
+            if self._pid == os.getpid():
+                for _ in self._threads:
+                    self._queue.put(None)
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first.enqueued_at + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+            if batch[-1] is None:
+                # Leave the stop signal for after this batch
+                self._queue.put(batch.pop())
+                break
+        return [item for item in batch if not item.cancelled]
+
+    def _run(self):
+        # Input tensor preallocated once per dispatcher and reused for every batch
+        buffer = None
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            try:
+                shape = batch[0].input_arr.shape
+                if buffer is None or buffer.shape[1:] != shape:
+                    buffer = np.zeros((self.max_batch_size,) + shape, dtype=np.float32)
+                for i, item in enumerate(batch):
+                    np.copyto(buffer[i], item.input_arr)
+                # Rows past the batch hold earlier inputs; their outputs are dropped
+                predictions, vectors = self.predict_batch(buffer[:self.padded_size(len(batch))], embeddings=True)
+                predictions = predictions[:len(batch)]
+            except Exception as e:
+                for item in batch:
+                    item.error = e
+                    item.done.set()
+                continue
+
+            waits = [started - item.enqueued_at for item in batch]
+            with self._lock:
+                self.batches += 1
+                self.requests += len(batch)
+                self.last_batch_size = len(batch)
+                self.max_batch_seen = max(self.max_batch_seen, len(batch))
+                self.total_queue_wait += sum(waits)
+            BATCH_SIZE.observe(len(batch))
+            for wait in waits:
+                QUEUE_WAIT_SECONDS.observe(wait)
+
+            for i, (item, probs) in enumerate(zip(batch, predictions)):
+                predicted_class = int(np.argmax(probs))
+                item.result = (predicted_class, float(probs[predicted_class]), probs)
+                item.embedding = vectors[i] if vectors is not None else None
+                item.done.set()
+
+    def padded_size(self, size):
+        """The power of two a batch of size images is run at, at most max_batch_size"""
+        return min(self.max_batch_size, 1 << (size - 1).bit_length())
+
+    def stats(self):
+        """Return batch size and queue wait statistics"""
+        with self._lock:
+            return {
+                'batches': self.batches,
+                'requests': self.requests,
+                'timeouts': self.timeouts,
+                'queue_depth': self._queue.qsize(),
+                'last_batch_size': self.last_batch_size,
+                'max_batch_size': self.max_batch_seen,
+                'avg_batch_size': self.requests / self.batches if self.batches else 0.0,
+                'avg_queue_wait_ms': 1000.0 * self.total_queue_wait / self.requests if self.requests else 0.0,
+            }
+
+
+class TomatoDiseasePredictor:
+    def __init__(self, model_path):
+        started = time.perf_counter()
+        self.model_path = model_path
+        self.model_name = os.path.splitext(os.path.basename(model_path))[0]
+        
+        # Map the model file once; forked workers and every interpreter share these pages
+        with open(model_path, 'rb') as f:
+            self.model_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        # Identifies the model in cache keys, so a new model never serves stale results
+        self.model_version = hashlib.sha256(self.model_map).hexdigest()[:12]
+        
+        # Interpreters are not thread-safe, so each request thread checks one out of the pool
+        self.pool = InterpreterPool(model_path)
+        
+        # Concurrent requests are grouped into one batched invoke
+        self.engine = None
+        if os.environ.get('INFERENCE_BATCHING', '1') == '1':
+            self.engine = BatchingEngine(
+                self.predict_batch,
+                max_batch_size=int(os.environ.get('BATCH_MAX_SIZE', 8)),
+                max_wait_ms=float(os.environ.get('BATCH_MAX_WAIT_MS', 5)),
+                timeout=float(os.environ.get('BATCH_TIMEOUT', 30)),
+                workers=self.pool.size
+            )
+        
+        self.load_seconds = time.perf_counter() - started
+        MODEL_LOAD_SECONDS.set(self.load_seconds, phase='load')
+        self.warm_seconds = None
+        self._warm_pid = None
+        self._warming_pid = None
+        self._warm_lock = threading.Lock()
+        self._embedding_size = False
+    
+    @property
+    def is_warm(self):
+        """True once the interpreters of this process have run their first invoke"""
+        return self._warm_pid == os.getpid()
+    
+    def warm_up(self):
+        started = time.perf_counter()
+        self.pool.warm_up()
+        self.warm_seconds = time.perf_counter() - started
+        MODEL_LOAD_SECONDS.set(self.warm_seconds, phase='warm_up')
+        self._warm_pid = os.getpid()
+    
+    def start_warm_up(self):
+        """Warm up in a background thread, once per process (call after fork)"""
+        with self._warm_lock:
+            if self._warming_pid == os.getpid():
+                return
+            self._warming_pid = os.getpid()
+        threading.Thread(target=self._warm_up_in_background, name='model-warm-up', daemon=True).start()
+    
+    def _warm_up_in_background(self):
+        try:
+            self.warm_up()
+        except Exception as e:
+            print(f"Warning: Model warm-up failed: {e}")
+            with self._warm_lock:
+                self._warming_pid = None
+    
+    def preprocess(self, image):
+        """Return the (256, 256, 3) uint8 model input for a path, file object or decoded RGB array"""
+        return preprocess_image(image)
+    
+    def predict_batch(self, input_batch, embeddings=False):
+        """
+        Run one invoke over a (N, 256, 256, 3) batch and return (N, classes) probabilities,
+        or (probabilities, (N, D) penultimate-layer embeddings or None) when embeddings is set
+        """
+        return self.pool.run(input_batch, embeddings)
+    
+    @property
+    def embedding_size(self):
+        """Length of this model's embeddings, or None if they cannot be extracted"""
+        if self._embedding_size is False:
+            self._embedding_size = self.pool.embedding_size if self.pool.embeddings else None
+        return self._embedding_size
+    
+    def close(self):
+        """Retire this model; requests still using it are answered, then its threads stop"""
+        if self.engine is not None:
+            self.engine.close()
+    
+    def predict(self, image, with_embedding=False):
+        """
+        Return (predicted_class, confidence, probabilities), plus the image's embedding
+        (or None) as a second value when with_embedding is set
+        """
+        input_arr = self.preprocess(image)
+        
+        if self.engine is not None:
+            return self.engine.submit(input_arr, with_embedding=with_embedding)
+        
+        predictions, vectors = self.predict_batch(np.array([input_arr]), embeddings=True)  # Add batch dimension
+        
+        # Get prediction class and confidence
+        predicted_class = np.argmax(predictions[0])
+        confidence = float(predictions[0][predicted_class])
+        
+        result = (predicted_class, confidence, predictions[0])
+        if with_embedding:
+            return result, vectors[0] if vectors is not None else None
+        return result
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Prediction job queue for TomatoHealth
+A durable SQLite-backed queue plus the worker processes that drain it
+
+Run the workers next to the web app:
+    python jobs.py worker --processes 4
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    payload BLOB,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_status_created ON jobs (status, created_at);
+"""
+
+
+class JobQueue:
+    """FIFO job queue stored in a SQLite file shared by the web and worker processes"""
+
+    def __init__(self, path, lease_seconds=300, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        # One connection per thread and process; SQLite connections are not shareable
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def enqueue(self, user_id, filename, data):
+        """Store an upload for processing and return its job id"""
+        job_id = uuid.uuid4().hex
+        self._connect().execute(
+            'INSERT INTO jobs (id, user_id, filename, payload, status, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (job_id, user_id, filename, data, QUEUED, time.time())
+        )
+        return job_id
+
+    def claim(self, worker, limit=1):
+        """Atomically move up to limit queued jobs to running and return them (with payload)"""
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Jobs whose worker died are handed out again once their lease expires
+            conn.execute(
+                'UPDATE jobs SET status = ?, worker = NULL WHERE status = ? AND started_at < ? AND attempts < ?',
+                (QUEUED, RUNNING, now - self.lease_seconds, self.max_attempts)
+            )
+            conn.execute(
+                'UPDATE jobs SET status = ?, error = ?, payload = NULL, finished_at = ? '
+                'WHERE status = ? AND started_at < ?',
+                (FAILED, 'Worker stopped before finishing the job', now, RUNNING, now - self.lease_seconds)
+            )
+            rows = conn.execute(
+                'SELECT * FROM jobs WHERE status = ? ORDER BY created_at LIMIT ?', (QUEUED, limit)
+            ).fetchall()
+            conn.executemany(
+                'UPDATE jobs SET status = ?, worker = ?, started_at = ?, attempts = attempts + 1 WHERE id = ?',
+                [(RUNNING, worker, now, row['id']) for row in rows]
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return [dict(row) for row in rows]
+
+    def complete(self, job_id, result):
+        self._finish(job_id, DONE, result=json.dumps(result))
+
+    def fail(self, job_id, error):
+        self._finish(job_id, FAILED, error=error)
+
+    def _finish(self, job_id, status, result=None, error=None):
+        # The payload is dropped once the job is finished; the upload lives on in upload storage
+        self._connect().execute(
+            'UPDATE jobs SET status = ?, result = ?, error = ?, payload = NULL, finished_at = ? WHERE id = ?',
+            (status, result, error, time.time(), job_id)
+        )
+
+    def get(self, job_id):
+        """Return the public fields of a job, or None"""
+        row = self._connect().execute(
+            'SELECT id, user_id, filename, status, result, error, attempts, created_at, started_at, finished_at '
+            'FROM jobs WHERE id = ?', (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def depth(self):
+        """Number of jobs waiting or running"""
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)', (QUEUED, RUNNING)
+        ).fetchone()[0]
+
+    def purge(self, older_than_seconds):
+        """Delete finished jobs older than the given age"""
+        self._connect().execute(
+            'DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?',
+            (DONE, FAILED, time.time() - older_than_seconds)
+        )
+
+
+def run_worker(batch_size=None, poll_interval=0.2):
+    """Claim jobs and process them until interrupted; runs in its own process"""
+    from app import app, job_queue, batch_executor, process_prediction_job
+
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    batch_size = batch_size or int(os.environ.get('BATCH_MAX_SIZE', 8))
+    print(f"Prediction worker {worker} started")
+
+    def process(job):
+        with app.app_context():
+            try:
+                job_queue.complete(job['id'], process_prediction_job(job))
+            except Exception as e:
+                job_queue.fail(job['id'], str(e))
+
+    while True:
+        jobs = job_queue.claim(worker, limit=batch_size)
+        if not jobs:
+            time.sleep(poll_interval)
+            continue
+        # Jobs of one claim run concurrently so they share batched invokes
+        list(batch_executor.map(process, jobs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TomatoHealth prediction job workers')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    worker_parser = subparsers.add_parser('worker', help='Run prediction worker processes')
+    worker_parser.add_argument('--processes', type=int, default=int(os.environ.get('JOB_WORKERS', 1)))
+    worker_parser.add_argument('--batch-size', type=int, default=None)
+    purge_parser = subparsers.add_parser('purge', help='Delete finished jobs')
+    purge_parser.add_argument('--older-than-hours', type=float, default=24)
+    args = parser.parse_args()
+
+    if args.command == 'purge':
+        from app import job_queue
+        job_queue.purge(args.older_than_hours * 3600)
+        return
+
+    processes = [
+        multiprocessing.Process(target=run_worker, kwargs={'batch_size': args.batch_size}, daemon=True)
+        for _ in range(max(1, args.processes))
+    ]
+    for process in processes:
+        process.start()
+
+    # Stop the worker processes together with the supervisor
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for process in processes:
+            process.join()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+Metrics for TomatoHealth
+Lightweight counters, gauges and histograms rendered in the Prometheus text format.
+Each observation is a bisect plus a few additions under a lock, cheap enough to stay on in production.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from sub-millisecond stages to slow uploads
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Optional function returning {label tuple: value}, evaluated at scrape time
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        if self.callback is not None:
+            try:
+                values = self.callback()
+            except Exception:
+                values = {}
+            with self._lock:
+                self._values = dict(values)
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines.extend(self._render_samples(items))
+        return lines
+
+    def _render_samples(self, items):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with block in seconds"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), callback=None):
+        return self.register(Counter(name, documentation, labelnames, callback))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        return self.register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    'tomatohealth_request_duration_seconds', 'Request latency by route', ('endpoint', 'method'))
+REQUESTS = REGISTRY.counter(
+    'tomatohealth_requests_total', 'Requests by route and status code', ('endpoint', 'method', 'status'))
+STAGE_SECONDS = REGISTRY.histogram(
+    'tomatohealth_stage_duration_seconds', 'Prediction pipeline stage latency', ('stage',))
+REJECTIONS = REGISTRY.counter(
+    'tomatohealth_rejections_total', 'Uploads rejected by reason', ('reason',))
+INFERENCE_TIERS = REGISTRY.counter(
+    'tomatohealth_inference_tier_total', 'Uploads classified, by the adaptive inference tier that answered', ('tier',))
+INVOKE_SECONDS = REGISTRY.histogram(
+    'tomatohealth_invoke_duration_seconds', 'Interpreter invoke latency per batch')
+BATCH_SIZE = REGISTRY.histogram(
+    'tomatohealth_batch_size', 'Images per batched invoke', buckets=(1, 2, 4, 8, 16, 32, 64))
+QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    'tomatohealth_batch_queue_wait_seconds', 'Time a request waits for its batch to start')
+WRITE_BEHIND_DROPPED = REGISTRY.counter(
+    'tomatohealth_write_behind_dropped_total', 'Buffered records dropped because writing them failed', ('buffer',))
+SCHEDULER_WAIT_SECONDS = REGISTRY.histogram(
+    'tomatohealth_scheduler_wait_seconds', 'Time a request waits for a fair-share inference slot', ('priority',))
+MODEL_LOAD_SECONDS = REGISTRY.gauge(
+    'tomatohealth_model_load_seconds', 'Model load and warm-up time', ('phase',))
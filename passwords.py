@@ -0,0 +1,77 @@
+"""
+Password hashing for TomatoHealth
+Hashing and verification run in a small bounded thread pool, so a burst of logins uses at
+most a fixed number of cores and is turned away instead of starving inference requests
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Werkzeug method string: pbkdf2:<hash>:<iterations> or scrypt:<n>:<r>:<p>
+DEFAULT_METHOD = 'pbkdf2:sha256:600000'
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many password checks are already waiting, or one took longer than the timeout"""
+
+
+class PasswordHasher:
+    """
+    Hashes passwords with a configurable scheme and cost. Hashes made with another scheme
+    or cost still verify, and verify() returns a replacement hash for them so callers can
+    upgrade (or downgrade) stored hashes transparently at login.
+    """
+
+    def __init__(self, method=None, workers=None, max_pending=None, timeout=None):
+        env = os.environ.get
+        self.method = method or env('PASSWORD_HASH_METHOD', DEFAULT_METHOD)
+        self.timeout = float(timeout or env('AUTH_TIMEOUT', 10))
+        # hashlib releases the GIL while hashing, so workers is the number of cores logins may use
+        self._executor = ThreadPoolExecutor(max_workers=int(workers or env('AUTH_WORKERS', 2)),
+                                            thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(int(max_pending or env('AUTH_MAX_PENDING', 16)))
+        self._prefix = None
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy('Too many password checks in progress')
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the hash finishes, even if the caller stops waiting
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise PasswordHasherBusy('Timed out waiting for a password check')
+
+    def _hash(self, password):
+        password_hash = generate_password_hash(password, self.method)
+        # The normalized method string, e.g. 'pbkdf2:sha256' becomes 'pbkdf2:sha256:600000'
+        self._prefix = password_hash.split('$', 1)[0]
+        return password_hash
+
+    def _verify(self, password_hash, password):
+        if not check_password_hash(password_hash, password):
+            return False, None
+        if self._prefix is None or password_hash.split('$', 1)[0] != self._prefix:
+            new_hash = self._hash(password)
+            if new_hash.split('$', 1)[0] != password_hash.split('$', 1)[0]:
+                return True, new_hash
+        return True, None
+
+    def hash(self, password):
+        """Return a new hash of password; raises PasswordHasherBusy when overloaded"""
+        return self._run(self._hash, password)
+
+    def verify(self, password_hash, password):
+        """
+        Return (matches, new_hash); new_hash is set when the stored hash uses another scheme
+        or cost than the configured one. Raises PasswordHasherBusy when overloaded.
+        """
+        return self._run(self._verify, password_hash, password)
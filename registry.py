@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Model registry for TomatoHealth
+Every .tflite file in the model directory is a model version (float, float16, int8...);
+the ACTIVE file names the one being served, and every process hot-swaps when it changes.
+
+Usage:
+    python registry.py list
+    python registry.py activate tomato_disease_model_int8
+    python registry.py quantize keras_model.keras --calibration samples/
+    python registry.py evaluate labeled/ --output evaluation.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+
+import numpy as np
+
+from derivatives import write_atomic
+from imaging import load_image, resize_for_model
+from inference import DISEASE_CLASSES, InterpreterPool, TomatoDiseasePredictor, load_runtime
+
+DEFAULT_MODEL_DIR = 'Plant_Disease_Prediction'
+DEFAULT_MODEL = 'tomato_disease_model'
+POINTER_FILE = 'ACTIVE'
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+class ModelRegistry:
+    """
+    The model versions in a directory and the predictor of the active one.
+    Attribute access is forwarded to the active predictor, so the registry is a drop-in
+    predictor; callers that need one consistent model for a whole request use current().
+    A swap loads and warms the new model in the background, then replaces the reference;
+    requests already holding the old predictor finish on it.
+    """
+
+    def __init__(self, directory=None, default_name=None, check_interval=None):
+        self.directory = directory or os.environ.get('MODEL_DIR', DEFAULT_MODEL_DIR)
+        self.default_name = default_name or os.environ.get('MODEL_NAME', DEFAULT_MODEL)
+        if check_interval is None:
+            check_interval = float(os.environ.get('MODEL_CHECK_INTERVAL', 5))
+        self.check_interval = check_interval
+        self._active = None
+        self._loading = None
+        self._failed = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.directory, f"{name}.tflite")
+
+    def variants(self):
+        """Names of every model version in the directory"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(os.path.splitext(name)[0] for name in os.listdir(self.directory)
+                      if name.endswith('.tflite'))
+
+    def active_name(self):
+        """The model named by the pointer file, or the default model"""
+        try:
+            with open(os.path.join(self.directory, POINTER_FILE)) as f:
+                name = f.read().strip()
+        except FileNotFoundError:
+            name = None
+        return name or self.default_name
+
+    def activate(self, name):
+        """Point every process at another model version; they switch within check_interval"""
+        if not os.path.exists(self.path(name)):
+            raise ValueError(f"Unknown model {name}; available: {', '.join(self.variants())}")
+        write_atomic(os.path.join(self.directory, POINTER_FILE), (name + '\n').encode())
+
+    def load(self):
+        """Load the active model in the foreground; returns False when its file is missing"""
+        name = self.active_name()
+        if not os.path.exists(self.path(name)):
+            return False
+        self._active = TomatoDiseasePredictor(self.path(name))
+        self._next_check = time.monotonic() + self.check_interval
+        return True
+
+    def current(self):
+        """The predictor of the active model (starts a background swap if the pointer moved)"""
+        if time.monotonic() >= self._next_check:
+            self._check_pointer()
+        return self._active
+
+    def _check_pointer(self):
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_check:
+                return
+            self._next_check = now + self.check_interval
+            name = self.active_name()
+            if name in (self._active.model_name, self._loading, self._failed):
+                return
+            self._loading = name
+        threading.Thread(target=self._swap, args=(name,), name='model-swap', daemon=True).start()
+
+    def _swap(self, name):
+        try:
+            predictor = TomatoDiseasePredictor(self.path(name))
+            predictor.warm_up()
+        except Exception as e:
+            print(f"Warning: Could not load model {name}, keeping {self._active.model_name}: {e}")
+            with self._lock:
+                self._failed, self._loading = name, None
+            return
+        with self._lock:
+            previous, self._active = self._active, predictor
+            self._failed, self._loading = None, None
+        previous.close()
+        print(f"Switched model from {previous.model_name} to {name} ({predictor.model_version})")
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.current(), name)
+
+
+def quantize(source, output_dir, stem=DEFAULT_MODEL, calibration=None, samples=200, include_float=False):
+    """
+    Convert a Keras or SavedModel source into float16 and int8 TFLite variants.
+    int8 uses full integer quantization calibrated on up to samples images from the
+    calibration folder (float inputs and outputs are kept); without one, weights only.
+    """
+    try:
+        import tensorflow as tf
+    except ImportError:
+        raise SystemExit('Quantization requires tensorflow (pip install tensorflow-cpu)')
+
+    if os.path.isdir(source):
+        def converter():
+            return tf.lite.TFLiteConverter.from_saved_model(source)
+    else:
+        model = tf.keras.models.load_model(source)
+
+        def converter():
+            return tf.lite.TFLiteConverter.from_keras_model(model)
+
+    variants = {}
+    if include_float:
+        variants[stem] = converter()
+
+    float16 = converter()
+    float16.optimizations = [tf.lite.Optimize.DEFAULT]
+    float16.target_spec.supported_types = [tf.float16]
+    variants[f"{stem}_float16"] = float16
+
+    int8 = converter()
+    int8.optimizations = [tf.lite.Optimize.DEFAULT]
+    if calibration:
+        paths = find_images(calibration)[:samples]
+        if not paths:
+            raise SystemExit(f"No calibration images in {calibration}")
+
+        def representative_dataset():
+            for path in paths:
+                yield [resize_for_model(load_image(path))[None].astype(np.float32)]
+
+        int8.representative_dataset = representative_dataset
+        int8.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    else:
+        print('No --calibration folder: the int8 variant quantizes weights only')
+    variants[f"{stem}_int8"] = int8
+
+    os.makedirs(output_dir, exist_ok=True)
+    for name, variant in variants.items():
+        path = os.path.join(output_dir, f"{name}.tflite")
+        write_atomic(path, variant.convert())
+        print(f"Wrote {path} ({os.path.getsize(path) / 1e6:.2f} MB)")
+
+
+def find_images(directory):
+    return sorted(os.path.join(root, name) for root, _, files in os.walk(directory)
+                  for name in files if name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def _normalize(name):
+    return re.sub(r'[^a-z0-9]', '', name.lower())
+
+
+def labeled_images(directory):
+    """
+    Return [(path, class index)] for a folder with one sub-folder per class.
+    Folder names match a class when they end with it, ignoring case and punctuation,
+    so PlantVillage names such as Tomato___Early_blight work as-is.
+    """
+    classes = sorted(((_normalize(name), index) for index, name in enumerate(DISEASE_CLASSES)),
+                     key=lambda item: -len(item[0]))
+    samples = []
+    for folder in sorted(os.listdir(directory)):
+        if not os.path.isdir(os.path.join(directory, folder)):
+            continue
+        label = next((index for key, index in classes if _normalize(folder).endswith(key)), None)
+        if label is None:
+            print(f"Skipping {folder}: not a known class", file=sys.stderr)
+            continue
+        samples.extend((path, label) for path in find_images(os.path.join(directory, folder)))
+    return samples
+
+
+def _rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def evaluate_variant(model_path, samples, threads=1):
+    """Accuracy, single-image latency and memory of one model file (runs in a fresh process)"""
+    inputs = [resize_for_model(load_image(path))[None].astype(np.float32) for path, _ in samples]
+    labels = np.array([label for _, label in samples])
+
+    load_runtime()
+    rss_before = _rss_bytes()
+    pool = InterpreterPool(model_path, size=1, num_threads=threads)
+    pool.warm_up()
+    rss_after = _rss_bytes()
+
+    latencies = []
+    predictions = []
+    for input_batch in inputs:
+        started = time.perf_counter()
+        probs = pool.run(input_batch)[0]
+        latencies.append((time.perf_counter() - started) * 1000)
+        predictions.append(probs)
+    predictions = np.array(predictions)
+
+    return {
+        'model': os.path.splitext(os.path.basename(model_path))[0],
+        'size_mb': os.path.getsize(model_path) / 1e6,
+        'memory_mb': (rss_after - rss_before) / 1e6,
+        'accuracy': float((predictions.argmax(axis=1) == labels).mean()) if len(labels) else None,
+        'p50_ms': float(np.percentile(latencies, 50)) if latencies else None,
+        'p95_ms': float(np.percentile(latencies, 95)) if latencies else None,
+        'predictions': predictions.argmax(axis=1).tolist(),
+    }
+
+
+def evaluate(registry, directory, variants=None, limit=None, threads=1):
+    """Evaluate each model version on a labeled folder; each runs in its own process"""
+    samples = labeled_images(directory)
+    if limit:
+        # Take every n-th image so a subset still covers every class
+        samples = samples[::max(1, len(samples) // limit)][:limit]
+    if not samples:
+        raise SystemExit(f"No labeled images in {directory}")
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for name in variants or registry.variants():
+        with context.Pool(1) as pool:
+            result = pool.apply(evaluate_variant, (registry.path(name), samples, threads))
+        results.append(result)
+
+    # How often each variant agrees with the first (reference) one
+    reference = results[0]['predictions']
+    for result in results:
+        result['agreement'] = float(np.mean(np.array(result.pop('predictions')) == reference))
+    return {'images': len(samples), 'variants': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage TomatoHealth model versions')
+    parser.add_argument('--model-dir', default=None, help=f"Model directory (default: {DEFAULT_MODEL_DIR})")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list', help='List model versions')
+    activate_parser = subparsers.add_parser('activate', help='Switch every process to a model version')
+    activate_parser.add_argument('name')
+    quantize_parser = subparsers.add_parser('quantize', help='Build float16 and int8 variants of a Keras/SavedModel')
+    quantize_parser.add_argument('source', help='.keras/.h5 file or SavedModel directory')
+    quantize_parser.add_argument('--calibration', help='Folder of sample leaf photos for int8 calibration')
+    quantize_parser.add_argument('--samples', type=int, default=200)
+    quantize_parser.add_argument('--stem', default=DEFAULT_MODEL)
+    quantize_parser.add_argument('--include-float', action='store_true', help='Also write the float model')
+    evaluate_parser = subparsers.add_parser('evaluate', help='Accuracy, latency and memory of each version')
+    evaluate_parser.add_argument('directory', help='Folder with one sub-folder of images per class')
+    evaluate_parser.add_argument('--variants', nargs='*', help='Model versions (default: all)')
+    evaluate_parser.add_argument('--limit', type=int, help='Evaluate at most this many images')
+    evaluate_parser.add_argument('--threads', type=int, default=1, help='Interpreter threads')
+    evaluate_parser.add_argument('--output', help='Also write the results as JSON')
+    args = parser.parse_args()
+
+    registry = ModelRegistry(args.model_dir)
+    if args.command == 'list':
+        active = registry.active_name()
+        for name in registry.variants():
+            size = os.path.getsize(registry.path(name)) / 1e6
+            print(f"{'*' if name == active else ' '} {name:<40} {size:8.2f} MB")
+    elif args.command == 'activate':
+        try:
+            registry.activate(args.name)
+        except ValueError as e:
+            raise SystemExit(str(e))
+        print(f"Activated {args.name}; running processes switch within {registry.check_interval:g}s")
+    elif args.command == 'quantize':
+        quantize(args.source, registry.directory, args.stem, args.calibration, args.samples, args.include_float)
+    elif args.command == 'evaluate':
+        results = evaluate(registry, args.directory, args.variants, args.limit, args.threads)
+        print(f"{'model':<40} {'size MB':>8} {'mem MB':>8} {'accuracy':>9} {'agree':>7} {'p50 ms':>8} {'p95 ms':>8}")
+        for row in results['variants']:
+            accuracy = f"{row['accuracy']:.3f}" if row['accuracy'] is not None else '-'
+            print(f"{row['model']:<40} {row['size_mb']:8.2f} {row['memory_mb']:8.1f} {accuracy:>9} "
+                  f"{row['agreement']:7.3f} {row['p50_ms']:8.2f} {row['p95_ms']:8.2f}")
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
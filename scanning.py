@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Video and burst scanning for TomatoHealth
+Frames are decoded one at a time and sampled adaptively. Near-duplicates are dropped by
+perceptual hash, and frames that fail the plant check on a downscaled copy are skipped. The
+rest are classified in fixed-size batches and folded into a timeline of segments, so memory
+use does not depend on the length of the video.
+
+Usage:
+    python scanning.py row12.mp4 --output row12.json
+    python scanning.py burst/*.jpg
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from cache import perceptual_hash
+from imaging import (MIN_EDGE_PERCENTAGE, MIN_GREEN_PERCENTAGE, MODEL_INPUT_SIZE, decode_image,
+                     plant_scores, proxy_image, resize_for_model)
+from inference import DISEASE_CLASSES
+
+VIDEO_EXTENSIONS = {'mp4', 'mov', 'm4v', 'avi', 'mkv', 'webm', '3gp'}
+
+
+def is_video(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in VIDEO_EXTENSIONS
+
+
+class AdaptiveSampler:
+    """
+    Time between sampled frames. It grows while consecutive samples look the same (the scout
+    is standing still) and shrinks as soon as the view changes (the scout is walking).
+    """
+
+    def __init__(self, interval=None, min_interval=None, max_interval=None):
+        env = os.environ.get
+        self.min_interval = float(min_interval or env('SCAN_MIN_INTERVAL', 0.1))
+        self.max_interval = float(max_interval or env('SCAN_MAX_INTERVAL', 2.0))
+        self.interval = float(interval or env('SCAN_INTERVAL', 0.5))
+
+    def update(self, duplicate):
+        if duplicate:
+            self.interval = min(self.max_interval, self.interval * 1.5)
+        else:
+            self.interval = max(self.min_interval, self.interval / 2)
+
+
+class VideoSource:
+    """Sampled (timestamp in seconds, RGB frame) pairs of a video file, decoded as they are read"""
+
+    unit = 'seconds'
+
+    def __init__(self, path, sampler=None, segment_length=None):
+        self.path = path
+        self.sampler = sampler or AdaptiveSampler()
+        self.segment_length = float(segment_length or os.environ.get('SCAN_SEGMENT_SECONDS', 5))
+        self.frames_read = 0
+
+    def __iter__(self):
+        capture = cv2.VideoCapture(self.path)
+        if not capture.isOpened():
+            raise ValueError('Could not open the video; use MP4, MOV, AVI, MKV or WebM')
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        if not fps or fps > 1000:
+            fps = 30.0
+        next_time = 0.0
+        try:
+            # grab() skips frames without converting them; only sampled frames are retrieved
+            while capture.grab():
+                timestamp = self.frames_read / fps
+                self.frames_read += 1
+                if timestamp + 1e-6 < next_time:
+                    continue
+                ok, frame = capture.retrieve()
+                if not ok:
+                    break
+                yield timestamp, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                # The scanner has updated the sampler by the time the generator resumes
+                next_time = timestamp + self.sampler.interval
+        finally:
+            capture.release()
+
+
+class BurstSource:
+    """(frame number, RGB frame) pairs of a burst of images given as (name, bytes) pairs"""
+
+    unit = 'frames'
+
+    def __init__(self, images, segment_length=None):
+        self.images = images
+        self.segment_length = int(segment_length or os.environ.get('SCAN_SEGMENT_FRAMES', 10))
+        self.sampler = None
+        self.frames_read = 0
+
+    def __iter__(self):
+        for _, data in self.images:
+            index = self.frames_read
+            self.frames_read += 1
+            if data is None:
+                continue
+            try:
+                image = decode_image(data)
+            except Exception:
+                continue
+            yield index, image
+
+
+class FrameScanner:
+    """
+    Classifies the frames of a source. predict_batch(batch) must return (N, classes)
+    probabilities. Frames within hash_distance bits of the previous frame kept are
+    duplicates; frames under min_confidence count as unclear.
+    """
+
+    def __init__(self, predict_batch, batch_size=None, hash_distance=None, min_confidence=0.3):
+        env = os.environ.get
+        self.predict_batch = predict_batch
+        self.batch_size = max(1, int(batch_size or env('SCAN_BATCH_SIZE', 16)))
+        self.hash_distance = int(hash_distance if hash_distance is not None else env('SCAN_HASH_DISTANCE', 6))
+        self.min_confidence = min_confidence
+
+    def scan(self, source):
+        """Return a summary with totals, a per-segment timeline and throughput"""
+        started = time.perf_counter()
+        buffer = np.empty((self.batch_size,) + MODEL_INPUT_SIZE[::-1] + (3,), dtype=np.uint8)
+        times = []
+        timeline = {}
+        totals = {'sampled': 0, 'duplicates': 0, 'not_plant': 0, 'analyzed': 0, 'unclear': 0}
+        diseases = {}
+        last_hash = None
+
+        def flush():
+            probabilities = self.predict_batch(buffer[:len(times)])
+            for timestamp, probs in zip(times, probabilities):
+                predicted_class = int(np.argmax(probs))
+                confidence = float(probs[predicted_class])
+                self._record(self._segment(timeline, source.segment_length, timestamp), timestamp,
+                             predicted_class, confidence)
+                totals['analyzed'] += 1
+                if confidence < self.min_confidence:
+                    totals['unclear'] += 1
+                else:
+                    name = DISEASE_CLASSES[predicted_class]
+                    diseases[name] = diseases.get(name, 0) + 1
+            times.clear()
+
+        for timestamp, frame in source:
+            totals['sampled'] += 1
+            self._segment(timeline, source.segment_length, timestamp)['sampled'] += 1
+            proxy = proxy_image(frame)
+            frame_hash = perceptual_hash(proxy)
+            duplicate = last_hash is not None and bin(frame_hash ^ last_hash).count('1') <= self.hash_distance
+            if source.sampler is not None:
+                source.sampler.update(duplicate)
+            if duplicate:
+                totals['duplicates'] += 1
+                continue
+            last_hash = frame_hash
+            green, edges = plant_scores(proxy)
+            if green <= MIN_GREEN_PERCENTAGE or edges <= MIN_EDGE_PERCENTAGE:
+                totals['not_plant'] += 1
+                continue
+            resize_for_model(frame, out=buffer[len(times)])
+            times.append(timestamp)
+            if len(times) == self.batch_size:
+                flush()
+        if times:
+            flush()
+
+        elapsed = time.perf_counter() - started
+        return {
+            'unit': source.unit,
+            'frames_read': source.frames_read,
+            **totals,
+            'diseases': diseases,
+            'timeline': [timeline[key] for key in sorted(timeline)],
+            'seconds': elapsed,
+            'frames_per_second': source.frames_read / elapsed if elapsed else 0.0,
+            'analyzed_per_second': totals['analyzed'] / elapsed if elapsed else 0.0,
+        }
+
+    def _segment(self, timeline, segment_length, timestamp):
+        key = int(timestamp // segment_length)
+        segment = timeline.get(key)
+        if segment is None:
+            segment = timeline[key] = {'start': key * segment_length, 'end': (key + 1) * segment_length,
+                                       'sampled': 0, 'analyzed': 0, 'unclear': 0, 'diseases': {}, 'worst': None}
+        return segment
+
+    def _record(self, segment, timestamp, predicted_class, confidence):
+        segment['analyzed'] += 1
+        if confidence < self.min_confidence:
+            segment['unclear'] += 1
+            return
+        name = DISEASE_CLASSES[predicted_class]
+        segment['diseases'][name] = segment['diseases'].get(name, 0) + 1
+        # The most confident diseased frame, to find the spot again
+        if name != 'Healthy' and (segment['worst'] is None or confidence > segment['worst']['confidence']):
+            segment['worst'] = {'disease': name, 'confidence': confidence * 100, 'at': timestamp}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scan a video or a burst of photos for tomato diseases')
+    parser.add_argument('paths', nargs='+', help='A video file, or image files of one burst')
+    parser.add_argument('--output', help='Also write the summary as JSON')
+    args = parser.parse_args()
+
+    from registry import ModelRegistry
+    registry = ModelRegistry()
+    if not registry.load():
+        raise SystemExit(f"Model file not found: {registry.path(registry.active_name())}")
+    model = registry.current()
+
+    if len(args.paths) == 1 and is_video(args.paths[0]):
+        source = VideoSource(args.paths[0])
+    else:
+        def images():
+            for path in args.paths:
+                with open(path, 'rb') as f:
+                    yield path, f.read()
+        source = BurstSource(images())
+
+    summary = FrameScanner(model.predict_batch).scan(source)
+    for segment in summary['timeline']:
+        found = ', '.join(f"{name} x{count}" for name, count in sorted(segment['diseases'].items(),
+                                                                      key=lambda item: -item[1]))
+        print(f"{segment['start']:8.1f}-{segment['end']:<8.1f} {segment['analyzed']:4d} frames  {found or '-'}")
+    print(f"{summary['frames_read']} frames read, {summary['sampled']} sampled, {summary['duplicates']} duplicates, "
+          f"{summary['not_plant']} without plants, {summary['analyzed']} analyzed in {summary['seconds']:.1f}s "
+          f"({summary['frames_per_second']:.0f} frames/s, {summary['analyzed_per_second']:.1f} analyzed/s)",
+          file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+"""
+Fair-share inference scheduling for TomatoHealth
+Every image a user sends for analysis takes a token from their bucket, and a request that would
+overdraw it is refused. Admitted requests then wait in a bounded queue for one of a fixed number
+of inference slots. The queue is ordered by weighted fair queuing across users, so a user sending
+images in a loop only gets their share of the model. Interactive web requests weigh more than
+bulk API traffic, and some queue places are kept for them.
+"""
+
+import heapq
+import itertools
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import SCHEDULER_WAIT_SECONDS
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+
+def default_slots():
+    """
+    One slot per core of this worker process, and at least two so one request's I/O overlaps
+    another's work. Decoding and validating uploads costs more CPU than the model, so more
+    slots than cores only make every request slower.
+    """
+    workers = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+    return max(2, (os.cpu_count() or 1) // workers)
+
+
+class RateLimited(Exception):
+    """Raised when a user's token bucket is empty; retry_after is in seconds"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limit exceeded, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class SchedulerBusy(Exception):
+    """Raised when the inference queue is full or no slot freed up in time"""
+
+
+class TokenBucket:
+    """Refills at rate tokens per second up to burst; a new bucket is full"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost, now):
+        """
+        Take cost tokens and return 0, or return the seconds until they will be there.
+        A cost larger than burst needs a full bucket and leaves it in debt.
+        """
+        self.refill(now)
+        needed = min(cost, self.burst)
+        if self.tokens < needed:
+            return (needed - self.tokens) / self.rate
+        self.tokens -= cost
+        return 0.0
+
+    def charge(self, cost, now):
+        """Take cost tokens even if that leaves the bucket in debt (for work measured afterwards)"""
+        self.refill(now)
+        self.tokens -= cost
+
+
+class TokenBuckets:
+    """The token buckets of every user in this process; full buckets are dropped when there are many"""
+
+    def __init__(self, rate, burst, clock=time.monotonic, max_users=10000):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.max_users = max_users
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, user_id, now):
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= self.max_users:
+                # Full buckets hold no state a new bucket would not
+                for key in [key for key, old in self._buckets.items()
+                            if old.tokens + (now - old.updated) * old.rate >= old.burst]:
+                    del self._buckets[key]
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst, now)
+        return bucket
+
+    def take(self, user_id, cost, debt=False):
+        """Take cost tokens and return 0, or the seconds until they will be there; debt always takes them"""
+        with self._lock:
+            now = self.clock()
+            bucket = self._bucket(user_id, now)
+            if debt:
+                bucket.charge(cost, now)
+                return 0.0
+            return bucket.take(cost, now)
+
+    def wait(self, user_id, cost=1):
+        """Seconds until cost tokens will be there, without taking them"""
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                return 0.0
+            now = self.clock()
+            bucket.refill(now)
+            return max(0.0, min(cost, self.burst) - bucket.tokens) / self.rate
+
+
+class SharedTokenBuckets:
+    """
+    The same token buckets in a SQLite file, shared by every worker process of a host so that
+    a user's limit does not grow with WEB_CONCURRENCY. Each admission is one short write
+    transaction; the file only holds rate-limit state, so it is not fsynced.
+    """
+
+    def __init__(self, path, rate, burst, max_users=10000):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._local = threading.local()
+        self._connect().execute('CREATE TABLE IF NOT EXISTS buckets '
+                                '(user_id TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+
+    def _connect(self):
+        # One connection per thread and process; SQLite connections are not shareable
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _tokens(self, conn, user_id, now):
+        row = conn.execute('SELECT tokens, updated FROM buckets WHERE user_id = ?', (str(user_id),)).fetchone()
+        if row is None:
+            return self.burst
+        return min(self.burst, row[0] + (now - row[1]) * self.rate)
+
+    def take(self, user_id, cost, debt=False):
+        """Take cost tokens and return 0, or the seconds until they will be there; debt always takes them"""
+        conn = self._connect()
+        # Wall-clock time, since the timestamps are compared across processes
+        now = time.time()
+        wait = 0.0
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            tokens = self._tokens(conn, user_id, now)
+            needed = min(cost, self.burst)
+            if tokens < needed and not debt:
+                wait = (needed - tokens) / self.rate
+            else:
+                conn.execute('INSERT OR REPLACE INTO buckets (user_id, tokens, updated) VALUES (?, ?, ?)',
+                             (str(user_id), tokens - cost, now))
+                if random.random() < 0.01:
+                    self._prune(conn, now)
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return wait
+
+    def _prune(self, conn, now):
+        count = conn.execute('SELECT COUNT(*) FROM buckets').fetchone()[0]
+        if count >= self.max_users:
+            conn.execute('DELETE FROM buckets WHERE tokens + (? - updated) * ? >= ?', (now, self.rate, self.burst))
+
+    def wait(self, user_id, cost=1):
+        """Seconds until cost tokens will be there, without taking them"""
+        tokens = self._tokens(self._connect(), user_id, time.time())
+        return max(0.0, min(cost, self.burst) - tokens) / self.rate
+
+
+class _Waiter:
+    __slots__ = ('event', 'granted', 'cancelled')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+        self.cancelled = False
+
+
+class FairScheduler:
+    """
+    Per-user token buckets in front of `slots` concurrent inference requests.
+
+    Waiting requests are served by self-clocked fair queuing. Each (user, priority) flow
+    stamps its request with a finish tag: the larger of the virtual time and the flow's
+    previous tag, plus cost / weight. The smallest tag gets the next free slot. A user who
+    has just arrived is therefore served after at most a request or so of a user who has
+    been flooding. Bulk requests are refused once the queue holds max_queue -
+    interactive_reserve requests, interactive ones at max_queue.
+
+    The buckets live in this process unless buckets_path names a SQLite file shared by the
+    worker processes; a rate of 0 turns the per-user limit off. Slots and the queue are
+    always per process.
+    """
+
+    def __init__(self, slots=None, max_queue=None, interactive_reserve=None, rate=None, burst=None,
+                 interactive_weight=None, timeout=None, buckets_path=None, clock=time.monotonic):
+        env = os.environ.get
+        self.slots = max(1, int(slots if slots is not None else env('SCHEDULER_SLOTS') or default_slots()))
+        self.max_queue = int(max_queue if max_queue is not None else env('INFERENCE_MAX_QUEUE', 64))
+        self.interactive_reserve = int(interactive_reserve if interactive_reserve is not None
+                                       else env('SCHEDULER_INTERACTIVE_RESERVE', 16))
+        # Images per second a user may send on average, and how many at once; fair queuing alone
+        # does not keep light users' latency flat while one user floods the model
+        self.rate = float(rate if rate is not None else env('USER_RATE', 4))
+        self.burst = float(burst if burst is not None else env('USER_BURST', 20))
+        self.weights = {INTERACTIVE: float(interactive_weight if interactive_weight is not None
+                                           else env('SCHEDULER_INTERACTIVE_WEIGHT', 4)),
+                        BULK: 1.0}
+        self.timeout = float(timeout if timeout is not None else env('SCHEDULER_TIMEOUT', env('BATCH_TIMEOUT', 30)))
+        self.clock = clock
+        self.buckets = None
+        if self.rate > 0:
+            self.buckets = (SharedTokenBuckets(buckets_path, self.rate, self.burst) if buckets_path
+                            else TokenBuckets(self.rate, self.burst, clock))
+        self._lock = threading.Lock()
+        self._queue = []
+        self._tags = {}
+        self._virtual = 0.0
+        self._sequence = itertools.count()
+        # Statistics
+        self.running = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rate_limited = 0
+        self.shed = 0
+
+    def admit(self, user_id, cost=1):
+        """Take cost images from a user's bucket; raises RateLimited when it is empty"""
+        wait = self.buckets.take(user_id, cost) if self.buckets is not None else 0.0
+        with self._lock:
+            if wait:
+                self.rate_limited += 1
+                raise RateLimited(wait)
+            self.admitted += cost
+
+    def charge(self, user_id, cost):
+        """Take images already analyzed from a user's bucket, possibly leaving it in debt"""
+        if self.buckets is not None:
+            self.buckets.take(user_id, cost, debt=True)
+        with self._lock:
+            self.admitted += cost
+
+    def check(self, user_id):
+        """Raise RateLimited when the user's bucket cannot pay for one image, without taking from it"""
+        wait = self.buckets.wait(user_id) if self.buckets is not None else 0.0
+        if wait > 0:
+            with self._lock:
+                self.rate_limited += 1
+            raise RateLimited(wait)
+
+    def _tag(self, user_id, priority, cost):
+        flow = (user_id, priority)
+        finish = max(self._virtual, self._tags.get(flow, 0.0)) + cost / self.weights[priority]
+        self._tags[flow] = finish
+        return finish
+
+    def acquire(self, user_id, priority=INTERACTIVE, cost=1):
+        """
+        Wait for an inference slot, which must then be given back with release().
+        Raises SchedulerBusy when the queue is full or the wait exceeds the timeout.
+        """
+        started = time.perf_counter()
+        with self._lock:
+            if self.running < self.slots and not self.queued:
+                self.running += 1
+                self._tag(user_id, priority, cost)
+                SCHEDULER_WAIT_SECONDS.observe(0.0, priority=priority)
+                return
+            limit = self.max_queue if priority == INTERACTIVE else self.max_queue - self.interactive_reserve
+            if self.queued >= limit:
+                self.shed += 1
+                raise SchedulerBusy('The inference queue is full')
+            waiter = _Waiter()
+            heapq.heappush(self._queue, (self._tag(user_id, priority, cost), next(self._sequence), waiter))
+            self.queued += 1
+
+        waiter.event.wait(self.timeout)
+        with self._lock:
+            if not waiter.granted:
+                waiter.cancelled = True
+                self.queued -= 1
+                self.shed += 1
+                raise SchedulerBusy('Timed out waiting for an inference slot')
+        SCHEDULER_WAIT_SECONDS.observe(time.perf_counter() - started, priority=priority)
+
+    def release(self):
+        """Hand a slot to the waiting request with the smallest finish tag, or free it"""
+        with self._lock:
+            while self._queue:
+                finish, _, waiter = heapq.heappop(self._queue)
+                if waiter.cancelled:
+                    continue
+                self._virtual = finish
+                waiter.granted = True
+                self.queued -= 1
+                waiter.event.set()
+                return
+            self.running -= 1
+            # With nobody waiting every tag is behind the virtual time, so none is needed
+            self._tags.clear()
+
+    @contextmanager
+    def slot(self, user_id, priority=INTERACTIVE, cost=1):
+        self.acquire(user_id, priority, cost)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def saturated(self, priority=INTERACTIVE):
+        """True when a request of this priority would be turned away by acquire()"""
+        limit = self.max_queue if priority == INTERACTIVE else self.max_queue - self.interactive_reserve
+        return self.queued >= limit
+
+    def stats(self):
+        return {'running': self.running, 'queued': self.queued, 'admitted': self.admitted,
+                'rate_limited': self.rate_limited, 'shed': self.shed}
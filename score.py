@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+TomatoHealth bulk scoring
+Runs the same validation and prediction pipeline as the web app over a directory
+(or list) of images, using a process pool and batched inference.
+
+Usage:
+    python score.py archive/ --output results.csv
+    python score.py --file-list photos.txt --output results.jsonl --processes 8
+    python score.py archive/ --output results.parquet --resume
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from adaptive import AdaptiveInference, predict_images
+from inference import DISEASE_CLASSES
+from registry import ModelRegistry
+from validation import LOW_CONFIDENCE_MESSAGE, MIN_CONFIDENCE, Sample, default_cascade
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+FIELDS = ['path', 'status', 'prediction', 'confidence', 'message', 'model_version']
+
+# Loaded in the parent by load_pipeline and inherited by forked workers; processes
+# started with spawn load their own copy in init_worker
+_pipeline = None
+
+
+def load_pipeline():
+    """
+    Load the active model with one single-threaded interpreter per process, the validation
+    cascade and, with ADAPTIVE_INFERENCE=1, the same escalation as the web app.
+    The web app itself is not imported, so workers never touch the database.
+    """
+    global _pipeline
+    os.environ.setdefault('INTERPRETER_POOL_SIZE', '1')
+    os.environ.setdefault('TFLITE_NUM_THREADS', '1')
+    os.environ['INFERENCE_BATCHING'] = '0'
+    registry = ModelRegistry(check_interval=float('inf'))
+    if not registry.load():
+        return None
+    adaptive = AdaptiveInference() if os.environ.get('ADAPTIVE_INFERENCE', '0') == '1' else None
+    _pipeline = (registry.current(), default_cascade(), adaptive)
+    return _pipeline
+
+
+def init_worker():
+    if _pipeline is None:
+        load_pipeline()
+
+
+def score_batch(paths):
+    """Validate and classify a batch of image paths; returns one result row per path"""
+    model, cascade, adaptive = _pipeline
+    rows = {}
+    accepted = []
+    images = []
+    for path in paths:
+        row = {'path': path, 'status': 'rejected', 'prediction': None, 'confidence': None,
+               'message': None, 'model_version': model.model_version}
+        rows[path] = row
+        try:
+            with open(path, 'rb') as f:
+                sample = Sample(data=f.read())
+            is_valid, message, _ = cascade.run(sample)
+            if not is_valid:
+                row['message'] = message
+                continue
+            images.append(sample.image)
+            accepted.append(path)
+        except Exception as e:
+            row['status'] = 'error'
+            row['message'] = str(e)
+
+    if images:
+        for path, (result, _) in zip(accepted, predict_images(model, images, adaptive)):
+            row = rows[path]
+            row['prediction'] = DISEASE_CLASSES[result[0]]
+            row['confidence'] = result[1] * 100
+            if result[1] < MIN_CONFIDENCE:
+                row['message'] = LOW_CONFIDENCE_MESSAGE
+            else:
+                row['status'] = 'ok'
+
+    return [rows[path] for path in paths]
+
+
+def find_images(inputs, file_list=None):
+    """Return the sorted image paths under the given files/directories and in the file list"""
+    paths = []
+    if file_list:
+        with open(file_list) as f:
+            paths.extend(line.strip() for line in f if line.strip())
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                paths.extend(os.path.join(root, name) for name in files
+                             if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            paths.append(item)
+    return sorted(set(paths))
+
+
+class ResultWriter:
+    """Appends result rows to CSV, JSONL or Parquet as batches complete"""
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.format = os.path.splitext(path)[1].lower().lstrip('.')
+        if self.format not in ('csv', 'jsonl', 'parquet'):
+            raise ValueError('Output must end in .csv, .jsonl or .parquet')
+
+        if self.format == 'parquet':
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise SystemExit('Parquet output requires pyarrow (pip install pyarrow)')
+            self.pyarrow = pyarrow
+            # Parquet files cannot be appended to, so a resumed run writes the next part file
+            stem = os.path.splitext(path)[0]
+            part = 0
+            while resume and os.path.exists(f"{stem}.part{part}.parquet" if part else path):
+                part += 1
+            target = f"{stem}.part{part}.parquet" if part else path
+            schema = pyarrow.schema([('path', pyarrow.string()), ('status', pyarrow.string()),
+                                     ('prediction', pyarrow.string()), ('confidence', pyarrow.float64()),
+                                     ('message', pyarrow.string()), ('model_version', pyarrow.string())])
+            self.writer = pyarrow.parquet.ParquetWriter(target, schema)
+        else:
+            append = resume and os.path.exists(path)
+            self.file = open(path, 'a' if append else 'w', newline='')
+            if self.format == 'csv':
+                self.writer = csv.DictWriter(self.file, fieldnames=FIELDS)
+                if not append:
+                    self.writer.writeheader()
+
+    def write(self, rows):
+        if self.format == 'parquet':
+            self.writer.write_table(self.pyarrow.Table.from_pylist(rows, schema=self.writer.schema))
+            return
+        if self.format == 'csv':
+            self.writer.writerows(rows)
+        else:
+            self.file.writelines(json.dumps(row) + '\n' for row in rows)
+        self.file.flush()
+
+    def close(self):
+        if self.format == 'parquet':
+            self.writer.close()
+        else:
+            self.file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score archived leaf photos with the TomatoHealth model')
+    parser.add_argument('inputs', nargs='*', help='Image files or directories (searched recursively)')
+    parser.add_argument('--file-list', help='Text file with one image path per line')
+    parser.add_argument('--output', required=True, help='Result file (.csv, .jsonl or .parquet)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--resume', action='store_true', help='Skip images recorded in the checkpoint')
+    args = parser.parse_args()
+
+    paths = find_images(args.inputs, args.file_list)
+    checkpoint_path = args.output + '.checkpoint'
+    done = set()
+    if args.resume and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            done = {line.rstrip('\n') for line in f}
+    paths = [path for path in paths if path not in done]
+    if not paths:
+        print('Nothing to score.')
+        return
+
+    # A missing model fails here once, instead of in every (respawned) pool worker
+    if load_pipeline() is None:
+        registry = ModelRegistry()
+        raise SystemExit(f"Model file not found: {registry.path(registry.active_name())}")
+
+    batches = [paths[i:i + args.batch_size] for i in range(0, len(paths), args.batch_size)]
+    writer = ResultWriter(args.output, resume=args.resume)
+    checkpoint = open(checkpoint_path, 'a' if args.resume else 'w')
+
+    print(f"Scoring {len(paths)} images ({len(done)} already done) with {args.processes} processes")
+    started = time.perf_counter()
+    last_report = started
+    scored = 0
+    counts = {'ok': 0, 'rejected': 0, 'error': 0}
+    try:
+        with multiprocessing.Pool(args.processes, initializer=init_worker) as pool:
+            for rows in pool.imap_unordered(score_batch, batches):
+                writer.write(rows)
+                # The checkpoint is only advanced once the rows are safely written
+                checkpoint.writelines(row['path'] + '\n' for row in rows)
+                checkpoint.flush()
+
+                scored += len(rows)
+                for row in rows:
+                    counts[row['status']] += 1
+                now = time.perf_counter()
+                if now - last_report >= 5 or scored == len(paths):
+                    rate = scored / (now - started)
+                    print(f"  {scored}/{len(paths)} images, {rate:.1f} images/sec", file=sys.stderr)
+                    last_report = now
+    finally:
+        writer.close()
+        checkpoint.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"Done: {scored} images in {elapsed:.1f}s ({scored / elapsed:.1f} images/sec); "
+          f"{counts['ok']} scored, {counts['rejected']} rejected, {counts['error']} errors")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+"""
+Upload storage for TomatoHealth
+Originals are stored under hash-sharded keys (objects/ab/cd/<filename>) in a local directory or
+an S3-compatible bucket. A retention job moves originals older than a cutoff into append-only
+pack files, each with an index of (filename, start, length); packed originals are read back with
+a range read of the pack, and a local SQLite copy of the indexes makes the lookup one query.
+
+Usage:
+    python storage.py migrate static/uploads --delete
+    python storage.py compact --older-than-days 30 --every 3600
+    python storage.py stats
+"""
+
+import argparse
+import functools
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from werkzeug.security import safe_join
+from werkzeug.utils import secure_filename
+
+from derivatives import is_content_addressed, write_atomic
+
+OBJECTS = 'objects/'
+PACKS = 'packs/'
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS packed (
+    filename TEXT PRIMARY KEY,
+    pack TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS packs (
+    name TEXT PRIMARY KEY,
+    files INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+
+def shard_key(filename):
+    """
+    Key of a loose original. Content-addressed names are sharded by their own hash, older
+    time-stamped names by a hash of the name, so no directory holds more than a sliver of the files.
+    """
+    digest = filename[:64] if is_content_addressed(filename) else hashlib.sha256(filename.encode()).hexdigest()
+    return f"{OBJECTS}{digest[:2]}/{digest[2:4]}/{filename}"
+
+
+class LocalBackend:
+    """Objects as files under a root directory; also the stand-in for an object store in development"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        path = safe_join(self.root, key)
+        if path is None:
+            raise FileNotFoundError(key)
+        return path
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(path, data)
+
+    def put_file(self, key, source):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f, open(source, 'rb') as src:
+                shutil.copyfileobj(src, f, 1024 * 1024)
+                # Originals are deleted once their pack is in place, so it must reach the disk first
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, key):
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+    def get_range(self, key, start, length):
+        with open(self._path(key), 'rb') as f:
+            f.seek(start)
+            return f.read(length)
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix):
+        """(key, size, modified) of every object under a prefix ending in '/'"""
+        top = os.path.join(self.root, prefix)
+        for directory, _, files in os.walk(top):
+            for name in files:
+                if name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield os.path.relpath(path, self.root).replace(os.sep, '/'), stat.st_size, stat.st_mtime
+
+
+class S3Backend:
+    """Objects in an S3-compatible bucket (AWS S3, MinIO, ...); needs boto3"""
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, client=None):
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise RuntimeError('STORAGE_BACKEND=s3 needs boto3 (pip install boto3)')
+            client = boto3.client('s3', endpoint_url=endpoint_url or None)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _missing(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def _get(self, key, **kwargs):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key, **kwargs)['Body'].read()
+        except self.client.exceptions.ClientError as e:
+            if self._missing(e):
+                raise FileNotFoundError(key)
+            raise
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+
+    def put_file(self, key, source):
+        # Multipart for large packs
+        self.client.upload_file(source, self.bucket, self.prefix + key)
+
+    def get(self, key):
+        return self._get(key)
+
+    def get_range(self, key, start, length):
+        return self._get(key, Range=f"bytes={start}-{start + length - 1}")
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+            return True
+        except self.client.exceptions.ClientError as e:
+            if self._missing(e):
+                return False
+            raise
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def list(self, prefix):
+        """(key, size, modified) of every object under a prefix ending in '/'"""
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            for item in page.get('Contents', []):
+                yield item['Key'][len(self.prefix):], item['Size'], item['LastModified'].timestamp()
+
+
+class PackWriter:
+    """Originals appended to a local temporary file, stored as one pack object when sealed"""
+
+    def __init__(self):
+        self.name = f"{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+        self.file = tempfile.NamedTemporaryFile(prefix='pack-', suffix='.pack', delete=False)
+        self.entries = []
+        # Called once the pack and its index are stored, to remove the loose copies
+        self.cleanups = []
+        self.size = 0
+
+    def append(self, filename, data, cleanup=None):
+        self.file.write(data)
+        self.entries.append((filename, self.size, len(data)))
+        self.size += len(data)
+        if cleanup is not None:
+            self.cleanups.append(cleanup)
+
+    def index(self):
+        return ''.join(json.dumps({'filename': filename, 'start': start, 'length': length}) + '\n'
+                       for filename, start, length in self.entries).encode()
+
+    def close(self):
+        self.file.close()
+        try:
+            os.unlink(self.file.name)
+        except FileNotFoundError:
+            pass
+
+
+class UploadStore:
+    """
+    Originals of uploads by filename. New uploads are written as loose objects; compact()
+    moves old ones into packs. Reads try the loose object, then the pack index, then the
+    flat folder of older releases (legacy_folder) until it has been migrated.
+    """
+
+    def __init__(self, backend, index_path, legacy_folder=None, retention_days=30,
+                 pack_bytes=256 * 1024 * 1024, refresh_interval=30, miss_refresh_interval=5):
+        self.backend = backend
+        self.index_path = index_path
+        self.legacy_folder = legacy_folder
+        self.retention_days = retention_days
+        self.pack_bytes = pack_bytes
+        # Packs written by other hosts are picked up at most this often, on a lookup miss
+        self.refresh_interval = refresh_interval
+        # ...or this often when a read finds an upload nowhere. Upload URLs need no login, so
+        # requests for made-up names must not list the packs every time
+        self.miss_refresh_interval = miss_refresh_interval
+        self._refreshed = None
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(INDEX_SCHEMA)
+
+    def _connect(self):
+        # One connection per thread and process; SQLite connections are not shareable
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def key(self, filename):
+        # Upload names come from secure_filename; anything else could escape the store
+        if not filename or secure_filename(filename) != filename:
+            raise FileNotFoundError(filename)
+        return shard_key(filename)
+
+    def _lookup(self, filename, force=False):
+        query = 'SELECT pack, start, length FROM packed WHERE filename = ?'
+        row = self._connect().execute(query, (filename,)).fetchone()
+        if row is None and self.refresh_index(force):
+            row = self._connect().execute(query, (filename,)).fetchone()
+        return row
+
+    def _legacy_path(self, filename):
+        if not self.legacy_folder:
+            return None
+        path = safe_join(self.legacy_folder, filename)
+        return path if path is not None and os.path.isfile(path) else None
+
+    def _stored(self, filename):
+        return self.backend.exists(self.key(filename)) or self._lookup(filename) is not None
+
+    def exists(self, filename):
+        try:
+            return self._stored(filename) or self._legacy_path(filename) is not None
+        except FileNotFoundError:
+            return False
+
+    def put(self, filename, data):
+        """Store an original unless it is already stored; returns whether it was written"""
+        if self.exists(filename):
+            return False
+        self.backend.put(self.key(filename), data)
+        return True
+
+    def get(self, filename):
+        """Bytes of an original. Raises FileNotFoundError if there is no such upload."""
+        key = self.key(filename)
+        try:
+            return self.backend.get(key)
+        except FileNotFoundError:
+            # Possibly compacted since; fall through to the pack index
+            pass
+        row = self._lookup(filename)
+        if row is not None:
+            pack, start, length = row
+            return self.backend.get_range(f"{PACKS}{pack}.pack", start, length)
+        path = self._legacy_path(filename)
+        if path is not None:
+            with open(path, 'rb') as f:
+                return f.read()
+        # The loose copy may have been compacted by another host since the refresh above
+        row = self._lookup(filename, force=True)
+        if row is None:
+            raise FileNotFoundError(filename)
+        pack, start, length = row
+        return self.backend.get_range(f"{PACKS}{pack}.pack", start, length)
+
+    def refresh_index(self, force=False):
+        """
+        Load the indexes of packs not yet in the local index; returns how many were loaded.
+        Refreshes at most every refresh_interval seconds, or miss_refresh_interval with force.
+        """
+        now = time.monotonic()
+        interval = self.miss_refresh_interval if force else self.refresh_interval
+        if self._refreshed is not None and now - self._refreshed < interval:
+            return 0
+        self._refreshed = now
+        conn = self._connect()
+        known = {row[0] for row in conn.execute('SELECT name FROM packs')}
+        loaded = 0
+        for key, _, _ in self.backend.list(PACKS):
+            name = key[len(PACKS):]
+            if not name.endswith('.idx') or name[:-4] in known:
+                continue
+            try:
+                lines = self.backend.get(key).decode().splitlines()
+            except FileNotFoundError:
+                continue
+            entries = [json.loads(line) for line in lines if line]
+            self._record(name[:-4], [(entry['filename'], entry['start'], entry['length']) for entry in entries])
+            loaded += 1
+        return loaded
+
+    def _record(self, pack, entries):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('INSERT OR REPLACE INTO packed (filename, pack, start, length) VALUES (?, ?, ?, ?)',
+                             [(filename, pack, start, length) for filename, start, length in entries])
+            conn.execute('INSERT OR REPLACE INTO packs (name, files, bytes, created_at) VALUES (?, ?, ?, ?)',
+                         (pack, len(entries), sum(length for _, _, length in entries), time.time()))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _seal(self, writer, stats):
+        writer.file.flush()
+        try:
+            # The pack goes first and the index second, so an index never points into a missing pack
+            self.backend.put_file(f"{PACKS}{writer.name}.pack", writer.file.name)
+            self.backend.put(f"{PACKS}{writer.name}.idx", writer.index())
+            self._record(writer.name, writer.entries)
+        finally:
+            writer.close()
+        for cleanup in writer.cleanups:
+            cleanup()
+        stats['packs'] += 1
+        stats['files'] += len(writer.entries)
+        stats['bytes'] += writer.size
+
+    def _write_packs(self, items, pack_bytes=None):
+        # items yields (filename, data, cleanup); packs are sealed once they reach pack_bytes
+        pack_bytes = pack_bytes or self.pack_bytes
+        stats = {'packs': 0, 'files': 0, 'bytes': 0}
+        writer = None
+        try:
+            for filename, data, cleanup in items:
+                if writer is None:
+                    writer = PackWriter()
+                writer.append(filename, data, cleanup)
+                if writer.size >= pack_bytes:
+                    current, writer = writer, None
+                    self._seal(current, stats)
+            if writer is not None:
+                current, writer = writer, None
+                self._seal(current, stats)
+        finally:
+            if writer is not None:
+                writer.close()
+        return stats
+
+    def compact(self, older_than_days=None, pack_bytes=None):
+        """Move loose originals last modified more than older_than_days ago into packs"""
+        days = self.retention_days if older_than_days is None else older_than_days
+        cutoff = time.time() - days * 86400
+
+        def old_objects():
+            for key, _, modified in self.backend.list(OBJECTS):
+                if modified >= cutoff:
+                    continue
+                filename = key.rsplit('/', 1)[1]
+                if self._lookup(filename) is not None:
+                    # Packed by an earlier run that stopped before removing the loose copy
+                    self.backend.delete(key)
+                    continue
+                try:
+                    data = self.backend.get(key)
+                except FileNotFoundError:
+                    continue
+                yield filename, data, functools.partial(self.backend.delete, key)
+
+        return self._write_packs(old_objects(), pack_bytes)
+
+    def migrate(self, source, delete=False, older_than_days=None, pack_bytes=None):
+        """
+        Move the flat upload folder of older releases into the store. Files older than the
+        retention period go straight into packs, the rest become loose objects. Files whose
+        names are not upload names are never stored or deleted, only counted as unsafe.
+        """
+        days = self.retention_days if older_than_days is None else older_than_days
+        cutoff = time.time() - days * 86400
+        counts = {'loose': 0, 'skipped': 0, 'unsafe': 0}
+
+        def remove(path):
+            if delete:
+                os.unlink(path)
+
+        def files():
+            for entry in os.scandir(source):
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                if secure_filename(entry.name) != entry.name:
+                    # No upload could have been saved under this name; left in place for a person to look at
+                    counts['unsafe'] += 1
+                    continue
+                if self._stored(entry.name):
+                    counts['skipped'] += 1
+                    remove(entry.path)
+                    continue
+                with open(entry.path, 'rb') as f:
+                    data = f.read()
+                if entry.stat().st_mtime < cutoff:
+                    yield entry.name, data, functools.partial(remove, entry.path)
+                else:
+                    self.backend.put(self.key(entry.name), data)
+                    counts['loose'] += 1
+                    remove(entry.path)
+
+        stats = self._write_packs(files(), pack_bytes)
+        return {**counts, **stats}
+
+    def stats(self, count_loose=True):
+        conn = self._connect()
+        packs, packed, packed_bytes = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(files), 0), COALESCE(SUM(bytes), 0) FROM packs'
+        ).fetchone()
+        stats = {'packs': packs, 'packed_files': packed, 'packed_bytes': packed_bytes}
+        if count_loose:
+            loose = [size for _, size, _ in self.backend.list(OBJECTS)]
+            stats.update(loose_files=len(loose), loose_bytes=sum(loose))
+        return stats
+
+
+def storage_from_env(instance_path=None, legacy_folder=None):
+    """The upload store configured by the STORAGE_* environment variables"""
+    env = os.environ.get
+    instance_path = instance_path or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
+    os.makedirs(instance_path, exist_ok=True)
+    kind = env('STORAGE_BACKEND', 'local')
+    if kind == 's3':
+        backend = S3Backend(env('STORAGE_BUCKET'), env('STORAGE_PREFIX', ''), env('STORAGE_ENDPOINT_URL'))
+    elif kind == 'local':
+        backend = LocalBackend(env('STORAGE_ROOT', os.path.join(instance_path, 'uploads')))
+    else:
+        raise ValueError(f"Unknown STORAGE_BACKEND: {kind}")
+    return UploadStore(
+        backend,
+        env('STORAGE_INDEX_PATH', os.path.join(instance_path, 'upload_index.db')),
+        legacy_folder=legacy_folder,
+        retention_days=float(env('STORAGE_RETENTION_DAYS', 30)),
+        pack_bytes=int(env('STORAGE_PACK_BYTES', 256 * 1024 * 1024)),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TomatoHealth upload storage')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser('migrate', help='Move a flat upload folder into the store')
+    migrate_parser.add_argument('source', nargs='?', default='static/uploads')
+    migrate_parser.add_argument('--delete', action='store_true', help='Remove each file once it is stored')
+    migrate_parser.add_argument('--older-than-days', type=float, help='Pack files older than this')
+    compact_parser = subparsers.add_parser('compact', help='Move old originals into pack files')
+    compact_parser.add_argument('--older-than-days', type=float)
+    compact_parser.add_argument('--pack-bytes', type=int)
+    compact_parser.add_argument('--every', type=float, help='Keep running, compacting every N seconds')
+    subparsers.add_parser('stats', help='Loose and packed originals')
+    args = parser.parse_args()
+
+    store = storage_from_env()
+    if args.command == 'migrate':
+        result = store.migrate(args.source, args.delete, args.older_than_days)
+        print(f"{result['loose']} files stored, {result['files']} packed into {result['packs']} packs, "
+              f"{result['skipped']} already stored")
+        if result['unsafe']:
+            print(f"{result['unsafe']} files with names that are not upload names were left in {args.source}",
+                  file=sys.stderr)
+    elif args.command == 'compact':
+        while True:
+            started = time.monotonic()
+            result = store.compact(args.older_than_days, args.pack_bytes)
+            print(f"Packed {result['files']} originals ({result['bytes'] / 1e6:.1f} MB) into {result['packs']} packs "
+                  f"in {time.monotonic() - started:.1f}s", file=sys.stderr)
+            if not args.every:
+                break
+            time.sleep(args.every)
+    else:
+        stats = store.stats()
+        print(f"{stats['loose_files']} loose originals ({stats['loose_bytes'] / 1e6:.1f} MB), "
+              f"{stats['packed_files']} in {stats['packs']} packs ({stats['packed_bytes'] / 1e6:.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import io
+import os
+import sys
+import uuid
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class StubPredictor:
+    """Stands in for the model registry: every image gets the class `predicted_class`"""
+
+    model_name = 'stub'
+    model_version = 'stub'
+    embedding_size = None
+    engine = None
+
+    def __init__(self, predicted_class=1, confidence=0.9, error=None):
+        self.predicted_class = predicted_class
+        self.confidence = confidence
+        self.error = error
+        self.calls = 0
+
+    def current(self):
+        return self
+
+    def predict(self, image, with_embedding=False):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        probs = np.full(10, (1 - self.confidence) / 9, dtype=np.float32)
+        probs[self.predicted_class] = self.confidence
+        result = (self.predicted_class, self.confidence, probs)
+        return (result, None) if with_embedding else result
+
+
+def leaf_jpeg(size=(320, 240), seed=0):
+    """A textured green leaf on soil that passes the upload validation cascade"""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    image = Image.new('RGB', size, (96, 72, 48))
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((width * 0.1, height * 0.2, width * 0.9, height * 0.8), fill=(60, 150, 50))
+    for i in range(12):
+        draw.line((width / 2, height / 2, width * (0.1 + 0.07 * i), height * 0.25), fill=(110, 190, 90), width=2)
+    pixels = np.asarray(image).astype(np.int16) + rng.integers(0, 24, (height, width, 3))
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """The web app with its database, queues and uploads in a temporary directory"""
+    workdir = tmp_path_factory.mktemp('app')
+    os.environ.update({
+        'DATABASE_URL': f"sqlite:///{workdir / 'app.db'}",
+        'JOB_QUEUE_PATH': str(workdir / 'jobs.db'),
+        'RATE_LIMIT_PATH': str(workdir / 'rate_limits.db'),
+        'STORAGE_BACKEND': 'local',
+        'STORAGE_ROOT': str(workdir / 'uploads'),
+        'STORAGE_INDEX_PATH': str(workdir / 'upload_index.db'),
+        'PREDICTION_CACHE_SIZE': '0',
+    })
+    import app
+    return app
+
+
+@pytest.fixture
+def client(app_module, monkeypatch):
+    """A test client logged in as a fresh user, with the model replaced by a StubPredictor"""
+    monkeypatch.setattr(app_module, 'predictor', StubPredictor())
+    with app_module.app.app_context():
+        username = f"user-{uuid.uuid4().hex[:8]}"
+        user = app_module.User(username=username, email=f"{username}@example.com")
+        user.set_password('password')
+        app_module.db.session.add(user)
+        app_module.db.session.commit()
+        user_id = user.id
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    return client
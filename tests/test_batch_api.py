@@ -0,0 +1,105 @@
+import io
+import json
+import zipfile
+
+from PIL import Image
+
+from conftest import StubPredictor, leaf_jpeg
+
+
+def post_batch(client, files):
+    return client.post('/api/v1/predict/batch', data={'files': files}, content_type='multipart/form-data')
+
+
+def lines(response):
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def zip_bytes(entries):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in entries.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def test_batch_streams_one_line_per_image_then_a_summary(client):
+    response = post_batch(client, [(io.BytesIO(leaf_jpeg(seed=0)), 'a.jpg'),
+                                   (io.BytesIO(leaf_jpeg(seed=1)), 'b.jpg')])
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    results = lines(response)
+    assert sorted(line['index'] for line in results[:-1]) == [0, 1]
+    assert all(line['status'] == 'ok' and line['prediction'] == 'Early blight' for line in results[:-1])
+    assert results[0]['top_k'][0]['disease'] == 'Early blight'
+    assert results[-1] == {'status': 'done', 'total': 2, 'succeeded': 2}
+
+
+def test_batch_reports_errors_per_image(client):
+    blank = io.BytesIO()
+    Image.new('RGB', (320, 240), (128, 128, 128)).save(blank, 'JPEG')
+    response = post_batch(client, [(io.BytesIO(b'not an image'), 'notes.txt'),
+                                   (io.BytesIO(blank.getvalue()), 'wall.jpg'),
+                                   (io.BytesIO(leaf_jpeg()), 'leaf.jpg')])
+
+    by_name = {line['filename']: line for line in lines(response)[:-1]}
+    assert by_name['notes.txt'] == {'index': 0, 'filename': 'notes.txt', 'status': 'rejected',
+                                    'error': 'Invalid file type'}
+    assert by_name['wall.jpg']['status'] == 'rejected'
+    assert by_name['leaf.jpg']['status'] == 'ok'
+    assert lines(response)[-1]['succeeded'] == 1
+
+
+def test_batch_reports_model_errors_per_image(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'predictor', StubPredictor(error=RuntimeError('model crashed')))
+    response = post_batch(client, [(io.BytesIO(leaf_jpeg()), 'leaf.jpg')])
+
+    first, summary = lines(response)
+    assert first['status'] == 'rejected'
+    assert first['error'] == 'Error processing image: model crashed'
+    assert summary['succeeded'] == 0
+
+
+def test_batch_expands_zip_archives(client):
+    archive = zip_bytes({'field/a.jpg': leaf_jpeg(seed=0), 'field/b.jpg': leaf_jpeg(seed=1),
+                         'field/readme.txt': b'skipped'})
+    response = post_batch(client, [(io.BytesIO(archive), 'field.zip')])
+
+    results = lines(response)
+    assert sorted(line['filename'] for line in results[:-1]) == ['a.jpg', 'b.jpg']
+    assert results[-1]['succeeded'] == 2
+
+
+def test_zip_expanding_beyond_the_batch_limit_is_refused(client, app_module, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'MAX_BATCH_CONTENT_LENGTH', 64 * 1024)
+    # Compresses to a few hundred bytes, expands to 200 KB
+    archive = zip_bytes({f"{i}.jpg": b'\0' * 50 * 1024 for i in range(4)})
+
+    response = post_batch(client, [(io.BytesIO(archive), 'bomb.zip')])
+
+    assert response.status_code == 413
+    assert 'expands beyond' in response.get_json()['error']
+
+
+def test_zip_entry_over_the_single_upload_limit_is_rejected(client, app_module, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'MAX_CONTENT_LENGTH', 1024)
+    archive = zip_bytes({'big.jpg': b'\0' * 4096})
+
+    response = post_batch(client, [(io.BytesIO(archive), 'big.zip')])
+
+    first, summary = lines(response)
+    assert first['status'] == 'rejected' and first['error'] == 'File too large'
+    assert summary == {'status': 'done', 'total': 1, 'succeeded': 0}
+
+
+def test_invalid_zip_is_a_bad_request(client):
+    response = post_batch(client, [(io.BytesIO(b'PK not really'), 'broken.zip')])
+
+    assert response.status_code == 400
+
+
+def test_batch_requires_login(app_module):
+    response = app_module.app.test_client().post('/api/v1/predict/batch')
+
+    assert response.status_code in (302, 401)
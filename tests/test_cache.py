@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import cache
+from cache import DatabaseCacheStore, PredictionCache, TTLCache, content_key
+
+
+class Clock:
+    def __init__(self, monkeypatch):
+        self.now = 1000.0
+        monkeypatch.setattr(cache.time, 'monotonic', lambda: self.now)
+
+
+class DictStore:
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, probabilities):
+        self.entries[key] = probabilities
+
+
+def probs(predicted_class):
+    values = np.full(4, 0.1, dtype=np.float32)
+    values[predicted_class] = 0.7
+    return values
+
+
+def test_content_key_depends_on_bytes_and_model_version():
+    assert content_key(b'leaf', 'v1') == content_key(b'leaf', 'v1')
+    assert content_key(b'leaf', 'v1') != content_key(b'leaf', 'v2')
+    assert content_key(b'leaf', 'v1') != content_key(b'other', 'v1')
+
+
+def test_get_returns_class_confidence_and_probabilities():
+    prediction_cache = PredictionCache()
+    prediction_cache.put('a', probs(2))
+
+    predicted_class, confidence, probabilities = prediction_cache.get('a')
+
+    assert predicted_class == 2
+    assert confidence == pytest.approx(0.7)
+    assert probabilities.tolist() == probs(2).tolist()
+    assert prediction_cache.get('missing') is None
+    assert prediction_cache.stats()['hits'] == 1 and prediction_cache.stats()['misses'] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    prediction_cache = PredictionCache(max_entries=2)
+    prediction_cache.put('a', probs(0))
+    prediction_cache.put('b', probs(1))
+    prediction_cache.get('a')
+    prediction_cache.put('c', probs(2))
+
+    assert prediction_cache.get('b') is None
+    assert prediction_cache.get('a')[0] == 0
+    assert prediction_cache.get('c')[0] == 2
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = Clock(monkeypatch)
+    prediction_cache = PredictionCache(ttl=60)
+    prediction_cache.put('a', probs(1))
+
+    clock.now += 60
+    assert prediction_cache.get('a') is not None
+    clock.now += 1
+    assert prediction_cache.get('a') is None
+    assert prediction_cache.stats()['entries'] == 0
+
+
+def test_misses_fall_through_to_the_store_and_are_kept_locally():
+    store = DictStore()
+    store.put('a', probs(3))
+    prediction_cache = PredictionCache(store=store)
+
+    assert prediction_cache.get('a')[0] == 3
+    del store.entries['a']
+    assert prediction_cache.get('a')[0] == 3
+    stats = prediction_cache.stats()
+    assert (stats['store_hits'], stats['hits'], stats['misses']) == (1, 1, 0)
+
+
+def test_put_persists_to_the_store_unless_told_not_to():
+    store = DictStore()
+    prediction_cache = PredictionCache(store=store)
+    prediction_cache.put('a', probs(0))
+    prediction_cache.put('b', probs(1), persist=False)
+
+    assert list(store.entries) == ['a']
+
+
+def test_ttl_cache_expires_and_invalidates(monkeypatch):
+    clock = Clock(monkeypatch)
+    ttl_cache = TTLCache(max_entries=2, ttl=10)
+    ttl_cache.put('a', 1)
+    ttl_cache.put('b', 2)
+    ttl_cache.invalidate('b')
+
+    assert ttl_cache.get('a') == 1
+    assert ttl_cache.get('b') is None
+    clock.now += 11
+    assert ttl_cache.get('a') is None
+
+
+def test_database_store_writes_behind_and_ignores_expired_rows(app_module):
+    app, db, model = app_module.app, app_module.db, app_module.CachedPrediction
+    store = DatabaseCacheStore(app, db, model, ttl=60, max_latency_ms=0)
+    store.put('fresh', probs(1))
+    store.writer.add(('stale', '[0.1, 0.9]', datetime.utcnow() - timedelta(seconds=120)))
+    assert store.writer.drain(timeout=5)
+
+    with app.app_context():
+        assert store.get('fresh').tolist() == probs(1).tolist()
+        assert store.get('stale') is None
+        assert store.get('missing') is None
+    store.writer.close()
@@ -0,0 +1,116 @@
+import threading
+
+import numpy as np
+import pytest
+
+from inference import BatchingEngine, BatchTimeout
+
+CLASSES = 4
+
+
+class StubModel:
+    """predict_batch that classifies an image as the value it is filled with"""
+
+    def __init__(self):
+        self.shapes = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def __call__(self, batch, embeddings=False):
+        self.gate.wait()
+        self.shapes.append(batch.shape)
+        probs = np.eye(CLASSES, dtype=np.float32)[batch[:, 0, 0, 0].astype(int) % CLASSES]
+        return probs, batch.reshape(len(batch), -1).copy()
+
+
+def image(value):
+    return np.full((2, 2, 3), value, dtype=np.uint8)
+
+
+def submit_all(engine, values, **kwargs):
+    results = [None] * len(values)
+
+    def run(i, value):
+        results[i] = engine.submit(image(value), **kwargs)
+
+    threads = [threading.Thread(target=run, args=(i, value)) for i, value in enumerate(values)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_requests_share_fixed_size_batches():
+    model = StubModel()
+    model.gate.clear()
+    engine = BatchingEngine(model, max_batch_size=4, max_wait_ms=50)
+    values = [0, 1, 2, 3, 1, 2]
+    threading.Timer(0.1, model.gate.set).start()
+
+    results = submit_all(engine, values, with_embedding=True)
+
+    assert [result[0] for result, _ in results] == [value % CLASSES for value in values]
+    assert all(embedding.tolist() == [value] * 12 for (_, embedding), value in zip(results, values))
+    # Batches are padded to a power of two
+    assert {shape[0] for shape in model.shapes} <= {1, 2, 4}
+    assert all(shape[1:] == (2, 2, 3) for shape in model.shapes)
+    stats = engine.stats()
+    assert stats['requests'] == 6
+    assert stats['batches'] < 6
+    engine.close()
+
+
+def test_single_request_runs_alone():
+    model = StubModel()
+    engine = BatchingEngine(model, max_batch_size=8, max_wait_ms=0)
+
+    predicted_class, confidence, probs = engine.submit(image(2))
+
+    assert (predicted_class, confidence) == (2, 1.0)
+    assert probs.shape == (CLASSES,)
+    assert model.shapes == [(1, 2, 2, 3)]
+    engine.close()
+
+
+def test_batches_are_padded_to_a_power_of_two():
+    engine = BatchingEngine(StubModel(), max_batch_size=8)
+
+    assert [engine.padded_size(size) for size in range(1, 9)] == [1, 2, 4, 4, 8, 8, 8, 8]
+    assert BatchingEngine(StubModel(), max_batch_size=6).padded_size(5) == 6
+
+
+def test_submit_times_out_when_the_model_does_not_answer():
+    model = StubModel()
+    model.gate.clear()
+    engine = BatchingEngine(model, max_batch_size=2, max_wait_ms=0)
+
+    with pytest.raises(BatchTimeout):
+        engine.submit(image(1), timeout=0.05)
+
+    assert engine.stats()['timeouts'] == 1
+    model.gate.set()
+    engine.close()
+
+
+def test_model_errors_reach_every_request_of_the_batch():
+    def failing(batch, embeddings=False):
+        raise ValueError('bad model')
+
+    engine = BatchingEngine(failing, max_batch_size=4, max_wait_ms=50)
+    errors = []
+
+    def run():
+        try:
+            engine.submit(image(1))
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 3 and all(str(e) == 'bad model' for e in errors)
+    engine.close()
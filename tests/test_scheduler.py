@@ -0,0 +1,159 @@
+import threading
+import time
+
+import pytest
+
+from scheduler import BULK, INTERACTIVE, FairScheduler, RateLimited, SchedulerBusy, TokenBucket, TokenBuckets
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.001)
+
+
+def queue_request(scheduler, user_id, priority, grants, errors=None):
+    """Start a request that waits for a slot and records its user once granted"""
+    queued = scheduler.queued
+
+    def run():
+        try:
+            scheduler.acquire(user_id, priority)
+        except SchedulerBusy as e:
+            if errors is None:
+                raise
+            errors.append((user_id, e))
+            return
+        grants.append(user_id)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    wait_until(lambda: scheduler.queued > queued or (errors and errors[-1][0] == user_id))
+    return thread
+
+
+def release_next(scheduler, grants):
+    count = len(grants)
+    scheduler.release()
+    wait_until(lambda: len(grants) > count)
+
+
+def test_token_bucket_waits_until_tokens_refill():
+    bucket = TokenBucket(rate=1, burst=5, now=0)
+
+    assert bucket.take(3, now=0) == 0
+    assert bucket.take(3, now=0) == pytest.approx(1.0)
+    assert bucket.take(3, now=1) == 0
+
+
+def test_token_bucket_cost_above_burst_needs_a_full_bucket_and_leaves_debt():
+    bucket = TokenBucket(rate=1, burst=5, now=0)
+    bucket.take(1, now=0)
+
+    assert bucket.take(10, now=0) == pytest.approx(1.0)
+    assert bucket.take(10, now=1) == 0
+    assert bucket.tokens == -5
+    assert bucket.take(1, now=1) == pytest.approx(6.0)
+
+
+def test_token_buckets_are_per_user():
+    clock = Clock()
+    buckets = TokenBuckets(rate=1, burst=2, clock=clock)
+
+    assert buckets.take('a', 2) == 0
+    assert buckets.take('a', 1) == pytest.approx(1.0)
+    assert buckets.take('b', 1) == 0
+    assert buckets.wait('a') == pytest.approx(1.0)
+    clock.now = 1
+    assert buckets.wait('a') == 0
+
+
+def test_admit_raises_rate_limited_with_retry_after():
+    clock = Clock()
+    scheduler = FairScheduler(slots=1, rate=1, burst=2, clock=clock)
+    scheduler.admit('a', 2)
+
+    with pytest.raises(RateLimited) as info:
+        scheduler.admit('a')
+    assert info.value.retry_after == pytest.approx(1.0)
+    assert scheduler.stats()['rate_limited'] == 1
+
+
+def test_rate_limit_is_on_by_default(monkeypatch):
+    monkeypatch.delenv('USER_RATE', raising=False)
+    monkeypatch.delenv('USER_BURST', raising=False)
+    scheduler = FairScheduler(slots=1)
+
+    assert (scheduler.rate, scheduler.burst) == (4, 20)
+    scheduler.admit('a', 20)
+    with pytest.raises(RateLimited):
+        scheduler.admit('a')
+
+
+def test_rate_zero_turns_the_limit_off():
+    scheduler = FairScheduler(slots=1, rate=0)
+
+    assert scheduler.buckets is None
+    for _ in range(1000):
+        scheduler.admit('a')
+
+
+def test_waiting_requests_are_served_by_finish_tag():
+    scheduler = FairScheduler(slots=1, rate=0, interactive_weight=4)
+    scheduler.acquire('holder', BULK)
+    grants = []
+    for _ in range(3):
+        queue_request(scheduler, 'heavy', BULK, grants)
+    queue_request(scheduler, 'light', BULK, grants)
+    queue_request(scheduler, 'web', INTERACTIVE, grants)
+
+    for _ in range(5):
+        release_next(scheduler, grants)
+
+    # The web upload weighs four times more, and the light user only waits behind one heavy request
+    assert grants == ['web', 'heavy', 'light', 'heavy', 'heavy']
+    scheduler.release()
+    assert scheduler.stats()['running'] == 0
+
+
+def test_release_skips_cancelled_waiters():
+    scheduler = FairScheduler(slots=1, rate=0, timeout=0.05)
+    scheduler.acquire('holder')
+    errors = []
+    queue_request(scheduler, 'late', INTERACTIVE, [], errors).join()
+
+    assert isinstance(errors[0][1], SchedulerBusy)
+    assert scheduler.queued == 0
+    scheduler.release()
+    assert scheduler.running == 0
+    scheduler.acquire('next')
+    assert scheduler.running == 1
+
+
+def test_interactive_reserve_is_kept_from_bulk_requests():
+    scheduler = FairScheduler(slots=1, max_queue=2, interactive_reserve=1, rate=0)
+    scheduler.acquire('holder')
+    grants = []
+    queue_request(scheduler, 'bulk', BULK, grants)
+
+    assert scheduler.saturated(BULK)
+    assert not scheduler.saturated(INTERACTIVE)
+    with pytest.raises(SchedulerBusy):
+        scheduler.acquire('bulk2', BULK)
+    queue_request(scheduler, 'web', INTERACTIVE, grants)
+    with pytest.raises(SchedulerBusy):
+        scheduler.acquire('web2', INTERACTIVE)
+    assert scheduler.stats()['shed'] == 2
+
+    release_next(scheduler, grants)
+    release_next(scheduler, grants)
+    assert sorted(grants) == ['bulk', 'web']
@@ -0,0 +1,118 @@
+import os
+import time
+
+import pytest
+
+from storage import LocalBackend, UploadStore, shard_key
+
+
+def make_store(tmp_path, **kwargs):
+    return UploadStore(LocalBackend(str(tmp_path / 'objects')), str(tmp_path / 'index.db'), **kwargs)
+
+
+def age(path, days):
+    past = time.time() - days * 86400
+    os.utime(path, (past, past))
+
+
+def test_put_get_round_trip_through_a_pack(tmp_path):
+    store = make_store(tmp_path)
+    assert store.put('leaf.jpg', b'leaf bytes')
+    assert not store.put('leaf.jpg', b'other bytes')
+    age(os.path.join(store.backend.root, shard_key('leaf.jpg')), 60)
+
+    stats = store.compact(older_than_days=30)
+
+    assert stats['packs'] == 1 and stats['files'] == 1
+    assert not store.backend.exists(shard_key('leaf.jpg'))
+    assert store.get('leaf.jpg') == b'leaf bytes'
+    assert store.exists('leaf.jpg')
+
+
+def test_compact_keeps_recent_originals_loose(tmp_path):
+    store = make_store(tmp_path)
+    store.put('new.jpg', b'new')
+
+    assert store.compact(older_than_days=30)['files'] == 0
+    assert store.backend.exists(shard_key('new.jpg'))
+
+
+def test_compacted_original_is_read_by_another_host_within_the_refresh_window(tmp_path):
+    backend = LocalBackend(str(tmp_path / 'objects'))
+    compactor = UploadStore(backend, str(tmp_path / 'compactor.db'))
+    web = UploadStore(backend, str(tmp_path / 'web.db'), refresh_interval=3600, miss_refresh_interval=0)
+    for index in range(3):
+        compactor.put(f"leaf{index}.jpg", f"leaf {index}".encode())
+        age(os.path.join(backend.root, shard_key(f"leaf{index}.jpg")), 60)
+    # Refreshes the web host's index now, so the next throttled refresh is an hour away
+    assert not web.exists('missing.jpg')
+
+    compactor.compact(older_than_days=30, pack_bytes=8)
+
+    assert [web.get(f"leaf{index}.jpg") for index in range(3)] == [b'leaf 0', b'leaf 1', b'leaf 2']
+    with pytest.raises(FileNotFoundError):
+        web.get('missing.jpg')
+
+
+def test_misses_list_the_packs_at_most_once_per_miss_refresh_interval(tmp_path):
+    store = make_store(tmp_path, miss_refresh_interval=60)
+    listings = []
+    list_packs = store.backend.list
+    store.backend.list = lambda prefix: listings.append(prefix) or list_packs(prefix)
+
+    for index in range(10):
+        with pytest.raises(FileNotFoundError):
+            store.get(f"missing{index}.jpg")
+
+    assert listings == ['packs/']
+
+
+def test_get_rejects_names_that_are_not_upload_names(tmp_path):
+    store = make_store(tmp_path)
+    with pytest.raises(FileNotFoundError):
+        store.get('../index.db')
+    assert not store.exists('../index.db')
+
+
+def test_get_falls_back_to_the_legacy_folder(tmp_path):
+    legacy = tmp_path / 'uploads'
+    legacy.mkdir()
+    (legacy / 'old.jpg').write_bytes(b'old')
+    store = make_store(tmp_path, legacy_folder=str(legacy))
+
+    assert store.get('old.jpg') == b'old'
+
+
+def test_migrate_with_delete_only_removes_stored_files(tmp_path):
+    source = tmp_path / 'uploads'
+    source.mkdir()
+    store = make_store(tmp_path)
+    store.put('stored.jpg', b'stored')
+    (source / 'stored.jpg').write_bytes(b'stored')
+    (source / 'recent.jpg').write_bytes(b'recent')
+    (source / 'old.jpg').write_bytes(b'old')
+    age(source / 'old.jpg', 60)
+    (source / 'has space.jpg').write_bytes(b'unsafe')
+
+    result = store.migrate(str(source), delete=True, older_than_days=30)
+
+    assert result == {'loose': 1, 'skipped': 1, 'unsafe': 1, 'packs': 1, 'files': 1, 'bytes': 3}
+    assert sorted(os.listdir(source)) == ['has space.jpg']
+    assert (source / 'has space.jpg').read_bytes() == b'unsafe'
+    assert store.get('stored.jpg') == b'stored'
+    assert store.get('recent.jpg') == b'recent'
+    assert store.backend.exists(shard_key('recent.jpg'))
+    assert store.get('old.jpg') == b'old'
+    assert not store.backend.exists(shard_key('old.jpg'))
+
+
+def test_migrate_without_delete_keeps_the_source(tmp_path):
+    source = tmp_path / 'uploads'
+    source.mkdir()
+    (source / 'leaf.jpg').write_bytes(b'leaf')
+    store = make_store(tmp_path)
+
+    store.migrate(str(source))
+
+    assert os.listdir(source) == ['leaf.jpg']
+    assert store.get('leaf.jpg') == b'leaf'
@@ -0,0 +1,69 @@
+import threading
+
+from metrics import WRITE_BEHIND_DROPPED
+from writebehind import WriteBehindBuffer
+
+
+def dropped(name):
+    return WRITE_BEHIND_DROPPED._values.get((name,), 0)
+
+
+def test_items_are_written_in_batches():
+    batches = []
+    buffer = WriteBehindBuffer(batches.append, max_batch=3, max_latency_ms=50, name='test-batches')
+    for i in range(7):
+        buffer.add(i)
+
+    assert buffer.drain(timeout=5)
+    assert [item for batch in batches for item in batch] == list(range(7))
+    assert all(len(batch) <= 3 for batch in batches)
+    assert buffer.stats()['written'] == 7 and buffer.stats()['pending'] == 0
+    buffer.close()
+
+
+def test_failed_batch_is_retried_one_by_one(caplog):
+    written = []
+
+    def flush(items):
+        if 'bad' in items:
+            raise ValueError('constraint failed')
+        written.extend(items)
+
+    buffer = WriteBehindBuffer(flush, max_batch=10, max_latency_ms=50, name='test-retry')
+    for item in ('a', 'bad', 'b'):
+        buffer.add(item)
+
+    assert buffer.drain(timeout=5)
+    assert sorted(written) == ['a', 'b']
+    assert buffer.stats()['failed'] == 1
+    assert dropped('test-retry') == 1
+    assert 'test-retry' in caplog.text and 'constraint failed' in caplog.text
+    buffer.close()
+
+
+def test_close_writes_pending_items():
+    written = []
+    gate = threading.Event()
+
+    def flush(items):
+        gate.wait()
+        written.extend(items)
+
+    buffer = WriteBehindBuffer(flush, max_batch=2, max_latency_ms=1000, name='test-close')
+    for i in range(5):
+        buffer.add(i)
+    gate.set()
+    buffer.close()
+
+    assert written == [0, 1, 2, 3, 4]
+
+
+def test_drain_times_out_while_a_write_is_stuck():
+    gate = threading.Event()
+    buffer = WriteBehindBuffer(lambda items: gate.wait(), max_latency_ms=0, name='test-drain')
+    buffer.add('a')
+
+    assert not buffer.drain(timeout=0.05)
+    gate.set()
+    assert buffer.drain(timeout=5)
+    buffer.close()
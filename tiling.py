@@ -0,0 +1,152 @@
+"""
+Tiled inference for TomatoHealth
+Field photos with many leaves are split into overlapping model-sized tiles; background
+tiles are skipped using a plant mask, and the rest run through a few batched invokes
+"""
+
+import os
+
+import cv2
+import numpy as np
+
+from imaging import MODEL_INPUT_SIZE
+
+TILE_SIZE = MODEL_INPUT_SIZE[0]
+
+# Longest side the photo is scaled to before tiling, so a tile covers roughly one leaf
+WORKING_RESOLUTION = int(os.environ.get('TILING_RESOLUTION', 1536))
+# Fraction of each tile shared with its neighbours
+TILE_OVERLAP = float(os.environ.get('TILE_OVERLAP', 0.25))
+# Tiles per invoke; the last batch is padded so the input tensor keeps its shape
+TILE_BATCH_SIZE = int(os.environ.get('TILE_BATCH_SIZE', 16))
+# Minimum share of green and of edge pixels for a tile to count as plant material
+TILE_MIN_GREEN = float(os.environ.get('TILE_MIN_GREEN', 0.10))
+TILE_MIN_EDGES = float(os.environ.get('TILE_MIN_EDGES', 0.01))
+# The plant mask is built at this fraction of the working resolution
+MASK_SCALE = 4
+
+
+def tile_origins(length, tile=TILE_SIZE, overlap=TILE_OVERLAP):
+    """Start offsets of overlapping tiles along one axis; the last tile ends at the edge"""
+    if length <= tile:
+        return np.array([0])
+    stride = max(1, int(tile * (1 - overlap)))
+    origins = np.arange(0, length - tile + 1, stride)
+    if origins[-1] != length - tile:
+        origins = np.append(origins, length - tile)
+    return origins
+
+
+def working_image(image, resolution=WORKING_RESOLUTION):
+    """
+    Scale an RGB array so its longest side is at most resolution pixels,
+    and its shortest side at least one tile
+    """
+    height, width = image.shape[:2]
+    scale = min(1.0, resolution / max(height, width))
+    scale = max(scale, TILE_SIZE / min(height, width))
+    if scale == 1:
+        return image
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+    size = (max(TILE_SIZE, round(width * scale)), max(TILE_SIZE, round(height * scale)))
+    return cv2.resize(image, size, interpolation=interpolation)
+
+
+def plant_fractions(image, ys, xs, tile=TILE_SIZE):
+    """
+    Return (green, edges) arrays of shape (len(ys), len(xs)): the share of green and of
+    edge pixels in every tile, from summed-area tables of a downscaled plant mask.
+    """
+    height, width = image.shape[:2]
+    small = cv2.resize(image, (max(1, width // MASK_SCALE), max(1, height // MASK_SCALE)),
+                       interpolation=cv2.INTER_AREA)
+    hsv = cv2.cvtColor(small, cv2.COLOR_RGB2HSV)
+    green = cv2.inRange(hsv, (35, 40, 40), (85, 255, 255)) // 255
+    edges = cv2.Canny(cv2.cvtColor(small, cv2.COLOR_RGB2GRAY), 50, 150) // 255
+
+    # Tile corners in mask coordinates, every tile at once
+    top = np.minimum(ys // MASK_SCALE, small.shape[0])[:, None]
+    left = np.minimum(xs // MASK_SCALE, small.shape[1])[None, :]
+    bottom = np.minimum((ys + tile) // MASK_SCALE, small.shape[0])[:, None]
+    right = np.minimum((xs + tile) // MASK_SCALE, small.shape[1])[None, :]
+    area = np.maximum((bottom - top) * (right - left), 1)
+
+    def fraction(mask):
+        table = cv2.integral(mask)
+        return (table[bottom, right] - table[top, right] - table[bottom, left] + table[top, left]) / area
+
+    return fraction(green), fraction(edges)
+
+
+def extract_tiles(image, ys, xs, tile=TILE_SIZE):
+    """Gather (N, tile, tile, 3) tiles at the given origins with a single fancy-indexing copy"""
+    offsets = np.arange(tile)
+    rows = (ys[:, None] + offsets)[:, :, None]
+    cols = (xs[:, None] + offsets)[:, None, :]
+    return image[rows, cols]
+
+
+def run_batches(predict_batch, tiles, batch_size=TILE_BATCH_SIZE):
+    """Classify tiles in fixed-size batches and return (N, classes) probabilities"""
+    buffer = np.zeros((batch_size,) + tiles.shape[1:], dtype=np.float32)
+    outputs = []
+    for start in range(0, len(tiles), batch_size):
+        chunk = tiles[start:start + batch_size]
+        buffer[:len(chunk)] = chunk
+        buffer[len(chunk):] = 0
+        outputs.append(predict_batch(buffer)[:len(chunk)])
+    return np.concatenate(outputs)
+
+
+def aggregate(tile_probs, weights, healthy_index, lesion_threshold=0.5):
+    """
+    Combine tile probabilities into (predicted_class, confidence, probabilities).
+    Probabilities are the plant-weighted mean over tiles, but a disease that any single
+    tile shows with at least lesion_threshold confidence wins: one sick leaf among
+    healthy ones must not be averaged away.
+    """
+    probabilities = np.average(tile_probs, axis=0, weights=weights).astype(np.float32)
+    peaks = tile_probs.max(axis=0)
+    peaks[healthy_index] = 0
+    disease = int(np.argmax(peaks))
+    if peaks[disease] >= lesion_threshold:
+        return disease, float(peaks[disease]), probabilities
+    predicted_class = int(np.argmax(probabilities))
+    return predicted_class, float(probabilities[predicted_class]), probabilities
+
+
+def predict_tiled(predict_batch, image, healthy_index, lesion_threshold=0.5):
+    """
+    Classify a high-resolution RGB array tile by tile.
+    Returns (result, heatmap): result is (predicted_class, confidence, probabilities) for the
+    whole image, or None when no tile contains plant material; heatmap describes every tile.
+    """
+    image = working_image(image)
+    height, width = image.shape[:2]
+    ys, xs = tile_origins(height), tile_origins(width)
+
+    green, edges = plant_fractions(image, ys, xs, TILE_SIZE)
+    keep = (green >= TILE_MIN_GREEN) & (edges >= TILE_MIN_EDGES)
+    rows, cols = np.nonzero(keep)
+
+    heatmap = {
+        'width': width, 'height': height, 'tile_size': TILE_SIZE,
+        'rows': len(ys), 'cols': len(xs), 'tiles_total': int(keep.size), 'tiles_analyzed': len(rows),
+        'tiles': [],
+    }
+    if not len(rows):
+        return None, heatmap
+
+    tiles = extract_tiles(image, ys[rows], xs[cols], TILE_SIZE)
+    tile_probs = run_batches(predict_batch, tiles)
+    result = aggregate(tile_probs, green[rows, cols], healthy_index, lesion_threshold)
+
+    classes = tile_probs.argmax(axis=1)
+    for row, col, predicted_class, probs in zip(rows, cols, classes, tile_probs):
+        heatmap['tiles'].append({
+            'row': int(row), 'col': int(col), 'x': int(xs[col]), 'y': int(ys[row]),
+            'class': int(predicted_class), 'confidence': float(probs[predicted_class]),
+            # Probability that the tile shows any disease, the heatmap intensity
+            'disease': float(1 - probs[healthy_index]),
+        })
+    return result, heatmap
@@ -0,0 +1,196 @@
+"""
+Upload validation for TomatoHealth
+A cascade of checks ordered from cheapest to most expensive that stops at the first failure,
+so most unusable uploads are rejected in milliseconds, before they reach the model
+"""
+
+import io
+import os
+import time
+from functools import cached_property
+
+import cv2
+from PIL import Image
+
+from imaging import (MIN_EDGE_PERCENTAGE, MIN_GREEN_PERCENTAGE, MODEL_INPUT_SIZE, brightness, decode_image,
+                     edge_percentage, green_percentage, proxy_image, sharpness)
+from metrics import REJECTIONS, STAGE_SECONDS
+
+NON_PLANT_MESSAGE = ("The uploaded image doesn't appear to contain plant material. "
+                     "Please upload a clear photo of a tomato leaf or plant.")
+
+# Predictions below this confidence are rejected rather than shown
+MIN_CONFIDENCE = 0.3
+LOW_CONFIDENCE_MESSAGE = ('The image quality is too low for reliable disease detection. '
+                          'Please upload a clearer image of a tomato leaf.')
+
+
+class Sample:
+    """An upload under validation; the decoded image and its small proxies are computed on first use"""
+
+    def __init__(self, data=None, image=None, max_side=None):
+        self.data = data
+        # Decode at up to this many pixels on the longest side instead of just the model input size
+        self.max_side = max_side
+        if image is not None:
+            self.image = image
+
+    @cached_property
+    def size(self):
+        """(width, height) of the original upload, read from the header without decoding"""
+        if self.data is not None:
+            return Image.open(io.BytesIO(self.data)).size
+        return self.image.shape[1], self.image.shape[0]
+
+    @cached_property
+    def image(self):
+        target_size = MODEL_INPUT_SIZE
+        if self.max_side:
+            width, height = self.size
+            scale = min(1.0, self.max_side / max(width, height))
+            target_size = (round(width * scale), round(height * scale))
+        with STAGE_SECONDS.time(stage='decode'):
+            return decode_image(self.data, target_size)
+
+    @cached_property
+    def proxy(self):
+        return proxy_image(self.image)
+
+    @cached_property
+    def hsv(self):
+        return cv2.cvtColor(self.proxy, cv2.COLOR_RGB2HSV)
+
+    @cached_property
+    def gray(self):
+        return cv2.cvtColor(self.proxy, cv2.COLOR_RGB2GRAY)
+
+
+class Check:
+    """One validation stage; returns an error message, or None when the sample passes"""
+    name = None
+    # Relative cost, the cascade runs cheaper checks first
+    cost = 0
+
+    def __call__(self, sample):
+        raise NotImplementedError
+
+
+class FileSize(Check):
+    name = 'file_size'
+    cost = 0
+
+    def __init__(self, min_bytes=1024):
+        self.min_bytes = min_bytes
+
+    def __call__(self, sample):
+        if sample.data is not None and len(sample.data) < self.min_bytes:
+            return "The uploaded file is too small to be a photo."
+
+
+class Dimensions(Check):
+    name = 'dimensions'
+    cost = 1
+
+    def __init__(self, min_side=64, max_pixels=50_000_000):
+        self.min_side = min_side
+        self.max_pixels = max_pixels
+
+    def __call__(self, sample):
+        width, height = sample.size
+        if min(width, height) < self.min_side:
+            return f"The image is too small; it should be at least {self.min_side}x{self.min_side} pixels."
+        if width * height > self.max_pixels:
+            return f"The image is too large; please upload a photo of at most {self.max_pixels / 1e6:g} megapixels."
+
+
+class GreenRatio(Check):
+    name = 'green_ratio'
+    cost = 10
+
+    def __init__(self, min_percentage=MIN_GREEN_PERCENTAGE):
+        self.min_percentage = min_percentage
+
+    def __call__(self, sample):
+        if green_percentage(sample.hsv) <= self.min_percentage:
+            return NON_PLANT_MESSAGE
+
+
+class Exposure(Check):
+    name = 'exposure'
+    cost = 11
+
+    def __init__(self, min_brightness=20, max_brightness=240):
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+
+    def __call__(self, sample):
+        level = brightness(sample.gray)
+        if level < self.min_brightness:
+            return "The image is too dark. Please retake the photo in better light."
+        if level > self.max_brightness:
+            return "The image is overexposed. Please retake the photo out of direct glare."
+
+
+class Sharpness(Check):
+    name = 'blur'
+    cost = 12
+
+    def __init__(self, min_sharpness=10):
+        self.min_sharpness = min_sharpness
+
+    def __call__(self, sample):
+        if sharpness(sample.gray) < self.min_sharpness:
+            return "The image is too blurry. Please hold the camera steady and focus on the leaf."
+
+
+class EdgeDensity(Check):
+    name = 'edge_density'
+    cost = 20
+
+    def __init__(self, min_percentage=MIN_EDGE_PERCENTAGE):
+        self.min_percentage = min_percentage
+
+    def __call__(self, sample):
+        if edge_percentage(sample.gray) <= self.min_percentage:
+            return NON_PLANT_MESSAGE
+
+
+class ValidationCascade:
+    """
+    Runs checks in order of cost and stops at the first failure.
+    The model's own confidence threshold is the final, most expensive stage and is applied by the caller.
+    """
+
+    def __init__(self, checks):
+        self.checks = sorted(checks, key=lambda check: check.cost)
+
+    def run(self, sample):
+        """Return (is_valid, message, name of the failed check or None)"""
+        for check in self.checks:
+            started = time.perf_counter()
+            try:
+                message = check(sample)
+            except Exception as e:
+                REJECTIONS.inc(reason='invalid_image')
+                return False, f"Error validating image: {str(e)}", 'invalid_image'
+            finally:
+                STAGE_SECONDS.observe(time.perf_counter() - started, stage=f"check_{check.name}")
+            if message:
+                REJECTIONS.inc(reason=check.name)
+                return False, message, check.name
+        return True, "Image validation passed.", None
+
+
+def default_cascade():
+    """The web app's cascade, with thresholds overridable from the environment"""
+    env = os.environ.get
+    return ValidationCascade([
+        FileSize(min_bytes=int(env('VALIDATE_MIN_BYTES', 1024))),
+        Dimensions(min_side=int(env('VALIDATE_MIN_SIDE', 64)),
+                   max_pixels=int(env('VALIDATE_MAX_PIXELS', 50_000_000))),
+        GreenRatio(min_percentage=float(env('VALIDATE_MIN_GREEN', MIN_GREEN_PERCENTAGE))),
+        Exposure(min_brightness=float(env('VALIDATE_MIN_BRIGHTNESS', 20)),
+                 max_brightness=float(env('VALIDATE_MAX_BRIGHTNESS', 240))),
+        Sharpness(min_sharpness=float(env('VALIDATE_MIN_SHARPNESS', 10))),
+        EdgeDensity(min_percentage=float(env('VALIDATE_MIN_EDGES', MIN_EDGE_PERCENTAGE))),
+    ])
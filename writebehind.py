@@ -0,0 +1,129 @@
+"""
+Write-behind buffer for TomatoHealth
+Records are queued in memory and written by a background thread in batches, so many
+requests share one transaction (and one fsync) instead of committing one row each
+"""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from metrics import WRITE_BEHIND_DROPPED
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """
+    Collects items from many threads and hands them to flush(items) in batches.
+    A batch is written as soon as it holds max_batch items or its oldest item has waited
+    max_latency_ms, whichever comes first. If a batch fails, its items are retried one
+    by one so a single bad row cannot lose the others. Pending items are written at exit.
+    """
+
+    def __init__(self, flush, max_batch=64, max_latency_ms=200.0, name='write-behind'):
+        self.flush = flush
+        self.max_batch = max(1, int(max_batch))
+        self.max_latency = max(0.0, float(max_latency_ms)) / 1000.0
+        self.name = name
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        # Items queued but not yet written, for drain()
+        self._pending = 0
+        self._idle = threading.Condition(self._lock)
+        # Statistics
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        # Threads do not survive fork, so each worker process starts its own writer
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pending = 0
+                self._pid = os.getpid()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def add(self, item):
+        """Queue an item; it is written within max_latency_ms"""
+        self._ensure_started()
+        with self._lock:
+            self._pending += 1
+        self._queue.put((time.perf_counter(), item))
+
+    def drain(self, timeout=None):
+        """Block until every item queued so far has been written; returns False on timeout"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def close(self, timeout=30):
+        """Write everything still queued and stop the writer thread"""
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first[1]]
+        deadline = first[0] + self.max_latency
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                entry = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is None:
+                # Write this batch first, then stop
+                self._queue.put(None)
+                break
+            batch.append(entry[1])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            written = self._write(batch)
+            with self._idle:
+                self.batches += 1
+                self.written += written
+                self.failed += len(batch) - written
+                self._pending -= len(batch)
+                self._idle.notify_all()
+
+    def _write(self, batch):
+        try:
+            self.flush(batch)
+            return len(batch)
+        except Exception:
+            if len(batch) == 1:
+                logger.exception('Dropped a buffered record of %s that could not be written', self.name)
+                WRITE_BEHIND_DROPPED.inc(buffer=self.name)
+                return 0
+        # Retry one by one so only the offending item is lost
+        return sum(self._write([item]) for item in batch)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': self._pending,
+                'batches': self.batches,
+                'written': self.written,
+                'failed': self.failed,
+                'avg_batch_size': self.written / self.batches if self.batches else 0.0,
+            }